@@ -7,13 +7,20 @@ import logging # module to enable logging
 import numpy as np
 import time
 
+# import custom functions
+from X_filtering_functions import field_diagnostics
+from X_kernels import GT_HET, GT_MISSING, gt_code
+
 # setup argument parser
 parser = argparse.ArgumentParser(description="Script to filter vcf files.")
 parser.add_argument('-i', '--input', type=str, default='', help='Name of input vcf file.')
 parser.add_argument('-o', '--output', type=str, default='', help='Output prefix to use.')
 parser.add_argument('-gq', '--gq-threshold', type=int, default=20, help='GQ threshold to use (default=20).')
+parser.add_argument('--diagnostics-output', type=str, default='', help='Name of file to write the counts of malformed GQ, DP and GT fields per sample to (not written if none specified, a summary is always logged).')
+parser.add_argument('--verbose-fields', action='store_true', help='Log every malformed GQ, DP and GT field as it is seen.')
 parser.add_argument('--log-file', type=str, default='', help='File to write log information to (uses stdout if none specified).')
 parser.add_argument('-r', '--reverse', action='store_true', help='Interchange the labels on the males and females.')
+parser.add_argument('-c', '--genotype-cache', type=str, default='', help='Directory of a bit packed genotype cache to read genotypes from, built from the input if missing or out of date.')
 
 # parse command line arguments
 opts = parser.parse_args(sys.argv[1:])
@@ -36,20 +43,22 @@ def find_genders(x, offset, reverse=False):
         return males, females
 
 def is_heterozygote(snp_info):
-    first_part = snp_info[:snp_info.find(':')]
-    if first_part == '0/1':
+    # phased, multi-allelic and haploid calls are classified with the interned GT table
+    code = gt_code(snp_info[:snp_info.find(':')])
+    if code == GT_HET:
         return True
-    elif first_part == '0/0' or first_part == '1/1':
-        return False
-    else:
+    elif code == GT_MISSING:
         return None
+    else:
+        return False
 
-def is_gq_greater_than(snp_info, gq_threshold):
+def is_gq_greater_than(snp_info, gq_threshold, col=None, diagnostics=field_diagnostics):
     parts = snp_info.split(':')
     try:
         gq_value = int(parts[-1]) # we expect GQ to be the last field
     except Exception as exception:
-        logging.debug('GQ value not integer valued: %s of %s.' % (parts[-1], snp_info))
+        if diagnostics is not None:
+            diagnostics.add('GQ', 'not_integer', col, snp_info)
         return False
     return gq_value >= gq_threshold
 
@@ -77,16 +86,17 @@ def count_zygote_gt_by_gender(row, male_cols, female_cols):
     else:
         return  n_hz_male/float(n_male), n_hz_female/float(n_female)
 
-def filter_by_gq(row, gq_threshold, offset, empty_str='.'):
+def filter_by_gq(row, gq_threshold, offset, empty_str='.', diagnostics=field_diagnostics):
     n = 0
     for i in range(offset, len(row)):
-        if not is_gq_greater_than(row[i], gq_threshold):
+        if not is_gq_greater_than(row[i], gq_threshold, i, diagnostics):
             n += 1
             row[i] = empty_str
     return n
 
 # setup logging, this will log anything info level or above
 logging.basicConfig(filename=(opts.log_file if opts.log_file != '' else None), filemode='a', level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+field_diagnostics.verbose = opts.verbose_fields
 
 logging.info('Start of plotting.')
 
@@ -100,33 +110,55 @@ except ImportError as ex:
     sys.exit(-1)
 
 
+def heterozygote_proportions_from_cache(cache, reverse=False):
+    # vectorised count_zygote_gt_by_gender over every SNP of the cache
+    male_idx, female_idx = find_genders(cache['samples'], offset=0, reverse=reverse)
+    n_hz_male, n_hm_male = genotype_counts(cache, male_idx)[:2]
+    n_hz_female, n_hm_female = genotype_counts(cache, female_idx)[:2]
+    n_male, n_female = n_hz_male + n_hm_male, n_hz_female + n_hm_female
+    keep = np.flatnonzero((n_male > 0) & (n_female > 0))
+    male_hzs = list(n_hz_male[keep]/n_male[keep].astype(float))
+    female_hzs = list(n_hz_female[keep]/n_female[keep].astype(float))
+    consensus = [cache['contigs'][i] for i in cache['contig_idx'][keep]]
+    position = [str(p) for p in cache['positions'][keep]]
+    return male_hzs, female_hzs, consensus, position
+
+
 # open files for reading
 try:
-    f = open(opts.input, "r")
-    logging.info('Opened input file %s' % opts.input)
-    csv_reader = csv.reader(f, delimiter="\t")
     male_hzs, female_hzs = [], []
     consensus, position = [], []
     s = time.time()
-    for row in csv_reader:
-        if row[0].startswith("##"):
-            continue
-        if row[0].startswith("#"): # header column
-            headers = row
-            individuals = headers[individual_start_col:]
-            male_cols, female_cols = find_genders(individuals, offset=individual_start_col, reverse=opts.reverse)
-        else:
-            gq_filtered = filter_by_gq(row, opts.gq_threshold, offset=individual_start_col)  # filter individuals where gq is less than given threshold
-            male_hz, female_hz = count_zygote_gt_by_gender(row, male_cols, female_cols)
-            if male_hz is not None and female_hz is not None:
-                male_hzs.append(male_hz)
-                female_hzs.append(female_hz)
-                consensus.append(row[0])
-                position.append(row[1])
+    if opts.genotype_cache != '':
+        from X_genotype_cache import load_or_build_genotype_cache, genotype_counts
+        cache = load_or_build_genotype_cache(opts.input, opts.genotype_cache, individual_start_col, opts.gq_threshold)
+        male_hzs, female_hzs, consensus, position = heterozygote_proportions_from_cache(cache, reverse=opts.reverse)
+    else:
+        f = open(opts.input, "r")
+        logging.info('Opened input file %s' % opts.input)
+        csv_reader = csv.reader(f, delimiter="\t")
+        for row in csv_reader:
+            if row[0].startswith("##"):
+                continue
+            if row[0].startswith("#"): # header column
+                headers = row
+                individuals = headers[individual_start_col:]
+                male_cols, female_cols = find_genders(individuals, offset=individual_start_col, reverse=opts.reverse)
+            else:
+                gq_filtered = filter_by_gq(row, opts.gq_threshold, offset=individual_start_col)  # filter individuals where gq is less than given threshold
+                male_hz, female_hz = count_zygote_gt_by_gender(row, male_cols, female_cols)
+                if male_hz is not None and female_hz is not None:
+                    male_hzs.append(male_hz)
+                    female_hzs.append(female_hz)
+                    consensus.append(row[0])
+                    position.append(row[1])
+        f.close()
 
     e = time.time()
-    logging.info('Found values for %d snps.' % (len(male_hzs)))
-    f.close()
+    logging.info('Found values for %d snps in %.2f seconds.' % (len(male_hzs), e-s))
+    field_diagnostics.log_summary()
+    if opts.diagnostics_output != '':
+        field_diagnostics.write(opts.diagnostics_output, headers if opts.genotype_cache == '' else None)
 
     plt.plot(female_hzs, male_hzs, marker='o', ls='none')
     plt.xlabel('female')
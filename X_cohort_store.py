@@ -0,0 +1,181 @@
+#!/usr/bin/python
+"""
+Persistent per-cohort store of GQ masked depths and genotype codes.
+
+The store is a directory of numpy arrays (one row per SNP, one column per sample) so that
+samples or contigs from new VCFs can be merged in and the fold change filter re-run over the
+whole cohort without re-parsing any VCF text.
+"""
+import argparse # package to help with argument parsing
+import csv
+import json
+import logging # module to enable logging
+import os
+import sys
+import time
+import numpy as np
+
+# import custom functions
+from X_filtering_functions import *
+from X_kernels import KERNELS, set_kernel
+
+
+STORE_ARRAYS = ['contig_idx', 'positions', 'dp', 'gt', 'gq_pass', 'totals']
+
+
+def store_exists(store_dir):
+    return os.path.exists(os.path.join(store_dir, 'store_info.json'))
+
+def load_store(store_dir, mmap_mode=None):
+    with open(os.path.join(store_dir, 'store_info.json')) as f:
+        store = json.load(f)
+    for name in STORE_ARRAYS:
+        store[name] = np.load(os.path.join(store_dir, name + '.npy'), mmap_mode=mmap_mode)
+    return store
+
+def save_store(store_dir, store):
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    for name in STORE_ARRAYS:
+        np.save(os.path.join(store_dir, name + '.npy'), store[name])
+    # write the json last so a half written store is never picked up
+    info = {'samples': store['samples'], 'contigs': store['contigs'], 'gq_threshold': store['gq_threshold']}
+    with open(os.path.join(store_dir, 'store_info.json'), 'w') as f:
+        json.dump(info, f)
+
+def cohort_from_vcf(input_file, individual_start_col, gq_threshold, max_memory=None):
+    cohort = read_vcf_arrays(input_file, individual_start_col, gq_threshold, max_memory=max_memory)
+    cohort['gq_threshold'] = gq_threshold
+    cohort['totals'] = cohort['dp'].sum(axis=0, dtype=np.int64)
+    return cohort
+
+def merge_cohorts(old, new):
+    """
+    Merge two cohorts on (contig, position) and sample name.
+    Cells not present in a cohort are missing (depth 0, GT_MISSING, failed GQ).
+    Where both cohorts have the same sample at the same site the new values are kept.
+    """
+    if old['gq_threshold'] != new['gq_threshold']:
+        raise ValueError('Cannot merge cohorts masked with GQ thresholds %d and %d.' % (old['gq_threshold'], new['gq_threshold']))
+    contigs = list(old['contigs'])
+    contig_ids = dict((contig, i) for i, contig in enumerate(contigs))
+    for contig in new['contigs']:
+        if contig not in contig_ids:
+            contig_ids[contig] = len(contigs)
+            contigs.append(contig)
+    new_contig_map = np.array([contig_ids[contig] for contig in new['contigs']], np.int32)
+    new_contig_idx = new_contig_map[new['contig_idx']] if len(new_contig_map) else np.zeros(0, np.int32)
+
+    # union of the sites, ordered by contig then position
+    all_contig_idx = np.concatenate([old['contig_idx'], new_contig_idx])
+    all_positions = np.concatenate([old['positions'], new['positions']])
+    keys = np.stack([all_contig_idx.astype(np.int64), all_positions])
+    site_keys, site_rows = np.unique(keys, axis=1, return_inverse=True)
+    site_rows = site_rows.reshape(-1)
+    old_rows, new_rows = site_rows[:len(old['positions'])], site_rows[len(old['positions']):]
+
+    samples = list(old['samples'])
+    sample_ids = dict((sample, i) for i, sample in enumerate(samples))
+    for sample in new['samples']:
+        if sample not in sample_ids:
+            sample_ids[sample] = len(samples)
+            samples.append(sample)
+    old_cols = np.arange(len(old['samples']))
+    new_cols = np.array([sample_ids[sample] for sample in new['samples']], np.int64)
+
+    overlap = np.intersect1d(old_rows, new_rows).size * np.intersect1d(old_cols, new_cols).size
+    if overlap:
+        logging.warning('%d cells present in both cohorts, keeping the newly added values.' % overlap)
+
+    n_sites, n_samples = site_keys.shape[1], len(samples)
+    merged = {'samples': samples, 'contigs': contigs, 'gq_threshold': old['gq_threshold'],
+              'contig_idx': site_keys[0].astype(np.int32), 'positions': site_keys[1],
+              'dp': np.zeros((n_sites, n_samples), np.int32),
+              'gt': np.full((n_sites, n_samples), GT_MISSING, np.int8),
+              'gq_pass': np.zeros((n_sites, n_samples), bool)}
+    for rows, cols, cohort in [(old_rows, old_cols, old), (new_rows, new_cols, new)]:
+        for name in ['dp', 'gt', 'gq_pass']:
+            merged[name][np.ix_(rows, cols)] = cohort[name]
+    merged['totals'] = merged['dp'].sum(axis=0, dtype=np.int64)
+    return merged
+
+def store_filter_results(store, male_idx, female_idx, fold_change_margin):
+    """
+    Recompute the meta data and filter decision of every SNP in the store.
+    """
+    return filter_results(store['gt'], store['dp'], store['gq_pass'], male_idx, female_idx, store['totals'], fold_change_margin)
+
+def write_store_meta(meta_output, store, results):
+    with open(meta_output, 'w') as fm:
+        csv_meta_writer = csv.writer(fm, delimiter="\t")
+        csv_meta_writer.writerow(META_HEADERS)
+        undetermined = np.isnan(results['fold_change'])
+        for i in range(len(store['positions'])):
+            fold_change_in_range = None if undetermined[i] else bool(results['fold_change_in_range'][i])
+            csv_meta_writer.writerow([store['contigs'][store['contig_idx'][i]], store['positions'][i],
+                                      bool(results['is_male_heterozygote'][i]),
+                                      results['n_male_homozygote'][i], results['n_male_heterozygote'][i],
+                                      results['n_female_homozygote'][i], results['n_female_heterozygote'][i],
+                                      results['n_gq_filtered'][i], results['male_mean_coverage'][i],
+                                      results['female_mean_coverage'][i], results['fold_change'][i], fold_change_in_range])
+
+
+# only run following code if was called from command line
+if __name__ == '__main__':
+    # setup argument parser
+    parser = argparse.ArgumentParser(description="Script to build a cohort store from vcf files and filter it.")
+    parser.add_argument('-s', '--store', type=str, default='', help='Directory of the cohort store.')
+    parser.add_argument('-a', '--add', type=str, action='append', default=[], help='Vcf file whose samples/contigs are merged into the store (can be repeated).')
+    parser.add_argument('-m', '--meta-output', type=str, default='', help='Name of meta data output file recomputed from the store.')
+    parser.add_argument('-p', '--passing-output', type=str, default='', help='Name of file to write the loci passing the filter to.')
+    parser.add_argument('-gq', '--gq-threshold', type=int, default=20, help='GQ threshold to use when adding vcf files (default=20).')
+    parser.add_argument('--fold-change-margin', type=float, default=0.2, help='Margin around 2.0 to use for fold change check (default=0.2).')
+    parser.add_argument('--log-file', type=str, default='', help='File to write log information to (uses stdout if none specified).')
+    parser.add_argument('-r', '--reverse', action='store_true', help='Interchange the labels on the males and females.')
+    parser.add_argument('--max-memory', type=str, default='', help='Memory budget used to size the blocks of records parsed together, e.g. 2G or 500M (default=blocks of 10000 records).')
+    parser.add_argument('--kernel', type=str, default='auto', choices=KERNELS, help='Record parsing kernel, auto uses numba when installed (default=auto).')
+
+    # parse command line arguments
+    opts = parser.parse_args(sys.argv[1:])
+
+    # config values
+    individual_start_col = 9
+
+    # setup logging, this will log anything info level or above
+    logging.basicConfig(filename=(opts.log_file if opts.log_file != '' else None), filemode='a', level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+
+    set_kernel(opts.kernel)
+    max_memory = parse_memory_size(opts.max_memory) if opts.max_memory != '' else None
+
+    try:
+        store = load_store(opts.store) if store_exists(opts.store) else None
+        for input_file in opts.add:
+            s = time.time()
+            cohort = cohort_from_vcf(input_file, individual_start_col, opts.gq_threshold, max_memory=max_memory)
+            store = cohort if store is None else merge_cohorts(store, cohort)
+            save_store(opts.store, store)
+            e = time.time()
+            logging.info('Added %s to store %s (%d snps x %d samples) in %.2f seconds.' % (input_file, opts.store, store['dp'].shape[0], store['dp'].shape[1], e-s))
+        if store is None:
+            logging.error('No cohort store found at %s.' % opts.store)
+            sys.exit(-1)
+
+        if opts.meta_output != '' or opts.passing_output != '':
+            s = time.time()
+            male_idx, female_idx = find_genders(store['samples'], offset=0, reverse=opts.reverse)
+            results = store_filter_results(store, male_idx, female_idx, opts.fold_change_margin)
+            if opts.meta_output != '':
+                write_store_meta(opts.meta_output, store, results)
+                logging.info('Wrote meta file %s' % opts.meta_output)
+            if opts.passing_output != '':
+                with open(opts.passing_output, 'w') as fp:
+                    for i in np.flatnonzero(results['passed']):
+                        fp.write('%s\t%d\n' % (store['contigs'][store['contig_idx'][i]], store['positions'][i]))
+                logging.info('Wrote passing loci file %s' % opts.passing_output)
+            total = len(store['positions'])
+            removed = total - int(results['passed'].sum())
+            e = time.time()
+            logging.info('Filtered %d/%d records leaving %d in %.2f seconds.' % (removed, total, total - removed, e-s))
+        logging.info('Peak memory use %.1f MB.' % (peak_rss() / 1024.0**2))
+    except IOError as ioerror:
+        logging.error('Problem opening files: ' + str(ioerror))
@@ -8,6 +8,7 @@ from collections import defaultdict
 from scipy import stats
 import numpy as np
 import csv
+import itertools
 import argparse # package to help with argument parsing
 import time
 
@@ -24,6 +25,11 @@ parser.add_argument('-gq', '--gq-threshold', type=int, default=20, help='GQ thre
 parser.add_argument('--fold-change-margin', type=float, default=0.2, help='Margin around 2.0 to use for fold change check (default=0.2).')
 parser.add_argument('--log-file', type=str, default='', help='File to write log information to (uses stdout if none specified).')
 parser.add_argument('-r', '--reverse', action='store_true', help='Interchange the labels on the males and females.')
+parser.add_argument('--multiple-testing', type=str, default='none', choices=['none'] + OutOfCoreQValues.methods, help='Correct the one sided t-test p-values genome-wide with Benjamini-Hochberg (bh) or Bonferroni, none tests the raw p-values (default=none).')
+parser.add_argument('--alpha', type=float, default=0.05, help='Significance level of the (corrected) one sided t-test (default=0.05).')
+parser.add_argument('--diagnostics-output', type=str, default='', help='Name of file to write the counts of malformed GQ, DP and GT fields per sample to (not written if none specified, a summary is always logged).')
+parser.add_argument('--verbose-fields', action='store_true', help='Log every malformed GQ, DP and GT field as it is seen.')
+parser.add_argument('--sort-chunk-records', type=int, default=1 << 22, help='Number of p-values sorted in memory at a time when ranking them for the correction (default=4194304).')
 
 # parse command line arguments
 opts = parser.parse_args(sys.argv[1:])
@@ -41,6 +47,8 @@ logging.basicConfig(filename=(opts.log_file if opts.log_file != '' else None), f
 
 logging.info('Start of filtering.')
 
+field_diagnostics.verbose = opts.verbose_fields
+
 
 total_sample_read_depth = total_read_dp_per_individual(opts.input, individual_start_col, opts.gq_threshold)
 #print(total_sample_read_depth)
@@ -48,9 +56,13 @@ total_sample_read_depth = total_read_dp_per_individual(opts.input, individual_st
 
 # open files for reading
 try:
+    correct = opts.multiple_testing != 'none'
     f = open(opts.input, "r")
-    fw = open(opts.output, "w")
-    fm = open(opts.meta_output, "w")
+    # with a correction the first pass writes the candidate rows and meta data to temporary files
+    # and spills the p-values, the second pass applies the corrected threshold
+    fw = open(opts.output + '.candidates.tmp' if correct else opts.output, "w")
+    fm = open(opts.meta_output + '.uncorrected.tmp' if correct else opts.meta_output, "w")
+    qvalues = OutOfCoreQValues(opts.meta_output, opts.multiple_testing, opts.sort_chunk_records) if correct else None
     logging.info('Opened input file %s' % opts.input)
     logging.info('Opened output file %s' % opts.output)
     logging.info('Opened output meta file %s' % opts.meta_output)
@@ -66,9 +78,7 @@ try:
             individuals = headers[individual_start_col:]
             male_cols, female_cols = find_genders(individuals, offset=individual_start_col, reverse=opts.reverse)
             csv_writer.writerow(row)
-            csv_meta_writer.writerow(["locus", "position", "is_male_heterozygote", "n_male_homozygote", "n_male_heterozygote",
-                                      "n_female_homozygote", "n_female_heterozygote", "n_gq_filtered", "male_mean_coverage",
-                                      "female_mean_coverage", "fold_change", "fold_change_in_range", "t_stat_eq", "pvalue_eq", "pvalue_eq_divided_2"])
+            csv_meta_writer.writerow(META_HEADERS + ["t_stat_eq", "pvalue_eq", "pvalue_eq_divided_2"])
         else:
             total += 1
             gq_filtered = filter_by_gq(row, opts.gq_threshold, offset=individual_start_col)  # filter individuals where gq is less than given threshold                            
@@ -83,17 +93,62 @@ try:
                 else:
                     fold_change_in_range = False
                     
-               
-            if not is_male_heterozygote and pvalue_eq_divided_2<.05 and fold_change_in_range:
+            if correct:
+                qvalues.add(pvalue_eq_divided_2)
+                if not is_male_heterozygote and fold_change_in_range:
+                    csv_writer.writerow(row)
+            elif not is_male_heterozygote and fold_change_in_range and pvalue_eq_divided_2 < opts.alpha:
                 csv_writer.writerow(row)
             else:
                 removed += 1
             csv_meta_writer.writerow([row[0], row[1], is_male_heterozygote, n_hm_male, n_ht_male, n_hm_female, n_ht_female, gq_filtered,
                                       male_mean_coverage, female_mean_coverage, fold_change, fold_change_in_range, t_stat_eq, pvalue_eq, pvalue_eq_divided_2])
-    e = time.time()
-    logging.info('Filtered %d/%d records leaving %d in %.2f seconds.' % (removed, total, total - removed, e-s))
     f.close()
     fw.close()
     fm.close()
+
+    if correct:
+        rank_start = time.time()
+        qvalues.finish()
+        logging.info('Ranked %d p-values for the %s correction in %.2f seconds.' % (qvalues.n_tests, opts.multiple_testing, time.time()-rank_start))
+        fc = open(opts.output + '.candidates.tmp', "r", newline='')
+        fu = open(opts.meta_output + '.uncorrected.tmp', "r", newline='')
+        fw = open(opts.output, "w")
+        fm = open(opts.meta_output, "w")
+        csv_meta_reader = csv.reader(fu, delimiter="\t")
+        csv_meta_writer = csv.writer(fm, delimiter="\t")
+        fw.write(fc.readline()) # header
+        csv_meta_writer.writerow(next(csv_meta_reader) + ["qvalue"])
+        meta_rows = []
+        for meta_row in itertools.chain(csv_meta_reader, [None]):
+            if meta_row is not None:
+                meta_rows.append(meta_row)
+                if len(meta_rows) < 65536:
+                    continue
+            # pvalue_eq_divided_2 is empty when the coverage could not be computed
+            qs = qvalues.qvalues([float(r[14]) if r[14] != '' else np.nan for r in meta_rows])
+            for r, q in zip(meta_rows, qs):
+                q = None if np.isnan(q) else q
+                candidate = r[2] == 'False' and r[11] == 'True'
+                line = fc.readline() if candidate else None
+                if candidate and q is not None and q < opts.alpha:
+                    fw.write(line)
+                else:
+                    removed += 1
+                csv_meta_writer.writerow(r + [q])
+            meta_rows = []
+        fc.close()
+        fu.close()
+        fw.close()
+        fm.close()
+        qvalues.close()
+        os.remove(opts.output + '.candidates.tmp')
+        os.remove(opts.meta_output + '.uncorrected.tmp')
+    e = time.time()
+    logging.info('Filtered %d/%d records leaving %d in %.2f seconds.' % (removed, total, total - removed, e-s))
+    field_diagnostics.log_summary()
+    if opts.diagnostics_output != '':
+        field_diagnostics.write(opts.diagnostics_output, headers)
+        logging.info('Wrote %d malformed field counts to %s' % (len(field_diagnostics.counts), opts.diagnostics_output))
 except IOError as ioerror:
     logging.error('Problem opening files: ' + str(ioerror))
@@ -9,19 +9,49 @@ import time
 
 # import custom functions
 from X_filtering_functions import *
+from X_kernels import KERNELS, set_kernel
 
 
 # only run following code if was called from command line
 if __name__ == '__main__':
     # setup argument parser
     parser = argparse.ArgumentParser(description="Script to filter vcf files.")
-    parser.add_argument('-i', '--input', type=str, default='', help='Name of input vcf file.')
-    parser.add_argument('-o', '--output', type=str, default='', help='Name of output vcf file.')
+    parser.add_argument('-i', '--input', type=str, default='', help='Name of input vcf file, - to read from stdin (needs --sample-depths).')
+    parser.add_argument('-o', '--output', type=str, default='', help='Name of output vcf file, - to write to stdout.')
     parser.add_argument('-m', '--meta-output', type=str, default='', help='Name of meta data output file.')
     parser.add_argument('-gq', '--gq-threshold', type=int, default=20, help='GQ threshold to use (default=20).')
     parser.add_argument('--fold-change-margin', type=float, default=0.2, help='Margin around 2.0 to use for fold change check (default=0.2).')
+    parser.add_argument('--male-het-alpha', type=float, default=0, help='Tolerate male heterozygotes that could all be genotyping errors given the GQ of the male calls, rejecting a SNP only when this is less likely than the alpha; 0 rejects any male heterozygote (default=0).')
     parser.add_argument('--log-file', type=str, default='', help='File to write log information to (uses stdout if none specified).')
     parser.add_argument('-r', '--reverse', action='store_true', help='Interchange the labels on the males and females.')
+    parser.add_argument('--include-samples', type=str, default='', help='Comma separated sample names, or a file with one per line, to restrict the analysis to.')
+    parser.add_argument('--exclude-samples', type=str, default='', help='Comma separated sample names, or a file with one per line, to leave out of the analysis.')
+    parser.add_argument('--kernel', type=str, default='auto', choices=KERNELS, help='Record parsing kernel, auto uses numba when installed (default=auto).')
+    parser.add_argument('--max-memory', type=str, default='', help='Memory budget used to size the blocks of records processed together, e.g. 2G or 500M (default=blocks of 10000 records).')
+    parser.add_argument('--checkpoint-every', type=int, default=0, help='Write a checkpoint after roughly this many records, 0 to disable (default=0).')
+    parser.add_argument('--checkpoint-file', type=str, default='', help='Name of the checkpoint file (default=<output>.checkpoint).')
+    parser.add_argument('--resume', action='store_true', help='Continue from the last checkpoint, truncating the outputs to it.')
+    parser.add_argument('-s', '--scaffold-output', type=str, default='', help='Name of per scaffold summary output file (not written if none specified).')
+    parser.add_argument('-q', '--quantile-output', type=str, default='', help='Name of fold change and coverage quantile summary output file (not written if none specified).')
+    parser.add_argument('-w', '--window-output', type=str, default='', help='Name of sliding window fold change profile output file (not written if none specified).')
+    parser.add_argument('-b', '--bootstrap-output', type=str, default='', help='Name of per scaffold bootstrap confidence interval output file of the pooled fold change (not written if none specified).')
+    parser.add_argument('--bootstrap-replicates', type=int, default=1000, help='Number of bootstrap replicates resampling the individuals (default=1000).')
+    parser.add_argument('--bootstrap-block-snps', type=int, default=0, help='Bootstrap blocks of this many SNPs along each scaffold instead of whole scaffolds, 0 for whole scaffolds (default=0).')
+    parser.add_argument('--bootstrap-ci', type=float, default=0.95, help='Confidence level of the bootstrap intervals (default=0.95).')
+    parser.add_argument('--permutation-output', type=str, default='', help='Name of file to write the empirical false discovery estimate from permuting the sex labels to (not written if none specified).')
+    parser.add_argument('--permutations', type=int, default=1000, help='Number of permutations of the sex labels (default=1000).')
+    parser.add_argument('--permutation-margins', type=str, default='', help='Comma separated fold change margins to estimate the false discoveries of (default=the --fold-change-margin).')
+    parser.add_argument('--seed', type=int, default=None, help='Seed of the bootstrap resampling and label permutations.')
+    parser.add_argument('--strata', type=str, default='', help='Populations filtered side by side in the same pass: a tab separated sheet of sample name and stratum, or comma separated sample name prefixes, each optionally named as name=prefix. The strata decide which records are written (and routed), the scaffold, quantile, window, bootstrap and permutation summaries stay those of the pooled samples.')
+    parser.add_argument('--strata-consensus', type=str, default='all', choices=['all', 'majority', 'any'], help='Strata a record has to pass in to be written when --strata is given (default=all).')
+    parser.add_argument('--route-output', type=str, default='', help='Prefix of the outputs every record is routed to by its classification: <prefix>_x_candidate.vcf, _male_het.vcf, _fold_change.vcf and _undetermined.vcf, with the low GQ calls masked as in the output vcf (not written if none specified).')
+    parser.add_argument('--route-compress-level', type=int, default=0, choices=range(10), help='gzip compression level of the routed outputs, 0 for uncompressed (default=0).')
+    parser.add_argument('--route-buffer-size', type=str, default='4M', help='Write buffer of every routed output, e.g. 16M (default=4M).')
+    parser.add_argument('--sample-depths', type=str, default='', help='Tab separated file of sample name and total read depth to normalise with instead of reading the input twice, e.g. from --write-sample-depths. Only the ratios between the samples matter to the fold change and filter, so read counts such as plot_coverage_from_BAM_summary.py --sample-depths-output can be used (the mean coverage columns are then in those units).')
+    parser.add_argument('--write-sample-depths', type=str, default='', help='Name of file to write the total read depth of every used sample to (not written if none specified).')
+    parser.add_argument('--diagnostics-output', type=str, default='', help='Name of file to write the counts of malformed GQ, DP and GT fields per sample to (not written if none specified, a summary is always logged).')
+    parser.add_argument('--verbose-fields', action='store_true', help='Log every malformed GQ, DP and GT field as it is seen.')
+    parser.add_argument('--window-sizes', type=str, default='100kb', help='Comma separated window sizes for the profile, in bp (e.g. 10kb, 1mb) or SNPs (e.g. 50snp); windows start every half window (default=100kb).')
 
     # parse command line arguments
     opts = parser.parse_args(sys.argv[1:])
@@ -32,61 +62,286 @@ if __name__ == '__main__':
     # initialise counters
     removed = 0
     total = 0
+    scaffold_summary = ScaffoldSummary() if opts.scaffold_output != '' else None
+    distribution_summary = DistributionSummary() if opts.quantile_output != '' else None
+    window_profile = WindowProfile() if opts.window_output != '' else None
+    window_sizes = parse_window_sizes(opts.window_sizes)
 
     # setup logging, this will log anything info level or above
     logging.basicConfig(filename=(opts.log_file if opts.log_file != '' else None), filemode='a', level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+    field_diagnostics.verbose = opts.verbose_fields
 
     logging.info('Start of filtering.')
 
-    total_sample_read_depth = total_read_dp_per_individual(opts.input, individual_start_col, opts.gq_threshold)
+    # streaming from stdin or to stdout is a single pass, there is nothing to seek back to for a checkpoint
+    streaming = opts.input == '-' or opts.output == '-'
+    if streaming and (opts.checkpoint_every > 0 or opts.resume):
+        logging.error('Checkpointing needs named input and output files, not stdin/stdout.')
+        sys.exit(-1)
+    if opts.route_output != '' and opts.route_compress_level > 0 and (opts.checkpoint_every > 0 or opts.resume):
+        logging.error('Checkpointing needs uncompressed routed outputs to truncate, leave out --route-compress-level.')
+        sys.exit(-1)
+    if opts.input == '-' and opts.sample_depths == '':
+        logging.error('Reading from stdin needs the sample depth totals from --sample-depths.')
+        sys.exit(-1)
+
+    # only the male and female columns of the selected samples are parsed, the rest are passed through untouched
+    if opts.input == '-':
+        headers = read_vcf_header_stream(sys.stdin.buffer)
+    else:
+        headers = read_vcf_header(opts.input)
+    individuals = headers[individual_start_col:]
+    male_cols, female_cols = find_genders(individuals, offset=individual_start_col, reverse=opts.reverse)
+    include_samples, exclude_samples = read_sample_list(opts.include_samples), read_sample_list(opts.exclude_samples)
+    male_cols = select_columns(individuals, individual_start_col, male_cols, include_samples, exclude_samples)
+    female_cols = select_columns(individuals, individual_start_col, female_cols, include_samples, exclude_samples)
+    used_cols = sorted(male_cols + female_cols)
+    last_col = max(used_cols) if used_cols else individual_start_col - 1
+    col_index = dict((col, i) for i, col in enumerate(used_cols))
+    logging.info('Using %d male and %d female samples of %d.' % (len(male_cols), len(female_cols), len(individuals)))
+
+    # male and female indexes into the used_cols of every stratum, strata without both sexes are not filtered
+    strata = []
+    for name, samples in (read_strata(opts.strata, individuals) if opts.strata != '' else []):
+        samples = set(samples)
+        stratum_males = [col_index[col] for col in male_cols if individuals[col - individual_start_col] in samples]
+        stratum_females = [col_index[col] for col in female_cols if individuals[col - individual_start_col] in samples]
+        if stratum_males and stratum_females:
+            strata.append((name, stratum_males, stratum_females))
+        logging.info('Stratum %s has %d male and %d female samples%s.' % (name, len(stratum_males), len(stratum_females),
+                                                                        '' if stratum_males and stratum_females else ', left out'))
+    if opts.strata != '' and not strata:
+        logging.error('No stratum of %s has both male and female samples.' % opts.strata)
+        sys.exit(-1)
+
+    set_kernel(opts.kernel)
+    max_memory = parse_memory_size(opts.max_memory) if opts.max_memory != '' else None
+
+    # a checkpoint is only valid for the same input and settings
+    checkpoint_file = opts.checkpoint_file if opts.checkpoint_file != '' else opts.output + '.checkpoint'
+    checkpoint_settings = {'input': vcf_signature(opts.input) if not streaming else None, 'used_cols': used_cols, 'male_cols': male_cols,
+                           'gq_threshold': opts.gq_threshold, 'fold_change_margin': opts.fold_change_margin,
+                           'scaffold_output': opts.scaffold_output, 'quantile_output': opts.quantile_output,
+                           'window_output': opts.window_output, 'sample_depths': opts.sample_depths,
+                           'bootstrap_output': opts.bootstrap_output, 'bootstrap_block_snps': opts.bootstrap_block_snps,
+                           'permutation_output': opts.permutation_output, 'permutations': opts.permutations,
+                           'permutation_margins': opts.permutation_margins, 'seed': opts.seed,
+                           'strata': [list(stratum) for stratum in strata], 'strata_consensus': opts.strata_consensus,
+                           'route_output': opts.route_output, 'male_het_alpha': opts.male_het_alpha}
+    checkpoint = read_checkpoint(checkpoint_file) if opts.resume else None
+    if opts.resume and checkpoint is None:
+        logging.warning('No checkpoint %s found, starting from the beginning.' % checkpoint_file)
+    if checkpoint is not None and checkpoint['settings'] != checkpoint_settings:
+        logging.error('Checkpoint %s was made with a different input or settings.' % checkpoint_file)
+        sys.exit(-1)
+
+    if checkpoint is not None:
+        total_sample_read_depth = dict((int(col), dp) for col, dp in checkpoint['total_sample_read_depth'].items())
+        removed, total = checkpoint['removed'], checkpoint['total']
+        if scaffold_summary is not None:
+            scaffold_summary.set_state(checkpoint['scaffold_summary'])
+        if distribution_summary is not None:
+            distribution_summary.set_state(checkpoint['distribution_summary'])
+        field_diagnostics.set_state(checkpoint['field_diagnostics'])
+        logging.info('Resuming from checkpoint %s after %d records.' % (checkpoint_file, total))
+    elif opts.sample_depths != '':
+        sample_depths = read_sample_depths(opts.sample_depths)
+        missing = [individuals[col - individual_start_col] for col in used_cols if individuals[col - individual_start_col] not in sample_depths]
+        if missing:
+            logging.error('No total read depth in %s for samples %s.' % (opts.sample_depths, ', '.join(missing)))
+            sys.exit(-1)
+        total_sample_read_depth = dict((col, sample_depths[individuals[col - individual_start_col]]) for col in used_cols)
+        logging.info('Read total read depths of %d samples from %s' % (len(used_cols), opts.sample_depths))
+    else:
+        total_sample_read_depth = total_depths_from_blocks(opts.input, individual_start_col, opts.gq_threshold, cols=used_cols, max_memory=max_memory)
+    totals = np.array([total_sample_read_depth[col] for col in used_cols])
+    if opts.bootstrap_output != '':
+        bootstrap = BootstrapFoldChange([col_index[col] for col in male_cols], [col_index[col] for col in female_cols],
+                                        [total_sample_read_depth[col] for col in used_cols], opts.bootstrap_block_snps)
+        if checkpoint is not None:
+            bootstrap.set_state(checkpoint['bootstrap'])
+    else:
+        bootstrap = None
+    if opts.permutation_output != '':
+        margins = [float(m) for m in opts.permutation_margins.split(',') if m != ''] or [opts.fold_change_margin]
+        permutation_null = PermutationNull([col_index[col] for col in male_cols], [col_index[col] for col in female_cols],
+                                           [total_sample_read_depth[col] for col in used_cols], margins, opts.permutations, opts.seed,
+                                           opts.male_het_alpha)
+        if checkpoint is not None:
+            permutation_null.set_state(checkpoint['permutation_null'])
+    else:
+        permutation_null = None
+    if opts.write_sample_depths != '':
+        write_sample_depths(opts.write_sample_depths, dict((individuals[col - individual_start_col], total_sample_read_depth[col]) for col in used_cols))
+        logging.info('Wrote total read depths of %d samples to %s' % (len(used_cols), opts.write_sample_depths))
     #print(total_sample_read_depth)
 
+    # the bootstrap sums alternate between two files, so the one the last checkpoint points to is
+    # never overwritten before the next checkpoint replaces it
+    bootstrap_sums_files = [checkpoint_file + '.bootstrap_sums.%d.npy' % i for i in range(2)]
+    if checkpoint is not None and checkpoint['bootstrap'] is not None and checkpoint['bootstrap'].get('sums_file') == bootstrap_sums_files[0]:
+        bootstrap_sums_files.reverse()
+
+    def save_checkpoint():
+        write_checkpoint(checkpoint_file, {
+            'settings': checkpoint_settings, 'input_offset': f.tell(),
+            'total_sample_read_depth': total_sample_read_depth, 'removed': removed, 'total': total,
+            'output_length': synced_length(fw), 'meta_output_length': synced_length(fm),
+            'scaffold_summary': scaffold_summary.get_state() if scaffold_summary is not None else None,
+            'distribution_summary': distribution_summary.get_state() if distribution_summary is not None else None,
+            'bootstrap': bootstrap.get_state(bootstrap_sums_files[0]) if bootstrap is not None else None,
+            'permutation_null': permutation_null.get_state() if permutation_null is not None else None,
+            'routed': routed.get_state() if routed is not None else None,
+            'routed_lengths': routed.lengths() if routed is not None else None,
+            'field_diagnostics': field_diagnostics.get_state()})
+        bootstrap_sums_files.reverse()
+
+    routed = None
+
     # open files for reading
     try:
-        f = open(opts.input, "r")
-        fw = open(opts.output, "w")
-        fm = open(opts.meta_output, "w")
+        f = sys.stdin.buffer if opts.input == '-' else open(opts.input, "rb")
+        if checkpoint is not None:
+            # drop anything written after the checkpoint and carry on from there
+            os.truncate(opts.output, checkpoint['output_length'])
+            os.truncate(opts.meta_output, checkpoint['meta_output_length'])
+            fw = open(opts.output, "a")
+            fm = open(opts.meta_output, "a")
+            if opts.route_output != '':
+                routed = RoutedOutputs(opts.route_output, buffer_size=parse_memory_size(opts.route_buffer_size), lengths=checkpoint['routed_lengths'])
+                routed.set_state(checkpoint['routed'])
+            f.seek(checkpoint['input_offset'])
+            if window_profile is not None:
+                # the profile holds a value per SNP so it is rebuilt from the meta data rather than checkpointed
+                window_profile.add_from_meta(opts.meta_output)
+        else:
+            fw = sys.stdout if opts.output == '-' else open(opts.output, "w")
+            fm = open(opts.meta_output, "w")
+            if opts.route_output != '':
+                routed = RoutedOutputs(opts.route_output, opts.route_compress_level, parse_memory_size(opts.route_buffer_size))
+                routed.writeheader(headers)
         logging.info('Opened input file %s' % opts.input)
         logging.info('Opened output file %s' % opts.output)
         logging.info('Opened output meta file %s' % opts.meta_output)
-        csv_reader = csv.reader(f, delimiter="\t")
         csv_writer = csv.writer(fw, delimiter="\t")
         csv_meta_writer = csv.writer(fm, delimiter="\t")
+        if checkpoint is None:
+            csv_writer.writerow(headers)
+            csv_meta_writer.writerow(META_HEADERS +
+                                     (['male_het_pvalue'] if opts.male_het_alpha > 0 else []) +
+                                     ['%s_%s' % (name, column) for name, stratum_males, stratum_females in strata for column in STRATUM_COLUMNS] +
+                                     (['consensus_passed'] if strata else []))
+            if opts.checkpoint_every > 0:
+                # keep the depth totals even if the run stops before the first block is done
+                f.seek(0)
+                for line in f:
+                    if line.startswith(b'#') and not line.startswith(b'##'):
+                        break
+                save_checkpoint()
+        last_checkpoint = total
         s = time.time()
-        for row in csv_reader:
-            if row[0].startswith("##"):
-                continue
-            if row[0].startswith("#"): # header column
-                headers = row
-                individuals = headers[individual_start_col:]
-                male_cols, female_cols = find_genders(individuals, offset=individual_start_col, reverse=opts.reverse)
-                csv_writer.writerow(row)
-                csv_meta_writer.writerow(["locus", "position", "is_male_heterozygote", "n_male_homozygote", "n_male_heterozygote",
-                                        "n_female_homozygote", "n_female_heterozygote", "n_gq_filtered", "male_mean_coverage",
-                                        "female_mean_coverage", "fold_change", "fold_change_in_range"])
-            else:
+        n_blocks = 0
+        for lines in iter_vcf_blocks(f, max_memory=max_memory, n_samples=len(used_cols)):
+            n_blocks += 1
+            results = filter_record_block(lines, male_cols, female_cols, used_cols, total_sample_read_depth,
+                                          opts.gq_threshold, opts.fold_change_margin, diagnostics=field_diagnostics,
+                                          male_het_alpha=opts.male_het_alpha)
+            block_loci, block_positions = [], []
+            if strata:
+                stratum_results = [filter_results(results['gt'], results['dp'], results['gq_pass'], stratum_males, stratum_females,
+                                                  totals, opts.fold_change_margin, results['gq'], opts.male_het_alpha)
+                                   for name, stratum_males, stratum_females in strata]
+                consensus = consensus_passed(np.column_stack([r['passed'] for r in stratum_results]), opts.strata_consensus)
+            if routed is not None:
+                routes = route_records(results, consensus if strata else None)
+            for i, line in enumerate(lines):
                 total += 1
-                gq_filtered = filter_by_gq(row, opts.gq_threshold, offset=individual_start_col)  # filter individuals where gq is less than given threshold
-                n_hm_male, n_ht_male, n_hm_female, n_ht_female = count_zygote_gt_type(row, female_cols, male_cols)
-                is_male_heterozygote = at_least_one_heterozygote(row, male_cols)
-                male_mean_coverage, female_mean_coverage, fold_change = calc_coverage_and_fold_change(row, male_cols, female_cols, total_sample_read_depth, normalise=True)
-                if fold_change is None:
-                    fold_change_in_range = None
-                else:
-                    if (2.0 - opts.fold_change_margin) < fold_change < (2.0 + opts.fold_change_margin):
-                        fold_change_in_range = True
-                    else:
-                        fold_change_in_range = False
-                if not is_male_heterozygote and fold_change_in_range:
-                    csv_writer.writerow(row)
+                locus, position = line.split(b'\t', 2)[:2]
+                locus, position = locus.decode(), position.decode()
+                is_male_heterozygote = bool(results['is_male_heterozygote'][i])
+                if results['coverage_defined']:
+                    male_mean_coverage = results['male_mean_coverage'][i]
+                    female_mean_coverage = results['female_mean_coverage'][i]
+                    fold_change = results['fold_change'][i]
+                    fold_change_in_range = bool(results['fold_change_in_range'][i])
                 else:
+                    male_mean_coverage, female_mean_coverage, fold_change, fold_change_in_range = None, None, None, None
+                # the summaries are of the pooled samples, the strata only decide which records are written
+                pooled_passed = not is_male_heterozygote and fold_change_in_range
+                passed = bool(consensus[i]) if strata else pooled_passed
+                if passed or routed is not None:
+                    # write the record with the low GQ calls of the parsed columns masked, the same for every route
+                    row = split_projected(line.decode(), last_col)
+                    filter_by_gq(row, opts.gq_threshold, offset=individual_start_col, cols=used_cols, diagnostics=None)
+                    row = unsplit_projected(row, last_col)
+                    if passed:
+                        csv_writer.writerow(row)
+                    if routed is not None:
+                        routed.writerow(routes[i], row)
+                if not passed:
                     removed += 1
-                csv_meta_writer.writerow([row[0], row[1], is_male_heterozygote, n_hm_male, n_ht_male, n_hm_female, n_ht_female, gq_filtered,
-                                        male_mean_coverage, female_mean_coverage, fold_change, fold_change_in_range])
+                if scaffold_summary is not None:
+                    scaffold_summary.add(locus, is_male_heterozygote, male_mean_coverage, female_mean_coverage,
+                                         fold_change, fold_change_in_range, pooled_passed)
+                if distribution_summary is not None:
+                    distribution_summary.add(male_mean_coverage, female_mean_coverage, fold_change, fold_change_in_range)
+                if window_profile is not None:
+                    window_profile.add(locus, position, male_mean_coverage, female_mean_coverage)
+                block_loci.append(locus)
+                block_positions.append(position)
+                csv_meta_writer.writerow([locus, position, is_male_heterozygote, results['n_male_homozygote'][i],
+                                          results['n_male_heterozygote'][i], results['n_female_homozygote'][i],
+                                          results['n_female_heterozygote'][i], results['n_gq_filtered'][i],
+                                          male_mean_coverage, female_mean_coverage, fold_change, fold_change_in_range] +
+                                         ([results['male_het_pvalue'][i]] if opts.male_het_alpha > 0 else []) +
+                                         ([value for r in stratum_results for value in stratum_meta_values(r, i)] + [passed] if strata else []))
+            if bootstrap is not None:
+                # the SNPs with a fold change, as pooled in the scaffold summary
+                finite = np.flatnonzero(np.isfinite(results['fold_change']))
+                bootstrap.add([block_loci[i] for i in finite], [block_positions[i] for i in finite], results['dp'][finite])
+            if permutation_null is not None:
+                permutation_null.add(results['gt'], results['dp'], results['gq'])
+            if opts.checkpoint_every > 0 and total - last_checkpoint >= opts.checkpoint_every:
+                save_checkpoint()
+                last_checkpoint = total
         e = time.time()
-        logging.info('Filtered %d/%d records leaving %d in %.2f seconds.' % (removed, total, total - removed, e-s))
-        f.close()
-        fw.close()
+        logging.info('Filtered %d/%d records leaving %d in %.2f seconds (%d blocks).' % (removed, total, total - removed, e-s, n_blocks))
+        if f is not sys.stdin.buffer:
+            f.close()
+        if fw is sys.stdout:
+            fw.flush()
+        else:
+            fw.close()
         fm.close()
+        if routed is not None:
+            routed.close()
+            logging.info('Routed %s records to %s_*' % (', '.join('%d %s' % (n, route) for route, n in zip(ROUTES, routed.counts)), opts.route_output))
+        if scaffold_summary is not None:
+            scaffold_summary.write(opts.scaffold_output)
+            logging.info('Wrote summary of %d scaffolds to %s' % (len(scaffold_summary.contigs), opts.scaffold_output))
+        if distribution_summary is not None:
+            distribution_summary.write(opts.quantile_output)
+            logging.info('Wrote quantile summary to %s' % opts.quantile_output)
+        if window_profile is not None:
+            window_profile.write(opts.window_output, window_sizes)
+            logging.info('Wrote fold change profile of %d window sizes to %s' % (len(window_sizes), opts.window_output))
+        field_diagnostics.log_summary()
+        if opts.diagnostics_output != '':
+            field_diagnostics.write(opts.diagnostics_output, headers)
+            logging.info('Wrote %d malformed field counts to %s' % (len(field_diagnostics.counts), opts.diagnostics_output))
+        if bootstrap is not None:
+            s = time.time()
+            bootstrap.write(opts.bootstrap_output, opts.bootstrap_replicates, opts.seed, opts.bootstrap_ci)
+            e = time.time()
+            logging.info('Wrote bootstrap intervals of %d units from %d replicates to %s in %.2f seconds.' % (len(bootstrap.units), opts.bootstrap_replicates, opts.bootstrap_output, e-s))
+        if permutation_null is not None:
+            permutation_null.write(opts.permutation_output)
+            for margin, n_passed, n_permutations, mean_permuted, q95, fdr in permutation_null.rows():
+                logging.info('Fold change margin %s: %d passed, %.1f on average with permuted labels (empirical FDR %s).' % (margin, n_passed, mean_permuted, fdr))
+        if not streaming:
+            for filename in [checkpoint_file] + bootstrap_sums_files:
+                if os.path.exists(filename):
+                    os.remove(filename)
+        logging.info('Peak memory use %.1f MB.' % (peak_rss() / 1024.0**2))
     except IOError as ioerror:
         logging.error('Problem opening files: ' + str(ioerror))
@@ -10,13 +10,118 @@ import time
 import csv
 import sys
 import os
-from optparse import OptionParser
+import math
+import json
+import itertools
+import gzip
+import io
+from array import array
 from collections import defaultdict
 #from utils import utils_logging
 from scipy import stats
-import argparse # package to help with argument parsing
+from X_kernels import GT_HOM_REF, GT_HET, GT_HOM_ALT, GT_MISSING, GT_MALFORMED, GQ_MISSING, DP_MALFORMED, MALFORMED_GT, gt_code, parse_block, mask_by_gq
 
 
+# approximate bytes held per sample cell while a block is processed (parsed, masked and normalised arrays)
+BLOCK_BYTES_PER_CELL = 48
+MIN_BLOCK_RECORDS, MAX_BLOCK_RECORDS = 16, 100000
+
+# columns of the per record meta data written by every filter script, which may add columns after them
+META_HEADERS = ["locus", "position", "is_male_heterozygote", "n_male_homozygote", "n_male_heterozygote",
+                "n_female_homozygote", "n_female_heterozygote", "n_gq_filtered", "male_mean_coverage",
+                "female_mean_coverage", "fold_change", "fold_change_in_range"]
+
+
+class FieldDiagnostics(object):
+    """
+    Counts of malformed GQ, DP and GT fields per vcf column and reason, with the first few cells
+    of every reason as examples, written as one table at the end instead of logging every cell.
+    With verbose every cell is logged as well.
+    """
+    headers = ["field", "reason", "column", "sample", "count", "examples"]
+
+    def __init__(self, n_examples=3, verbose=False):
+        self.n_examples = n_examples
+        self.verbose = verbose
+        self.counts = {}
+        self.examples = {}
+
+    def add(self, field, reason, col, cell):
+        key = (field, reason, col)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        examples = self.examples.setdefault((field, reason), [])
+        if len(examples) < self.n_examples:
+            examples.append(cell)
+        if self.verbose:
+            logging.warning('%s value %s in column %s: %s.', field, reason, col, cell)
+
+    def add_counts(self, field, reason, cols, counts):
+        # counts of a block of records, e.g. np.sum(gq == GQ_MISSING, axis=0) over the cols
+        for col, n in zip(cols, counts):
+            if n:
+                key = (field, reason, col)
+                self.counts[key] = self.counts.get(key, 0) + int(n)
+
+    def add_block(self, lines, cols, gt, gq, dp, gq_threshold):
+        """
+        Count the malformed fields of a block parsed by parse_block like the row helpers do: every GQ
+        that is not an integer, and the DP and GT of the calls passing the GQ threshold. The cells are
+        only looked up in the record lines for the examples, or every one of them with verbose.
+        """
+        gq_pass = gq >= gq_threshold
+        for field, reason, malformed in [('GQ', 'not_integer', gq == GQ_MISSING),
+                                         ('DP', 'not_integer', gq_pass & (dp == DP_MALFORMED)),
+                                         ('GT', 'malformed', gq_pass & (gt == GT_MALFORMED))]:
+            if not malformed.any():
+                continue
+            if self.verbose:
+                for r, i in np.argwhere(malformed):
+                    self.add(field, reason, cols[i], record_cell(lines[r], cols[i]))
+                continue
+            examples = self.examples.setdefault((field, reason), [])
+            for r, i in np.argwhere(malformed)[:max(self.n_examples - len(examples), 0)]:
+                examples.append(record_cell(lines[r], cols[i]))
+            self.add_counts(field, reason, cols, malformed.sum(axis=0))
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def get_state(self):
+        return {'counts': [list(key) + [n] for key, n in self.counts.items()],
+                'examples': [list(key) + [examples] for key, examples in self.examples.items()]}
+
+    def set_state(self, state):
+        self.counts = dict(((field, reason, col), n) for field, reason, col, n in state['counts'])
+        self.examples = dict(((field, reason), list(examples)) for field, reason, examples in state['examples'])
+
+    def rows(self, headers=None):
+        for field, reason, col in sorted(self.counts, key=lambda key: (key[0], key[1], -1 if key[2] is None else key[2])):
+            sample = headers[col] if headers is not None and col is not None and col < len(headers) else ''
+            yield [field, reason, col, sample, self.counts[(field, reason, col)], ' '.join(self.examples.get((field, reason), []))]
+
+    def log_summary(self):
+        by_reason = {}
+        for (field, reason, col), n in self.counts.items():
+            n_total, cols = by_reason.setdefault((field, reason), [0, set()])
+            by_reason[(field, reason)][0] = n_total + n
+            cols.add(col)
+        for (field, reason), (n, cols) in sorted(by_reason.items()):
+            logging.warning('%d %s fields %s in %d columns, e.g. %s.' % (n, field, reason, len(cols), ', '.join(self.examples.get((field, reason), [])) or 'not kept'))
+
+    def write(self, filename, headers=None):
+        with open(filename, 'w') as f:
+            csv_writer = csv.writer(f, delimiter="\t")
+            csv_writer.writerow(self.headers)
+            csv_writer.writerows(self.rows(headers))
+
+# shared by the row helpers, scripts set verbose and write it out at the end
+field_diagnostics = FieldDiagnostics()
+
+def record_cell(line, col):
+    # text of column col of a record line (bytes), empty for a short record
+    row = line.rstrip(b'\r\n').split(b'\t', col + 1)
+    return row[col].decode('ascii', 'replace') if col < len(row) else ''
+
 
 # define useful functions
 def find_genders(x, offset, reverse=False):
@@ -33,59 +138,62 @@ def find_genders(x, offset, reverse=False):
         return males, females
 
 def is_heterozygote(snp_info):
-    first_part = snp_info[:snp_info.find(':')]
-    if first_part == '0/1':
+    # True/False for a het/hom call, None when the call is missing (see X_kernels.interned_gt)
+    code = gt_code(snp_info[:snp_info.find(':')])
+    if code == GT_HET:
         return True
-    elif first_part == '0/0' or first_part == '1/1':
-        return False
-    else:
+    elif code == GT_MISSING:
         return None
+    else:
+        return False
+
+def genotype_code(snp_info):
+    # same classification as is_heterozygote but keeping hom-ref and hom-alt apart
+    return gt_code(snp_info[:snp_info.find(':')])
 
 def at_least_one_heterozygote(row, cols):
     for col in cols:
-        if is_heterozygote(row[col]):
+        if gt_code(row[col][:row[col].find(':')]) == GT_HET:
             return True
     return False
 
-def is_gq_greater_than(snp_info, gq_threshold):
+def is_gq_greater_than(snp_info, gq_threshold, col=None, diagnostics=field_diagnostics):
     parts = snp_info.split(':')
     try:
         gq_value = int(parts[-1]) # we expect GQ to be the last field
     except Exception as exception:
-        logging.debug('GQ value not integer valued: %s of %s.' % (parts[-1], snp_info))
+        if diagnostics is not None:
+            diagnostics.add('GQ', 'not_integer', col, snp_info)
         return False
     return gq_value >= gq_threshold
 
-def count_zygote_gt_type(row, male_cols, female_cols):
+def count_zygote_gt_type(row, male_cols, female_cols, diagnostics=field_diagnostics):
     """
     Count the number of male, female, homozygote and heterozygote genotypes.
     """
-    n_hm_male, n_ht_male, n_hm_female, n_ht_female = 0, 0, 0, 0
-    for i in male_cols:
-        is_ht = is_heterozygote(row[i])
-        if is_ht:
-            n_ht_male += 1
-        elif is_ht == False:
-            n_hm_male += 1
-
-    for i in female_cols:
-        is_ht = is_heterozygote(row[i])
-        if is_ht:
-            n_ht_female += 1
-        elif is_ht == False:
-            n_hm_female += 1
-
+    n = []
+    for cols in [male_cols, female_cols]:
+        counts = [0, 0, 0, 0] # indexed by genotype code, the missing calls are not used
+        for i in cols:
+            gt = row[i][:row[i].find(':')]
+            code = gt_code(gt)
+            counts[code] += 1
+            if code == GT_MISSING and gt in MALFORMED_GT and diagnostics is not None:
+                diagnostics.add('GT', 'malformed', i, row[i])
+        n += [counts[GT_HOM_REF] + counts[GT_HOM_ALT], counts[GT_HET]]
+    n_hm_male, n_ht_male, n_hm_female, n_ht_female = n
     return n_hm_male, n_ht_male, n_hm_female, n_ht_female
 
-def filter_by_gq(row, gq_threshold, offset, empty_str='.'):
+def filter_by_gq(row, gq_threshold, offset, empty_str='.', cols=None, diagnostics=field_diagnostics):
+    # only the given cols are checked when projecting, otherwise everything from offset
     n = 0
-    for i in range(offset, len(row)):
-        if not is_gq_greater_than(row[i], gq_threshold):
+    for i in (range(offset, len(row)) if cols is None else cols):
+        if not is_gq_greater_than(row[i], gq_threshold, i, diagnostics):
             n += 1
             row[i] = empty_str
     return n
 
-def dp_values(row, cols, dp_idx=2):
+def dp_values(row, cols, dp_idx=2, diagnostics=field_diagnostics):
     # get a list of the dp values for the given rows
     dp_values = []
     for col in cols:
@@ -95,39 +203,200 @@ def dp_values(row, cols, dp_idx=2):
                 dp_value = int(parts[dp_idx])
                 dp_values.append(dp_value)
             except Exception as ex:
-                logging.warning('DP value not an integer %s.' % parts[dp_idx])
+                if diagnostics is not None:
+                    diagnostics.add('DP', 'not_integer', col, row[col])
         else: dp_values.append(0)
     return dp_values
 
-def total_read_dp_per_individual(input_file, individual_start_col, gq_threshold):
+def read_vcf_header(input_file):
+    # the #CHROM header row of a vcf file
+    with open(input_file, "r") as f:
+        for line in f:
+            if line.startswith("#") and not line.startswith("##"):
+                return line.rstrip('\r\n').split('\t')
+    return None
+
+def read_vcf_header_stream(f):
+    """
+    The #CHROM header row of a vcf stream opened in binary mode (e.g. stdin), read up to and
+    including that row so the records can be read from f next.
+    """
+    for line in f:
+        if line.startswith(b'#') and not line.startswith(b'##'):
+            return line.decode().rstrip('\r\n').split('\t')
+    return None
+
+def read_sample_depths(depths_file):
+    """
+    Total read depth of every sample from a tab separated file of sample name and total,
+    as written by write_sample_depths. Lines starting with # are skipped.
+    """
+    depths = {}
+    with open(depths_file) as f:
+        for line in f:
+            if line.startswith('#') or line.strip() == '':
+                continue
+            sample, total = line.rstrip('\r\n').split('\t')[:2]
+            depths[sample] = float(total) if '.' in total or 'e' in total.lower() else int(total)
+    return depths
+
+def write_sample_depths(depths_file, depths):
+    # depths maps sample name to total read depth
+    with open(depths_file, 'w') as f:
+        f.write('#sample\ttotal_read_depth\n')
+        for sample, total in depths.items():
+            f.write('%s\t%s\n' % (sample, total))
+
+def vcf_signature(input_file):
+    # identifies the version of a vcf file that a cache or checkpoint was made from
+    stat = os.stat(input_file)
+    return {'source': os.path.abspath(input_file), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+def write_checkpoint(checkpoint_file, checkpoint):
+    # write to a temporary file first so a crash while writing never leaves a broken checkpoint
+    with open(checkpoint_file + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+def write_checkpoint_array(filename, values):
+    # arrays too large for the json checkpoint go in a .npy file next to it, written the same way
+    with open(filename + '.tmp', 'wb') as f:
+        np.save(f, values)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(filename + '.tmp', filename)
+
+def read_checkpoint(checkpoint_file):
+    if not os.path.exists(checkpoint_file):
+        return None
+    with open(checkpoint_file) as f:
+        return json.load(f)
+
+def synced_length(f):
+    # flush an output file to disk and return its length
+    f.flush()
+    os.fsync(f.fileno())
+    return os.fstat(f.fileno()).st_size
+
+def read_sample_list(spec):
+    """
+    Sample names from a comma separated list, or from a file with one name per line.
+    """
+    if spec == '':
+        return []
+    if os.path.isfile(spec):
+        with open(spec) as f:
+            return [line.strip() for line in f if line.strip() != '']
+    return [name for name in spec.split(',') if name != '']
+
+def read_strata(spec, individuals):
+    """
+    Strata of the samples as a list of (name, sample names), from a tab separated sample sheet of
+    sample name and stratum, or from comma separated sample name prefixes, each optionally named
+    as name=prefix. A sample is put in the first stratum whose prefix it starts with.
+    """
+    strata = []
+    if os.path.isfile(spec):
+        stratum_of = {}
+        with open(spec) as f:
+            for line in f:
+                if line.startswith('#') or line.strip() == '':
+                    continue
+                sample, stratum = line.rstrip('\r\n').split('\t')[:2]
+                stratum_of[sample] = stratum
+        for stratum in sorted(set(stratum_of.values()), key=list(stratum_of.values()).index):
+            strata.append((stratum, [ind for ind in individuals if stratum_of.get(ind) == stratum]))
+        return strata
+    rules = [rule.split('=', 1) if '=' in rule else [rule, rule] for rule in spec.split(',') if rule != '']
+    assigned = set()
+    for name, prefix in rules:
+        samples = [ind for ind in individuals if ind.startswith(prefix) and ind not in assigned]
+        assigned.update(samples)
+        strata.append((name, samples))
+    return strata
+
+# meta data columns of every stratum, prefixed with its name
+STRATUM_COLUMNS = ["n_male_heterozygote", "male_mean_coverage", "female_mean_coverage", "fold_change",
+                   "fold_change_in_range", "passed"]
+
+def stratum_meta_values(results, i):
+    # STRATUM_COLUMNS of SNP i from the filter_results of a stratum, None where the coverage is undefined
+    if not results['coverage_defined']:
+        return [results['n_male_heterozygote'][i], None, None, None, None, False]
+    return [results['n_male_heterozygote'][i], results['male_mean_coverage'][i], results['female_mean_coverage'][i],
+            results['fold_change'][i], bool(results['fold_change_in_range'][i]), bool(results['passed'][i])]
+
+def consensus_passed(stratum_passed, rule='all'):
+    """
+    Consensus of a (snps x strata) boolean array of stratum decisions: passed in all strata,
+    in more than half of them or in any.
+    """
+    stratum_passed = np.asarray(stratum_passed, bool)
+    n_strata, votes = stratum_passed.shape[1], stratum_passed.sum(axis=1)
+    if n_strata == 0:
+        return np.zeros(len(stratum_passed), bool)
+    if rule == 'all':
+        return votes == n_strata
+    if rule == 'majority':
+        return 2*votes > n_strata
+    if rule == 'any':
+        return votes > 0
+    raise ValueError('Unknown consensus rule %s, expected all, majority or any.' % rule)
+
+def select_columns(individuals, offset, cols, include_samples=None, exclude_samples=None):
+    # keep the cols whose sample is included (when an include list is given) and not excluded
+    include_samples = set(include_samples) if include_samples else None
+    exclude_samples = set(exclude_samples or [])
+    return [col for col in cols if (include_samples is None or individuals[col - offset] in include_samples)
+            and individuals[col - offset] not in exclude_samples]
+
+def split_projected(line, last_col):
+    """
+    Split a vcf line only up to last_col, the remaining columns are kept as one unsplit string.
+    """
+    return line.rstrip('\r\n').split('\t', last_col + 1)
+
+def unsplit_projected(row, last_col):
+    # split the unparsed remainder again, e.g. before writing the row out
+    if len(row) > last_col + 1:
+        return row[:last_col + 1] + row[last_col + 1].split('\t')
+    return row
+
+def total_read_dp_per_individual(input_file, individual_start_col, gq_threshold, cols=None):
     f = open(input_file, "r")
     logging.info('Opened input file %s' % input_file)
-    csv_reader = csv.reader(f, delimiter="\t")
     s = time.time()
     all_samples_total_coverages={}
-    for row in csv_reader:
-        if row[0].startswith("##"):
+    for line in f:
+        if line.startswith("##"):
             continue
-        if row[0].startswith("#"): # header column
-            headers = row
-            individuals = headers[individual_start_col:]
-            for i, individual in enumerate(individuals):
-                all_samples_total_coverages[i + individual_start_col]=0
+        if line.startswith("#"): # header column
+            headers = line.rstrip('\r\n').split('\t')
+            if cols is None:
+                cols = list(range(individual_start_col, len(headers)))
+            last_col = max(cols) if cols else individual_start_col - 1
+            for col_idx in cols:
+                all_samples_total_coverages[col_idx]=0
         else:
-            gq_filtered = filter_by_gq(row, gq_threshold, offset=individual_start_col)
-            for col_idx in range(individual_start_col, len(row)):
-                individual_dp = dp_values(row, [col_idx])[0]
-                all_samples_total_coverages[col_idx] += individual_dp
+            row = split_projected(line, last_col)
+            # not counted in the field diagnostics, the filter pass sees the same cells
+            gq_filtered = filter_by_gq(row, gq_threshold, offset=individual_start_col, cols=cols, diagnostics=None)
+            for col_idx in cols:
+                individual_dp = dp_values(row, [col_idx], diagnostics=None)
+                all_samples_total_coverages[col_idx] += individual_dp[0] if individual_dp else 0
+    f.close()
     return all_samples_total_coverages
 
 def calc_coverage_and_fold_change(row, male_cols, female_cols, total_sample_read_depth, normalise=True):
-    male_dps = np.array(dp_values(row, male_cols), np.float)                 
-    female_dps = np.array(dp_values(row, female_cols), np.float)
+    male_dps = np.array(dp_values(row, male_cols), float)                 
+    female_dps = np.array(dp_values(row, female_cols), float)
     male_dp_total = np.array(list(map(lambda x: total_sample_read_depth[x], male_cols)))
     female_dp_total = np.array(list(map(lambda x: total_sample_read_depth[x], female_cols)))
     if np.any(male_dp_total == 0) or np.any(female_dp_total == 0):
         logging.error('Total coverage depth is 0.')
-        return None, None, None
+        return None, None, None, None, None, None
     
     # normalise the depths
     if normalise: 
@@ -141,42 +410,1085 @@ def calc_coverage_and_fold_change(row, male_cols, female_cols, total_sample_read
     pvalue_eq_divided_2 = pvalue_eq/2
     return male_mean_coverage, female_mean_coverage, fold_change, t_stat_eq, pvalue_eq, pvalue_eq_divided_2
 
+class ScaffoldSummary(object):
+    """
+    Running per contig aggregates of the X linkage evidence, updated one SNP at a time.
+    Only a handful of numbers are kept per contig and the fold change mean/variance use Welford's method.
+    """
+    headers = ["locus", "n_snps", "n_male_heterozygote", "n_passed", "n_fold_change", "fold_change_mean",
+               "fold_change_var", "male_mean_coverage", "female_mean_coverage", "pooled_fold_change",
+               "fraction_in_range"]
+
+    def __init__(self):
+        self.contigs = {}
+
+    def add(self, locus, is_male_heterozygote, male_mean_coverage, female_mean_coverage, fold_change, fold_change_in_range, passed):
+        if locus not in self.contigs:
+            # n_snps, n_male_het, n_passed, n_fold_change, mean, m2, male_sum, female_sum, n_in_range
+            self.contigs[locus] = [0, 0, 0, 0, 0.0, 0.0, 0.0, 0.0, 0]
+        c = self.contigs[locus]
+        c[0] += 1
+        if is_male_heterozygote:
+            c[1] += 1
+        if passed:
+            c[2] += 1
+        if fold_change is None or not np.isfinite(fold_change):
+            return
+        c[3] += 1
+        delta = fold_change - c[4]
+        c[4] += delta/c[3]
+        c[5] += delta*(fold_change - c[4])
+        c[6] += male_mean_coverage
+        c[7] += female_mean_coverage
+        if fold_change_in_range:
+            c[8] += 1
+
+    def get_state(self):
+        return {'contigs': self.contigs}
+
+    def set_state(self, state):
+        self.contigs = dict(state['contigs'])
+
+    def rows(self):
+        for locus, c in self.contigs.items():
+            n_snps, n_male_het, n_passed, n, mean, m2, male_sum, female_sum, n_in_range = c
+            if n == 0:
+                yield [locus, n_snps, n_male_het, n_passed, 0, None, None, None, None, None, None]
+                continue
+            pooled_fold_change = female_sum/male_sum if male_sum > 0 else None
+            yield [locus, n_snps, n_male_het, n_passed, n, mean, (m2/(n - 1) if n > 1 else None),
+                   male_sum/n, female_sum/n, pooled_fold_change, n_in_range/float(n)]
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            csv_writer = csv.writer(f, delimiter="\t")
+            csv_writer.writerow(self.headers)
+            csv_writer.writerows(self.rows())
+
+class QuantileSketch(object):
+    """
+    Mergeable streaming quantile sketch of non-negative values (DDSketch).
+    Values are counted in logarithmic buckets so every quantile is returned within relative_accuracy
+    of a true value of that rank. When more than max_bins buckets are in use the lowest ones are
+    collapsed, which only affects the accuracy of the lowest quantiles.
+    """
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1.0 + relative_accuracy)/(1.0 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.bins = defaultdict(int)
+        self.zero_count = 0
+        self.count = 0
+        self.n_not_finite = 0
+        self.min, self.max = None, None
+
+    def add(self, value):
+        if value is None or not math.isfinite(value):
+            self.n_not_finite += 1
+            return
+        if value < 0:
+            raise ValueError('Quantile sketch only takes non-negative values, got %s.' % value)
+        self.count += 1
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if value == 0:
+            self.zero_count += 1
+        else:
+            self.bins[int(math.ceil(math.log(value)/self.log_gamma))] += 1
+            if len(self.bins) > self.max_bins:
+                self._collapse()
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError('Cannot merge quantile sketches with different accuracies.')
+        for key, n in other.bins.items():
+            self.bins[key] += n
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.n_not_finite += other.n_not_finite
+        for value in [other.min, other.max]:
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+        while len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def get_state(self):
+        return {'bins': dict((str(key), n) for key, n in self.bins.items()), 'zero_count': self.zero_count,
+                'count': self.count, 'n_not_finite': self.n_not_finite, 'min': self.min, 'max': self.max}
+
+    def set_state(self, state):
+        self.bins = defaultdict(int, ((int(key), n) for key, n in state['bins'].items()))
+        self.zero_count, self.count, self.n_not_finite = state['zero_count'], state['count'], state['n_not_finite']
+        self.min, self.max = state['min'], state['max']
+
+    def _collapse(self):
+        # fold the lowest bucket into the next one up
+        keys = sorted(self.bins)
+        self.bins[keys[1]] += self.bins.pop(keys[0])
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q*(self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+        seen = self.zero_count
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                value = 2.0*self.gamma**key/(self.gamma + 1.0)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+
+class DistributionSummary(object):
+    """
+    Quantile sketches of the fold change and mean male/female coverage for all SNPs and for
+    the SNPs inside (filtered) and outside (excluded) the fold change range, as in the plots.
+    """
+    groups = ['all', 'filtered', 'excluded']
+    variables = ['fold_change', 'male_coverage', 'female_coverage']
+    quantiles = [0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99]
+
+    def __init__(self, relative_accuracy=0.01):
+        self.sketches = dict(((group, variable), QuantileSketch(relative_accuracy))
+                             for group in self.groups for variable in self.variables)
+
+    def add(self, male_mean_coverage, female_mean_coverage, fold_change, fold_change_in_range):
+        if fold_change is None:
+            return
+        for group in ['all', 'filtered' if fold_change_in_range else 'excluded']:
+            self.sketches[(group, 'fold_change')].add(fold_change)
+            self.sketches[(group, 'male_coverage')].add(male_mean_coverage)
+            self.sketches[(group, 'female_coverage')].add(female_mean_coverage)
+
+    def merge(self, other):
+        for key, sketch in other.sketches.items():
+            self.sketches[key].merge(sketch)
+
+    def get_state(self):
+        return dict(('%s:%s' % key, sketch.get_state()) for key, sketch in self.sketches.items())
+
+    def set_state(self, state):
+        for key, sketch in self.sketches.items():
+            sketch.set_state(state['%s:%s' % key])
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            csv_writer = csv.writer(f, delimiter="\t")
+            csv_writer.writerow(['group', 'variable', 'count', 'n_not_finite', 'min'] +
+                                ['q%g' % (q*100) for q in self.quantiles] + ['max'])
+            for group in self.groups:
+                for variable in self.variables:
+                    sketch = self.sketches[(group, variable)]
+                    csv_writer.writerow([group, variable, sketch.count, sketch.n_not_finite, sketch.min] +
+                                        [sketch.quantile(q) for q in self.quantiles] + [sketch.max])
+
+def parse_window_sizes(spec):
+    """
+    Window sizes such as 10kb,1mb,5000 (base pairs) or 50snp (number of SNPs) as (size, unit) pairs.
+    """
+    units = [('snps', 'snp', 1), ('snp', 'snp', 1), ('kb', 'bp', 1000), ('mb', 'bp', 1000**2), ('bp', 'bp', 1)]
+    window_sizes = []
+    for size in spec.split(','):
+        size = size.strip().lower()
+        if size == '':
+            continue
+        unit, scale = 'bp', 1
+        for suffix, suffix_unit, suffix_scale in units:
+            if size.endswith(suffix):
+                size, unit, scale = size[:-len(suffix)], suffix_unit, suffix_scale
+                break
+        size = int(float(size) * scale)
+        if size <= 0:
+            raise ValueError('Window sizes have to be positive, got %s.' % spec)
+        window_sizes.append((size, unit))
+    return window_sizes
+
+
+class WindowProfile(object):
+    """
+    Fold change profiles along every contig over sliding windows of several sizes.
+    Per contig the SNP positions and cumulative sums of the mean normalised male and female depth are
+    kept, so the depth of any window is the difference of two cumulative sums. Windows of size bp or
+    snp SNPs start every half window, with a last SNP window ending at the last SNP of the contig.
+    """
+    headers = ["locus", "window_unit", "window_size", "start", "end", "n_snps", "male_mean_coverage",
+               "female_mean_coverage", "fold_change"]
+
+    def __init__(self):
+        # contig -> positions, cumulative male depth, cumulative female depth
+        self.contigs = {}
+
+    def add(self, locus, position, male_mean_coverage, female_mean_coverage):
+        if male_mean_coverage is None or female_mean_coverage is None or \
+                not (np.isfinite(male_mean_coverage) and np.isfinite(female_mean_coverage)):
+            return
+        if locus not in self.contigs:
+            self.contigs[locus] = (array('q'), array('d', [0.0]), array('d', [0.0]))
+        positions, male_sums, female_sums = self.contigs[locus]
+        positions.append(int(position))
+        male_sums.append(male_sums[-1] + male_mean_coverage)
+        female_sums.append(female_sums[-1] + female_mean_coverage)
+
+    def add_arrays(self, loci, positions, male_mean_coverage, female_mean_coverage):
+        # same as add for every element, contig by contig
+        loci = np.asarray(loci)
+        positions = np.asarray(positions, np.int64)
+        male_mean_coverage, female_mean_coverage = np.asarray(male_mean_coverage, float), np.asarray(female_mean_coverage, float)
+        defined = np.isfinite(male_mean_coverage) & np.isfinite(female_mean_coverage)
+        names, first, inverse = np.unique(loci, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.searchsorted(inverse[order], np.arange(len(names) + 1))
+        for k in np.argsort(first):
+            idx = order[bounds[k]:bounds[k + 1]]
+            idx = idx[defined[idx]]
+            if len(idx) == 0:
+                continue
+            locus = str(names[k])
+            if locus not in self.contigs:
+                self.contigs[locus] = (array('q'), array('d', [0.0]), array('d', [0.0]))
+            contig_positions, male_sums, female_sums = self.contigs[locus]
+            contig_positions.extend(positions[idx].tolist())
+            male_sums.extend((male_sums[-1] + np.cumsum(male_mean_coverage[idx])).tolist())
+            female_sums.extend((female_sums[-1] + np.cumsum(female_mean_coverage[idx])).tolist())
+
+    def add_from_meta(self, meta_file):
+        # rebuild the profile from a meta data file, e.g. when resuming from a checkpoint
+        with open(meta_file) as f:
+            csv_reader = csv.reader(f, delimiter="\t")
+            next(csv_reader, None)
+            for row in csv_reader:
+                if row[8] != '' and row[9] != '':
+                    self.add(row[0], row[1], float(row[8]), float(row[9]))
+
+    def contig_arrays(self, locus):
+        positions, male_sums, female_sums = self.contigs[locus]
+        positions = np.frombuffer(positions, np.int64) if len(positions) else np.zeros(0, np.int64)
+        male_sums, female_sums = np.frombuffer(male_sums, np.float64), np.frombuffer(female_sums, np.float64)
+        if np.any(positions[1:] < positions[:-1]):
+            # unsorted records, redo the sums in position order
+            order = np.argsort(positions, kind='stable')
+            positions = positions[order]
+            male_sums = np.concatenate([[0.0], np.cumsum(np.diff(male_sums)[order])])
+            female_sums = np.concatenate([[0.0], np.cumsum(np.diff(female_sums)[order])])
+        return positions, male_sums, female_sums
+
+    def windows(self, size, unit):
+        step = max(1, size//2)
+        for locus in self.contigs:
+            positions, male_sums, female_sums = self.contig_arrays(locus)
+            if len(positions) == 0:
+                continue
+            if unit == 'bp':
+                starts = np.arange((positions[0]//step)*step, positions[-1] + 1, step)
+                ends = starts + size - 1
+                lo = np.searchsorted(positions, starts, side='left')
+                hi = np.searchsorted(positions, ends, side='right')
+            else:
+                lo = np.arange(0, max(len(positions) - size, 0) + 1, step)
+                if lo[-1] < len(positions) - size:
+                    # a last window ending at the last SNP when the steps don't reach it
+                    lo = np.append(lo, len(positions) - size)
+                hi = np.minimum(lo + size, len(positions))
+                starts, ends = positions[lo], positions[hi - 1]
+            n_snps = hi - lo
+            male_mean = (male_sums[hi] - male_sums[lo])/np.maximum(n_snps, 1)
+            female_mean = (female_sums[hi] - female_sums[lo])/np.maximum(n_snps, 1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                fold_change = female_mean/male_mean
+            for i in np.flatnonzero(n_snps):
+                yield [locus, unit, size, starts[i], ends[i], n_snps[i], male_mean[i], female_mean[i], fold_change[i]]
+
+    def write(self, filename, window_sizes):
+        with open(filename, 'w') as f:
+            csv_writer = csv.writer(f, delimiter="\t")
+            csv_writer.writerow(self.headers)
+            for size, unit in window_sizes:
+                csv_writer.writerows(self.windows(size, unit))
+
+class BootstrapFoldChange(object):
+    """
+    Bootstrap confidence intervals of the pooled fold change (as in ScaffoldSummary) of every scaffold,
+    or of blocks of block_snps SNPs along it, from resampling the male and female individuals.
+    Only the depth sum of every sample over the SNPs of a unit is kept while reading. The replicates
+    are multinomial weight matrices over the individuals drawn at once with a seeded RNG and applied
+    to the normalised sums of all units by matrix products.
+    """
+    headers = ["locus", "start", "end", "n_snps", "pooled_fold_change", "bootstrap_se", "ci_low", "ci_high"]
+
+    def __init__(self, male_idx, female_idx, totals, block_snps=0):
+        self.male_idx, self.female_idx = list(male_idx), list(female_idx)
+        self.totals = np.asarray(totals, float)
+        self.block_snps = block_snps
+        # [locus, start, end, n_snps] of every unit and the unit being filled on every contig
+        self.units = []
+        self.current = {}
+        self.sums = np.zeros((0, len(self.totals)), np.int64)
+
+    def add(self, loci, positions, dp):
+        """
+        Add the (snps x samples) depths of SNPs at loci/positions, e.g. the SNPs with a finite fold change.
+        """
+        unit_ids = np.empty(len(loci), np.int64)
+        for i, (locus, position) in enumerate(zip(loci, positions)):
+            position = int(position)
+            unit = self.current.get(locus)
+            if unit is None or (self.block_snps > 0 and self.units[unit][3] == self.block_snps):
+                unit = self.current[locus] = len(self.units)
+                self.units.append([locus, position, position, 0])
+            u = self.units[unit]
+            u[1], u[2], u[3] = min(u[1], position), max(u[2], position), u[3] + 1
+            unit_ids[i] = unit
+        if len(self.units) > len(self.sums):
+            grown = np.zeros((max(len(self.units), 2*len(self.sums)), len(self.totals)), np.int64)
+            grown[:len(self.sums)] = self.sums
+            self.sums = grown
+        np.add.at(self.sums, unit_ids, np.asarray(dp, np.int64))
+
+    def get_state(self, sums_file=None):
+        # the (units x samples) sums are written to sums_file when given, only its name is in the state
+        state = {'units': self.units, 'current': self.current}
+        if sums_file is None:
+            state['sums'] = self.sums[:len(self.units)].tolist()
+        else:
+            write_checkpoint_array(sums_file, self.sums[:len(self.units)])
+            state['sums_file'] = sums_file
+        return state
+
+    def set_state(self, state):
+        self.units = [list(u) for u in state['units']]
+        self.current = dict(state['current'])
+        sums = np.load(state['sums_file']) if 'sums_file' in state else np.array(state['sums'], np.int64)
+        self.sums = sums.reshape(len(self.units), len(self.totals))
+
+    def intervals(self, n_replicates=1000, seed=None, ci=0.95, chunk_cells=1 << 24):
+        """
+        Pooled fold change, bootstrap standard error and percentile interval of every unit.
+        Units are done in chunks of about chunk_cells replicate values.
+        """
+        n_units, n_males, n_females = len(self.units), len(self.male_idx), len(self.female_idx)
+        point, se, low, high = [np.full(n_units, np.nan) for i in range(4)]
+        if n_units == 0 or n_males == 0 or n_females == 0:
+            return point, se, low, high
+        with np.errstate(divide='ignore', invalid='ignore'):
+            normalised = self.sums[:n_units]/self.totals * 1000000
+        male, female = normalised[:, self.male_idx], normalised[:, self.female_idx]
+        # resampled individuals of every replicate as weights summing to 1
+        rs = np.random.RandomState(seed)
+        male_weights = rs.multinomial(n_males, np.full(n_males, 1.0/n_males), size=n_replicates).T/float(n_males)
+        female_weights = rs.multinomial(n_females, np.full(n_females, 1.0/n_females), size=n_replicates).T/float(n_females)
+        alpha = (1.0 - ci)/2
+        chunk = max(1, chunk_cells//max(n_replicates, 1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            point[:] = female.mean(axis=1)/male.mean(axis=1)
+            for start in range(0, n_units, chunk):
+                rows = slice(start, start + chunk)
+                replicates = np.dot(female[rows], female_weights)/np.dot(male[rows], male_weights)
+                se[rows] = replicates.std(axis=1, ddof=1)
+                low[rows], high[rows] = np.quantile(replicates, [alpha, 1.0 - alpha], axis=1)
+        return point, se, low, high
+
+    def write(self, filename, n_replicates=1000, seed=None, ci=0.95):
+        point, se, low, high = self.intervals(n_replicates, seed, ci)
+        with open(filename, 'w') as f:
+            csv_writer = csv.writer(f, delimiter="\t")
+            csv_writer.writerow(self.headers)
+            for i, (locus, start, end, n_snps) in enumerate(self.units):
+                csv_writer.writerow([locus, start, end, n_snps, point[i], se[i], low[i], high[i]])
+
+class PermutationNull(object):
+    """
+    Empirical null of the filter from shuffling the male/female labels of the samples.
+    Every block of masked genotypes and depths is filtered under the real labels and all
+    n_permutations shuffles at once: the labels are the columns of a samples x permutations 0/1
+    matrix, so the male heterozygote counts and the male/female mean normalised coverage of
+    every permutation are matrix products. Passing SNPs are counted for every fold change margin.
+    With male_het_alpha > 0 the male heterozygotes are tested against the GQ error model of
+    genotype_summary, which needs the GQ array of every block.
+    """
+    headers = ["fold_change_margin", "n_passed", "n_permutations", "mean_permuted_passed",
+               "permuted_passed_q95", "empirical_fdr"]
+
+    def __init__(self, male_idx, female_idx, totals, margins, n_permutations=1000, seed=None, male_het_alpha=0):
+        self.pooled = list(male_idx) + list(female_idx)
+        self.n_males, self.n_females = len(male_idx), len(female_idx)
+        self.totals = np.asarray(totals, float)[self.pooled]
+        self.margins = list(margins)
+        self.n_permutations = n_permutations
+        self.male_het_alpha = male_het_alpha
+        # column 0 has the real labels
+        rs = np.random.RandomState(seed)
+        order = np.argsort(rs.random_sample((n_permutations, len(self.pooled))), axis=1)
+        labels = np.zeros((n_permutations + 1, len(self.pooled)))
+        labels[0, :self.n_males] = 1
+        labels[1:] = (order < self.n_males)
+        self.males = labels.T
+        self.females = 1 - self.males
+        self.counts = np.zeros((len(self.margins), n_permutations + 1), np.int64)
+
+    def add(self, gt, dp, gq=None, chunk_cells=1 << 24):
+        if self.n_males == 0 or self.n_females == 0:
+            return
+        het = (gt[:, self.pooled] == GT_HET).astype(float)
+        if self.male_het_alpha > 0:
+            errors = genotype_error_probabilities(gt[:, self.pooled], gq[:, self.pooled])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            normalised = dp[:, self.pooled]/self.totals * 1000000
+        chunk = max(1, chunk_cells//self.males.shape[1])
+        for start in range(0, len(het), chunk):
+            rows = slice(start, start + chunk)
+            if self.male_het_alpha > 0:
+                no_male_het = heterozygote_error_pvalues(np.dot(het[rows], self.males), np.dot(errors[rows], self.males)) >= self.male_het_alpha
+            else:
+                no_male_het = np.dot(het[rows], self.males) == 0
+            with np.errstate(divide='ignore', invalid='ignore'):
+                fold_change = (np.dot(normalised[rows], self.females)/self.n_females)/(np.dot(normalised[rows], self.males)/self.n_males)
+            for j, margin in enumerate(self.margins):
+                self.counts[j] += np.sum(no_male_het & fold_change_in_range_array(fold_change, margin), axis=0)
+
+    def get_state(self):
+        return {'counts': self.counts.tolist()}
+
+    def set_state(self, state):
+        self.counts = np.array(state['counts'], np.int64).reshape(self.counts.shape)
+
+    def rows(self):
+        for j, margin in enumerate(self.margins):
+            n_passed, permuted = self.counts[j, 0], self.counts[j, 1:]
+            mean_permuted = permuted.mean() if len(permuted) else None
+            fdr = min(1.0, mean_permuted/n_passed) if n_passed > 0 and mean_permuted is not None else None
+            yield [margin, n_passed, self.n_permutations, mean_permuted,
+                   np.quantile(permuted, 0.95) if len(permuted) else None, fdr]
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            csv_writer = csv.writer(f, delimiter="\t")
+            csv_writer.writerow(self.headers)
+            csv_writer.writerows(self.rows())
+
+def external_sort(input_file, output_file, chunk_records=1 << 22, dtype=np.float64):
+    """
+    Sort a raw binary array file into output_file holding at most about chunk_records values in memory.
+    Chunks are sorted into runs which are then merged. Returns the number of values.
+    """
+    n = os.path.getsize(input_file) // np.dtype(dtype).itemsize
+    if n == 0:
+        open(output_file, 'wb').close()
+        return 0
+    values = np.memmap(input_file, dtype=dtype, mode='r', shape=(n,))
+    out = np.memmap(output_file, dtype=dtype, mode='w+', shape=(n,))
+    if n <= chunk_records:
+        out[:] = np.sort(values)
+        out.flush()
+        return n
+    runs_file = output_file + '.runs'
+    runs = np.memmap(runs_file, dtype=dtype, mode='w+', shape=(n,))
+    bounds = list(range(0, n, chunk_records)) + [n]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        runs[start:end] = np.sort(values[start:end])
+    runs.flush()
+    # merge the runs through a buffer per run: every value up to the smallest last value of the
+    # buffers that have more of their run to come is final, so those are merged with one numpy sort
+    starts, ends = bounds[:-1], bounds[1:]
+    buffer_records = max(1, chunk_records // len(starts))
+    buffers = [runs[start:start] for start in starts]
+    position = 0
+    while True:
+        for i, start in enumerate(starts):
+            if len(buffers[i]) == 0 and start < ends[i]:
+                buffers[i] = np.array(runs[start:min(ends[i], start + buffer_records)])
+                starts[i] += len(buffers[i])
+        limits = [buffer[-1] for buffer, start, end in zip(buffers, starts, ends) if len(buffer) and start < end]
+        bound = min(limits) if limits else np.inf
+        cuts = [np.searchsorted(buffer, bound, side='right') for buffer in buffers]
+        merged = np.sort(np.concatenate([buffer[:cut] for buffer, cut in zip(buffers, cuts)]), kind='mergesort')
+        if len(merged) == 0:
+            break
+        out[position:position + len(merged)] = merged
+        position += len(merged)
+        buffers = [buffer[cut:] for buffer, cut in zip(buffers, cuts)]
+    out.flush()
+    del runs
+    os.remove(runs_file)
+    return n
+
+
+class OutOfCoreQValues(object):
+    """
+    Multiple testing corrected q-values (Benjamini-Hochberg or Bonferroni) without holding the p-values in memory.
+    In the first pass p-values are appended to a raw float64 spill file. finish() then sorts them out
+    of core and works out the BH q-value of every rank, so qvalues() can look them up in a second pass.
+    """
+    methods = ['bh', 'bonferroni']
+
+    def __init__(self, spill_prefix, method='bh', chunk_records=1 << 22):
+        if method not in self.methods:
+            raise ValueError('Unknown multiple testing correction %s.' % method)
+        self.method = method
+        self.chunk_records = chunk_records
+        self.spill_file = spill_prefix + '.pvalues.tmp'
+        self.sorted_file = spill_prefix + '.pvalues_sorted.tmp'
+        self.qvalue_file = spill_prefix + '.qvalues_sorted.tmp'
+        self.spill = open(self.spill_file, 'wb')
+        self.buffer = array('d')
+        self.n_tests = 0
+
+    def add(self, pvalue):
+        # p-values that are None or nan are not counted as tests
+        if pvalue is None or not np.isfinite(pvalue):
+            return
+        self.buffer.append(pvalue)
+        if len(self.buffer) >= 65536:
+            self.buffer.tofile(self.spill)
+            del self.buffer[:]
+
+    def finish(self):
+        self.buffer.tofile(self.spill)
+        del self.buffer[:]
+        self.spill.close()
+        self.n_tests = external_sort(self.spill_file, self.sorted_file, self.chunk_records)
+        if self.n_tests == 0 or self.method != 'bh':
+            return
+        # q_(i) = min over j >= i of m/j p_(j), filled in from the largest p-value down
+        m = self.n_tests
+        pvalues = np.memmap(self.sorted_file, dtype=np.float64, mode='r', shape=(m,))
+        qvalues = np.memmap(self.qvalue_file, dtype=np.float64, mode='w+', shape=(m,))
+        running = 1.0
+        for end in range(m, 0, -self.chunk_records):
+            start = max(0, end - self.chunk_records)
+            adjusted = pvalues[start:end] * m / np.arange(start + 1, end + 1)
+            adjusted = np.minimum(np.minimum.accumulate(adjusted[::-1])[::-1], running)
+            qvalues[start:end] = adjusted
+            running = adjusted[0]
+        qvalues.flush()
+        self.sorted_pvalues, self.sorted_qvalues = pvalues, qvalues
+
+    def qvalues(self, pvalues):
+        pvalues = np.asarray(pvalues, np.float64)
+        qvalues = np.full(len(pvalues), np.nan)
+        valid = np.isfinite(pvalues)
+        if self.n_tests == 0 or not np.any(valid):
+            return qvalues
+        if self.method == 'bonferroni':
+            qvalues[valid] = np.minimum(1.0, pvalues[valid] * self.n_tests)
+        else:
+            # tied p-values share the q-value of the last of their ranks
+            ranks = np.searchsorted(self.sorted_pvalues, pvalues[valid], side='right') - 1
+            qvalues[valid] = self.sorted_qvalues[np.maximum(ranks, 0)]
+        return qvalues
+
+    def close(self):
+        self.sorted_pvalues, self.sorted_qvalues = None, None
+        for filename in [self.spill_file, self.sorted_file, self.qvalue_file]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+def parse_memory_size(spec):
+    """
+    Number of bytes in a memory size such as 2G, 500M, 64k or 1000000.
+    """
+    units = {'k': 1024, 'm': 1024**2, 'g': 1024**3, 't': 1024**4}
+    spec = spec.strip().lower().rstrip('b')
+    if spec and spec[-1] in units:
+        return int(float(spec[:-1]) * units[spec[-1]])
+    return int(float(spec))
+
+def peak_rss():
+    # peak resident set size of this process in bytes (ru_maxrss is in kilobytes on linux, bytes on mac),
+    # resource is only there on unix so it is imported here, elsewhere the peak is reported as 0
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def record_block_size(max_memory, n_samples, bytes_per_record):
+    """
+    Number of records per block so that a block stays within max_memory bytes.
+    """
+    per_record = bytes_per_record + n_samples * BLOCK_BYTES_PER_CELL
+    return int(max(MIN_BLOCK_RECORDS, min(MAX_BLOCK_RECORDS, max_memory // max(per_record, 1))))
+
+def iter_vcf_blocks(f, block_records=10000, max_memory=None, n_samples=0):
+    """
+    Blocks of record lines from a vcf file opened in binary mode.
+    With a max_memory budget (bytes) the block size is worked out from the number of samples and
+    the mean bytes per record seen so far, otherwise blocks have block_records records.
+    """
+    if max_memory is not None:
+        # start from a guess of ~24 bytes per sample cell until records have been seen
+        block_records = record_block_size(max_memory, n_samples, 24 * n_samples)
+    block, n_bytes, n_records = [], 0, 0
+    for line in f:
+        if line.startswith(b'#'):
+            continue
+        block.append(line)
+        n_bytes += len(line)
+        if len(block) == block_records:
+            yield block
+            n_records += len(block)
+            block = []
+            if max_memory is not None:
+                block_records = record_block_size(max_memory, n_samples, n_bytes / float(n_records))
+    if block:
+        yield block
+
+def line_start(f, offset, data_start, window=1 << 12):
+    """
+    Byte offset of the start of the line holding the byte at offset, reading back from it.
+    """
+    end = offset
+    while end > data_start:
+        start = max(data_start, end - window)
+        f.seek(start)
+        newline = f.read(end - start).rfind(b'\n')
+        if newline >= 0:
+            return start + newline + 1
+        end = start
+    return data_start
+
+def sample_vcf_records(input_file, n_records=None, seed=None, run_records=16, fraction=None):
+    """
+    About n_records record lines (bytes), or a fraction of the records, read from randomly spread
+    byte offsets of a vcf file. A random offset falls in a line with a probability proportional to
+    its length, so the line is kept with a probability inversely proportional to its length (the
+    shortest line seen kept every time) and a run of run_records records is read from its start.
+    The kept lines are then a uniform sample of the records whatever the mix of line lengths.
+    Returns the lines and the number of records in the file estimated from the mean length of the
+    sampled lines; when that is no more than n_records every record is returned.
+    """
+    rng = np.random.RandomState(seed)
+    size = os.path.getsize(input_file)
+    with open(input_file, 'rb') as f:
+        # skip the header lines
+        data_start = 0
+        for line in f:
+            if not line.startswith(b'#'):
+                break
+            data_start += len(line)
+        if data_start >= size:
+            return [], 0
+
+        def hit_line():
+            start = line_start(f, rng.randint(data_start, size), data_start)
+            f.seek(start)
+            return start, len(f.readline())
+
+        # a pilot of length biased lines, whose harmonic mean length is the mean record length
+        pilot = [hit_line() for i in range(256)]
+        lengths = np.array([length for start, length in pilot], float)
+        estimated_records = int(round((size - data_start)*np.mean(1.0/lengths)))
+        if fraction is not None:
+            n_records = max(1, int(round(fraction*estimated_records)))
+        if estimated_records <= n_records:
+            f.seek(data_start)
+            lines = [line for line in f if not line.startswith(b'#')]
+            return lines, len(lines)
+        n_runs = max(1, n_records//run_records)
+        shortest = lengths.min()
+        starts = set()
+        for draw in range(100*n_runs):
+            if len(starts) == n_runs:
+                break
+            start, length = pilot[draw] if draw < len(pilot) else hit_line()
+            if rng.random_sample()*length < shortest:
+                starts.add(start)
+        lines, read_up_to = [], data_start
+        for start in sorted(starts):
+            # inside the previous run, carry on from its end
+            f.seek(max(start, read_up_to))
+            lines.extend(line for i, line in zip(range(run_records), f) if not line.startswith(b'#'))
+            read_up_to = f.tell()
+    if lines:
+        estimated_records = int(round((size - data_start)/np.mean([len(line) for line in lines])))
+    return lines, estimated_records
+
+def preview_vcf_lines(input_file, n_records=None, fraction=None, seed=None):
+    """
+    The header line and records sampled one at a time from random offsets as text lines, to feed
+    the csv reader loops instead of the whole file. Returns the lines, the number of sampled
+    records and the estimated number of records in the file.
+    """
+    with open(input_file) as f:
+        for header in f:
+            if not header.startswith('##'):
+                break
+    lines, estimated_records = sample_vcf_records(input_file, n_records, seed=seed, run_records=1, fraction=fraction)
+    return [header] + [line.decode() for line in lines], len(lines), estimated_records
+
+def wilson_interval(k, n, z=1.96):
+    """
+    Wilson score interval of the proportion k/n (95% with the default z).
+    """
+    if n == 0:
+        return 0.0, 1.0
+    p = k/float(n)
+    denominator = 1.0 + z*z/n
+    centre = (p + z*z/(2.0*n))/denominator
+    half_width = z*math.sqrt(p*(1.0 - p)/n + z*z/(4.0*n*n))/denominator
+    return max(0.0, centre - half_width), min(1.0, centre + half_width)
+
+def read_vcf_arrays(input_file, individual_start_col, gq_threshold, cols=None, block_records=10000, max_memory=None):
+    """
+    Read the GQ masked depths and genotype codes of every sample into (snps x samples) arrays,
+    parsed a block at a time with the X_kernels kernels. Masked cells get a depth of 0 and
+    GT_MISSING, as with filter_by_gq followed by dp_values. Only the given cols are parsed (all samples by default). With a gq_threshold of None the
+    genotypes and depths are not masked and the GQ values are returned as 'gq' instead of 'gq_pass'.
+    """
+    headers = read_vcf_header(input_file)
+    if cols is None:
+        cols = list(range(individual_start_col, len(headers)))
+    contigs, contig_ids = [], {}
+    contig_idx, positions, dps, gts, gqs = [], [], [], [], []
+    with open(input_file, 'rb') as f:
+        logging.info('Opened input file %s' % input_file)
+        for lines in iter_vcf_blocks(f, block_records, max_memory, len(cols)):
+            gt, gq, dp = parse_block(lines, cols)
+            if gq_threshold is not None:
+                gt, dp, gq = mask_by_gq(gt, gq, dp, gq_threshold)
+            for line in lines:
+                contig, position = line.split(b'\t', 2)[:2]
+                contig = contig.decode()
+                if contig not in contig_ids:
+                    contig_ids[contig] = len(contigs)
+                    contigs.append(contig)
+                contig_idx.append(contig_ids[contig])
+                positions.append(int(position))
+            gts.append(gt)
+            dps.append(dp)
+            gqs.append(gq)
+    n_samples = len(cols)
+    gq_name, gq_dtype = ('gq', np.int32) if gq_threshold is None else ('gq_pass', bool)
+    return {'samples': [headers[col] for col in cols], 'contigs': contigs,
+            'contig_idx': np.array(contig_idx, np.int32),
+            'positions': np.array(positions, np.int64),
+            'dp': np.concatenate(dps) if dps else np.zeros((0, n_samples), np.int32),
+            'gt': np.concatenate(gts) if gts else np.zeros((0, n_samples), np.int8),
+            gq_name: np.concatenate(gqs) if gqs else np.zeros((0, n_samples), gq_dtype)}
+
+def total_depths_from_blocks(input_file, individual_start_col, gq_threshold, cols=None, block_records=10000, max_memory=None):
+    """
+    Same result as total_read_dp_per_individual, parsed a block at a time with the X_kernels kernels.
+    """
+    headers = read_vcf_header(input_file)
+    if cols is None:
+        cols = list(range(individual_start_col, len(headers)))
+    totals = np.zeros(len(cols), np.int64)
+    with open(input_file, 'rb') as f:
+        logging.info('Opened input file %s' % input_file)
+        for lines in iter_vcf_blocks(f, block_records, max_memory, len(cols)):
+            gt, gq, dp = parse_block(lines, cols)
+            totals += mask_by_gq(gt, gq, dp, gq_threshold)[1].sum(axis=0)
+    return dict((col, int(total)) for col, total in zip(cols, totals))
+
+def coverage_and_fold_change_matrix(dp, male_idx, female_idx, total_sample_read_depth, normalise=True, ttest=True):
+    """
+    Vectorised calc_coverage_and_fold_change over a (snps x samples) depth matrix.
+    male_idx/female_idx index the sample axis and total_sample_read_depth is an array over it.
+    Everything is nan when a male or female total is 0, where the row version returns None.
+    The t-test values are None when ttest is False.
+    """
+    dp = np.asarray(dp, float)
+    totals = np.asarray(total_sample_read_depth, float)
+    n = dp.shape[0]
+    if np.any(totals[male_idx] == 0) or np.any(totals[female_idx] == 0):
+        logging.error('Total coverage depth is 0.')
+        return tuple(np.full(n, np.nan) for i in range(6))
+    # row contiguous so the row means are summed in the same order as np.mean of a single row
+    male_dps = np.ascontiguousarray(dp[:, male_idx])
+    female_dps = np.ascontiguousarray(dp[:, female_idx])
+    if normalise:
+        male_dps = male_dps/totals[male_idx] * 1000000
+        female_dps = female_dps/totals[female_idx] * 1000000
+    male_mean_coverage = male_dps.mean(axis=1)
+    female_mean_coverage = female_dps.mean(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fold_change = female_mean_coverage/male_mean_coverage
+        if not ttest:
+            return male_mean_coverage, female_mean_coverage, fold_change, None, None, None
+        t_stat_eq, pvalue_eq = stats.ttest_ind(male_dps, female_dps, axis=1)
+    pvalue_eq_divided_2 = pvalue_eq/2
+    return male_mean_coverage, female_mean_coverage, fold_change, t_stat_eq, pvalue_eq, pvalue_eq_divided_2
+
+def fold_change_in_range_array(fold_change, fold_change_margin):
+    # boolean array of the fold change check, nan fold changes are never in range
+    with np.errstate(invalid='ignore'):
+        return ((2.0 - fold_change_margin) < fold_change) & (fold_change < (2.0 + fold_change_margin))
+
+def genotype_error_probabilities(gt, gq):
+    # phred scaled GQ as the probability a call is wrong, 0 for missing and GQ masked calls
+    return np.where(gt != GT_MISSING, np.power(10.0, -np.maximum(gq, 0)/10.0), 0.0)
+
+def heterozygote_error_pvalues(n_heterozygote, expected_errors):
+    """
+    Probability of at least n_heterozygote heterozygote calls if every one of them was a genotyping error.
+    The number of errors is taken as Poisson around expected_errors, the summed error probabilities of the
+    calls, and every error is counted as a heterozygote. Vectorised over any shape of arrays.
+    """
+    return stats.poisson.sf(np.asarray(n_heterozygote) - 1, expected_errors)
+
+def genotype_summary(gt, gq_pass, male_idx, female_idx, gq=None, male_het_alpha=0):
+    """
+    Per SNP genotype counts of the meta data, the part of filter_results not needing the depth totals.
+    With male_het_alpha > 0 a SNP only counts as a male heterozygote when its male heterozygotes are
+    unlikely (p < male_het_alpha) to all be genotyping errors given the GQ of the male calls.
+    """
+    male_gt, female_gt = gt[:, male_idx], gt[:, female_idx]
+    results = {}
+    results['n_male_homozygote'] = np.sum((male_gt == GT_HOM_REF) | (male_gt == GT_HOM_ALT), axis=1)
+    results['n_male_heterozygote'] = np.sum(male_gt == GT_HET, axis=1)
+    results['n_female_homozygote'] = np.sum((female_gt == GT_HOM_REF) | (female_gt == GT_HOM_ALT), axis=1)
+    results['n_female_heterozygote'] = np.sum(female_gt == GT_HET, axis=1)
+    results['is_male_heterozygote'] = results['n_male_heterozygote'] > 0
+    if male_het_alpha > 0:
+        results['male_het_pvalue'] = heterozygote_error_pvalues(
+            results['n_male_heterozygote'], genotype_error_probabilities(male_gt, gq[:, male_idx]).sum(axis=1))
+        results['is_male_heterozygote'] = results['male_het_pvalue'] < male_het_alpha
+    results['n_gq_filtered'] = np.sum(~gq_pass, axis=1)
+    return results
+
+def filter_results(gt, dp, gq_pass, male_idx, female_idx, totals, fold_change_margin, gq=None, male_het_alpha=0):
+    """
+    Meta data and filter decision of every SNP from (snps x samples) masked genotype, depth and
+    GQ pass arrays. male_idx/female_idx index the sample axis and totals is the depth total of every sample.
+    The GQ array is only needed for the error tolerant male heterozygote test of genotype_summary.
+    """
+    results = genotype_summary(gt, gq_pass, male_idx, female_idx, gq, male_het_alpha)
+    totals = np.asarray(totals)
+    # with a male or female total of 0 the coverage is undefined, None in the per row version
+    results['coverage_defined'] = not (np.any(totals[male_idx] == 0) or np.any(totals[female_idx] == 0))
+    male_mean_coverage, female_mean_coverage, fold_change = coverage_and_fold_change_matrix(
+        dp, male_idx, female_idx, totals, normalise=True, ttest=False)[:3]
+    results['male_mean_coverage'] = male_mean_coverage
+    results['female_mean_coverage'] = female_mean_coverage
+    results['fold_change'] = fold_change
+    results['fold_change_in_range'] = fold_change_in_range_array(fold_change, fold_change_margin)
+    results['passed'] = ~results['is_male_heterozygote'] & results['fold_change_in_range']
+    return results
+
+def filter_record_block(lines, male_cols, female_cols, used_cols, total_sample_read_depth, gq_threshold, fold_change_margin, diagnostics=None,
+                        male_het_alpha=0):
+    """
+    filter_results for a block of vcf record lines (bytes), parsing only the used_cols.
+    The malformed GQ, DP and GT fields are counted in diagnostics when given.
+    """
+    gt, gq, dp = parse_block(lines, used_cols)
+    if diagnostics is not None:
+        diagnostics.add_block(lines, used_cols, gt, gq, dp, gq_threshold)
+    gt, dp, gq_pass = mask_by_gq(gt, gq, dp, gq_threshold)
+    position = dict((col, i) for i, col in enumerate(used_cols))
+    male_idx, female_idx = [position[col] for col in male_cols], [position[col] for col in female_cols]
+    totals = np.array([total_sample_read_depth[col] for col in used_cols], np.int64)
+    results = filter_results(gt, dp, gq_pass, male_idx, female_idx, totals, fold_change_margin, gq, male_het_alpha)
+    # arrays of the used_cols, e.g. for BootstrapFoldChange, PermutationNull and strata
+    results['gt'], results['dp'], results['gq_pass'], results['gq'] = gt, dp, gq_pass, gq
+    return results
+
+# routes of the records, in the order of the output files
+ROUTES = ['x_candidate', 'male_het', 'fold_change', 'undetermined']
+ROUTE_X_CANDIDATE, ROUTE_MALE_HET, ROUTE_FOLD_CHANGE, ROUTE_UNDETERMINED = range(len(ROUTES))
+
+# write buffer of every routed output
+ROUTE_BUFFER_SIZE = 4 * 1024**2
+
+def route_records(results, passed=None):
+    """
+    Route of every SNP of filter_results: male heterozygotes, SNPs without a finite fold change
+    (no depth in the males or females) as undetermined, fold changes out of range and the rest as X candidates.
+    passed replaces the X candidates when given, e.g. the strata consensus, and the SNPs it rejects that
+    would otherwise be X candidates are undetermined.
+    """
+    routes = np.full(len(results['is_male_heterozygote']), ROUTE_UNDETERMINED, np.int8)
+    if results['coverage_defined']:
+        routes[results['fold_change_in_range']] = ROUTE_X_CANDIDATE
+        routes[np.isfinite(results['fold_change']) & ~results['fold_change_in_range']] = ROUTE_FOLD_CHANGE
+    routes[results['is_male_heterozygote']] = ROUTE_MALE_HET
+    if passed is not None:
+        passed = np.asarray(passed, bool)
+        routes[~passed & (routes == ROUTE_X_CANDIDATE)] = ROUTE_UNDETERMINED
+        routes[passed] = ROUTE_X_CANDIDATE
+    return routes
+
+def route_filename(prefix, route, compress_level=0):
+    return '%s_%s.vcf%s' % (prefix, route, '.gz' if compress_level > 0 else '')
+
+class RoutedOutputs(object):
+    """
+    One text output per route, <prefix>_<route>.vcf, each behind its own write buffer of buffer_size
+    bytes and gzip compressed when compress_level is 1-9. Given the lengths of a checkpoint the
+    uncompressed outputs are truncated to them and continued.
+    """
+    def __init__(self, prefix, compress_level=0, buffer_size=ROUTE_BUFFER_SIZE, lengths=None):
+        self.filenames = [route_filename(prefix, route, compress_level) for route in ROUTES]
+        self.counts = [0] * len(ROUTES)
+        self.files = []
+        append = lengths is not None
+        for filename, length in zip(self.filenames, lengths if append else self.filenames):
+            if append:
+                os.truncate(filename, length)
+            if compress_level > 0:
+                raw = io.BufferedWriter(gzip.open(filename, 'ab' if append else 'wb', compresslevel=compress_level), buffer_size)
+            else:
+                raw = open(filename, 'ab' if append else 'wb', buffering=buffer_size)
+            self.files.append(io.TextIOWrapper(raw, newline=''))
+        self.writers = [csv.writer(f, delimiter="\t") for f in self.files]
+
+    def writeheader(self, headers):
+        for writer in self.writers:
+            writer.writerow(headers)
+
+    def writerow(self, route, row):
+        self.writers[route].writerow(row)
+        self.counts[route] += 1
+
+    def lengths(self):
+        return [synced_length(f) for f in self.files]
+
+    def get_state(self):
+        return {'counts': self.counts}
+
+    def set_state(self, state):
+        self.counts = list(state['counts'])
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+def iter_site_keys(f):
+    """
+    (contig, position) of every record of a vcf file opened in binary mode, splitting each
+    line only up to the second tab.
+    """
+    for line in f:
+        if line.startswith(b'#'):
+            continue
+        locus, position = line.split(b'\t', 2)[:2]
+        yield locus, int(position)
+
+class SiteIndex(object):
+    """
+    Deduplicated sorted int64 positions of every contig, e.g. the sites of a subset vcf.
+    Saved as a .npz together with the signature of the vcf it was built from so it can be reused
+    until the vcf changes.
+    """
+    def __init__(self, positions=None, signature=None):
+        self.positions = positions if positions is not None else {}
+        self.signature = signature
+        self.contig_ids, self.sorted_keys = None, None
+
+    @classmethod
+    def from_vcf(cls, vcf_filename):
+        positions = {}
+        with open(vcf_filename, 'rb') as f:
+            for locus, position in iter_site_keys(f):
+                if locus not in positions:
+                    positions[locus] = array('q')
+                positions[locus].append(position)
+        return cls(dict((locus.decode(), np.unique(np.frombuffer(p, np.int64))) for locus, p in positions.items()),
+                   vcf_signature(vcf_filename))
+
+    def __len__(self):
+        return sum(len(p) for p in self.positions.values())
+
+    def contains(self, loci, positions):
+        """
+        Boolean array of which (locus, position) pairs are in the index.
+        """
+        loci = np.asarray(loci, object)
+        positions = np.asarray(positions, np.int64)
+        if self.sorted_keys is None:
+            # (contig number << 40 | position) keys of every site, sorted as the contigs are numbered in order
+            self.contig_ids = dict((contig, i) for i, contig in enumerate(self.positions))
+            self.sorted_keys = np.concatenate([np.zeros(0, np.int64)] + [np.int64(i) << 40 | self.positions[contig]
+                                                                         for contig, i in self.contig_ids.items()])
+        if len(positions) == 0 or len(self.sorted_keys) == 0:
+            return np.zeros(len(positions), bool)
+        # the contig of every distinct locus is looked up once
+        names, inverse = np.unique(loci, return_inverse=True)
+        ids = np.array([self.contig_ids.get(name, -1) for name in names.tolist()], np.int64)[inverse.reshape(-1)]
+        keys = ids << 40 | positions
+        at = np.minimum(np.searchsorted(self.sorted_keys, keys), len(self.sorted_keys) - 1)
+        return (ids >= 0) & (self.sorted_keys[at] == keys)
+
+    def keys(self):
+        # CHROM:POS strings as from get_SNP_IDs_from_VCF
+        return ['%s:%d' % (locus, position) for locus, p in self.positions.items() for position in p]
+
+    def save(self, filename):
+        contigs = list(self.positions)
+        lengths = np.array([len(self.positions[contig]) for contig in contigs], np.int64)
+        with open(filename, 'wb') as f:
+            np.savez(f, contigs=np.array(contigs, str), lengths=lengths,
+                     positions=np.concatenate([self.positions[contig] for contig in contigs]) if contigs else np.zeros(0, np.int64),
+                     signature=np.array(json.dumps(self.signature)))
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            offsets = np.concatenate([[0], np.cumsum(data['lengths'])])
+            positions = dict((str(contig), data['positions'][offsets[i]:offsets[i + 1]])
+                             for i, contig in enumerate(data['contigs']))
+            return cls(positions, json.loads(str(data['signature'])))
+
+def load_or_build_site_index(index_filename, vcf_filename):
+    """
+    The site index saved at index_filename, rebuilt from vcf_filename (and saved) when missing or out of date.
+    """
+    if os.path.exists(index_filename):
+        index = SiteIndex.load(index_filename)
+        if vcf_filename == '' or index.signature == vcf_signature(vcf_filename):
+            logging.info('Using site index %s' % index_filename)
+            return index
+    s = time.time()
+    index = SiteIndex.from_vcf(vcf_filename)
+    index.save(index_filename)
+    e = time.time()
+    logging.info('Built site index %s of %d sites in %.2f seconds.' % (index_filename, len(index), e-s))
+    return index
 
-    
-    
 def get_SNP_IDs_from_VCF(vcf_filename):
     SNP_IDs=[]
     # open files for reading
     try:
-        f = open(vcf_filename, "r")
-        csv_reader = csv.reader(f, delimiter="\t")
-        for row in csv_reader:
-            if row[0].startswith("##"):
-                continue
-            if row[0].startswith("#"): # header column
-                continue
-            else:
-                SNP_IDs.append(row[0]+":"+row[1])
-        f.close()
+        with open(vcf_filename, "rb") as f:
+            for locus, position in iter_site_keys(f):
+                SNP_IDs.append('%s:%d' % (locus.decode(), position))
     except IOError:
         logging.error("Failed to open " + vcf_filename)
 
 
     return SNP_IDs
     
-def get_coverages_from_meta(meta_filename, SNP_IDs):
+def get_coverages_from_meta(meta_filename, SNP_IDs, chunk_rows=65536):
+    """
+    Male and female mean coverage of the meta data rows of the sites in SNP_IDs, a list of
+    CHROM:POS strings or a SiteIndex.
+    """
     male_coverages, female_coverages = [], []
+    if not isinstance(SNP_IDs, SiteIndex):
+        SNP_IDs = set(SNP_IDs)
     try:
         f = open(meta_filename, "r")
         csv_reader = csv.reader(f, delimiter="\t")
         headers = next(csv_reader)
-        for row in csv_reader:
-            SNP_ID = row[0] + ':' + row[1]
-            if SNP_ID in SNP_IDs:    
-                male_coverages.append(float(row[8]))
-                female_coverages.append(float(row[9]))
+        while True:
+            rows = list(itertools.islice(csv_reader, chunk_rows))
+            if not rows:
+                break
+            if isinstance(SNP_IDs, SiteIndex):
+                found = SNP_IDs.contains([row[0] for row in rows], [int(row[1]) for row in rows])
+            else:
+                found = [row[0] + ':' + row[1] in SNP_IDs for row in rows]
+            for row, is_found in zip(rows, found):
+                if is_found:
+                    male_coverages.append(float(row[8]))
+                    female_coverages.append(float(row[9]))
         f.close()
     except IOError:
         logging.error("Failed to open " + meta_filename)
     return male_coverages, female_coverages
-
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+"""
+Bit packed genotype cache of a vcf file.
+
+Every GQ masked genotype is stored as a 2 bit code (hom-ref 00, het 01, hom-alt 10, missing 11),
+four samples to a byte, together with a packed bitmask of the calls passing the GQ threshold.
+The arrays are memory mapped when loaded and genotype counts for any subset of samples come
+from bitwise operations and popcounts over the packed bytes.
+
+Only Compare_Male_HZ_to_Female_Hz.py reads the cache (-c/--genotype-cache). X_filtering.py and
+X_plots.py count heterozygotes in the same scan that reads the depths for the fold change, which
+the cache does not hold, so they still read the vcf.
+"""
+import argparse # package to help with argument parsing
+import json
+import logging # module to enable logging
+import os
+import sys
+import time
+import numpy as np
+
+# import custom functions
+from X_filtering_functions import *
+from X_kernels import KERNELS, set_kernel
+
+
+CACHE_ARRAYS = ['contig_idx', 'positions', 'gt_packed', 'gq_pass']
+
+# bumped when the genotype classification changes so older caches are rebuilt
+CACHE_VERSION = 2
+
+# number of set bits in every byte value
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], np.uint8)
+
+# low bit of every 2 bit lane
+LANE_LOW_BITS = 0x55
+
+
+def default_cache_dir(input_file):
+    return input_file + '.gtcache'
+
+def pack_genotypes(gt):
+    """
+    Pack a (snps x samples) array of genotype codes into (snps x ceil(samples/4)) bytes.
+    Padding lanes are missing so they are never counted.
+    """
+    n_snps, n_samples = gt.shape
+    n_bytes = (n_samples + 3)//4
+    padded = np.full((n_snps, n_bytes*4), GT_MISSING, np.uint8)
+    padded[:, :n_samples] = gt
+    lanes = padded.reshape(n_snps, n_bytes, 4)
+    return (lanes[:, :, 0] | (lanes[:, :, 1] << 2) | (lanes[:, :, 2] << 4) | (lanes[:, :, 3] << 6)).astype(np.uint8)
+
+def unpack_genotypes(gt_packed, n_samples):
+    shifts = np.array([0, 2, 4, 6], np.uint8)
+    lanes = (gt_packed[:, :, None] >> shifts) & 3
+    return lanes.reshape(gt_packed.shape[0], -1)[:, :n_samples].astype(np.int8)
+
+def lane_mask(n_samples, idx):
+    """
+    Byte mask with the low bit of the lane set for every sample in idx.
+    """
+    bits = np.zeros(((n_samples + 3)//4)*4, np.uint8)
+    bits[np.asarray(idx, np.int64)] = 1
+    lanes = bits.reshape(-1, 4)
+    return (lanes[:, 0] | (lanes[:, 1] << 2) | (lanes[:, 2] << 4) | (lanes[:, 3] << 6)).astype(np.uint8)
+
+def build_genotype_cache(input_file, cache_dir, individual_start_col, gq_threshold, max_memory=None):
+    cohort = read_vcf_arrays(input_file, individual_start_col, gq_threshold, max_memory=max_memory)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    np.save(os.path.join(cache_dir, 'contig_idx.npy'), cohort['contig_idx'])
+    np.save(os.path.join(cache_dir, 'positions.npy'), cohort['positions'])
+    np.save(os.path.join(cache_dir, 'gt_packed.npy'), pack_genotypes(cohort['gt']))
+    np.save(os.path.join(cache_dir, 'gq_pass.npy'), np.packbits(cohort['gq_pass'], axis=1))
+    # write the json last so a half written cache is never picked up
+    info = vcf_signature(input_file)
+    info.update({'samples': cohort['samples'], 'contigs': cohort['contigs'], 'gq_threshold': gq_threshold,
+                 'individual_start_col': individual_start_col, 'version': CACHE_VERSION})
+    with open(os.path.join(cache_dir, 'cache_info.json'), 'w') as f:
+        json.dump(info, f)
+
+def load_genotype_cache(cache_dir):
+    with open(os.path.join(cache_dir, 'cache_info.json')) as f:
+        cache = json.load(f)
+    for name in CACHE_ARRAYS:
+        cache[name] = np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r')
+    return cache
+
+def cache_is_current(cache_dir, input_file, individual_start_col, gq_threshold):
+    try:
+        with open(os.path.join(cache_dir, 'cache_info.json')) as f:
+            info = json.load(f)
+    except (IOError, ValueError):
+        return False
+    signature = vcf_signature(input_file)
+    return all(info.get(key) == value for key, value in signature.items()) and info.get('gq_threshold') == gq_threshold \
+        and info.get('individual_start_col') == individual_start_col and info.get('version') == CACHE_VERSION
+
+def load_or_build_genotype_cache(input_file, cache_dir, individual_start_col, gq_threshold, max_memory=None):
+    if cache_is_current(cache_dir, input_file, individual_start_col, gq_threshold):
+        logging.info('Using genotype cache %s' % cache_dir)
+    else:
+        s = time.time()
+        build_genotype_cache(input_file, cache_dir, individual_start_col, gq_threshold, max_memory=max_memory)
+        e = time.time()
+        logging.info('Built genotype cache %s in %.2f seconds.' % (cache_dir, e-s))
+    return load_genotype_cache(cache_dir)
+
+def genotype_counts(cache, idx, block_size=65536):
+    """
+    Number of heterozygote, homozygote and missing calls among the samples idx for every SNP.
+    """
+    gt_packed = cache['gt_packed']
+    mask = lane_mask(len(cache['samples']), idx)
+    n_snps = gt_packed.shape[0]
+    n_het, n_hom = np.zeros(n_snps, np.int64), np.zeros(n_snps, np.int64)
+    for start in range(0, n_snps, block_size):
+        block = np.asarray(gt_packed[start:start + block_size])
+        low = block & LANE_LOW_BITS
+        high = (block >> 1) & LANE_LOW_BITS
+        n_het[start:start + block_size] = POPCOUNT[low & ~high & mask].sum(axis=1, dtype=np.int64)
+        n_hom[start:start + block_size] = POPCOUNT[~low & LANE_LOW_BITS & mask].sum(axis=1, dtype=np.int64)
+    n_missing = len(idx) - n_het - n_hom
+    return n_het, n_hom, n_missing
+
+
+# only run following code if was called from command line
+if __name__ == '__main__':
+    # setup argument parser
+    parser = argparse.ArgumentParser(description="Script to build the bit packed genotype cache of a vcf file.")
+    parser.add_argument('-i', '--input', type=str, default='', help='Name of input vcf file.')
+    parser.add_argument('-c', '--cache', type=str, default='', help='Directory of the genotype cache (default=<input>.gtcache).')
+    parser.add_argument('-gq', '--gq-threshold', type=int, default=20, help='GQ threshold to use (default=20).')
+    parser.add_argument('--max-memory', type=str, default='', help='Memory budget used to size the blocks of records parsed together, e.g. 2G or 500M (default=blocks of 10000 records).')
+    parser.add_argument('--kernel', type=str, default='auto', choices=KERNELS, help='Record parsing kernel, auto uses numba when installed (default=auto).')
+    parser.add_argument('--log-file', type=str, default='', help='File to write log information to (uses stdout if none specified).')
+
+    # parse command line arguments
+    opts = parser.parse_args(sys.argv[1:])
+
+    # config values
+    individual_start_col = 9
+
+    # setup logging, this will log anything info level or above
+    logging.basicConfig(filename=(opts.log_file if opts.log_file != '' else None), filemode='a', level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+
+    set_kernel(opts.kernel)
+
+    try:
+        cache_dir = opts.cache if opts.cache != '' else default_cache_dir(opts.input)
+        max_memory = parse_memory_size(opts.max_memory) if opts.max_memory != '' else None
+        load_or_build_genotype_cache(opts.input, cache_dir, individual_start_col, opts.gq_threshold, max_memory=max_memory)
+        logging.info('Peak memory use %.1f MB.' % (peak_rss() / 1024.0**2))
+    except IOError as ioerror:
+        logging.error('Problem opening files: ' + str(ioerror))
@@ -0,0 +1,243 @@
+#!/usr/bin/python
+"""
+Kernels turning blocks of vcf records into genotype code, GQ and DP arrays in one scan.
+Malformed fields come out as the GT_MALFORMED, GQ_MISSING and DP_MALFORMED sentinels so they can be
+counted per block, mask_by_gq turns them into missing calls with a depth of 0.
+
+The byte level scanner is compiled with numba when it is installed, otherwise a pure Python
+version splitting the record bytes is used. Both give the same values as the reference helpers
+is_heterozygote, is_gq_greater_than and dp_values in X_filtering_functions.
+"""
+import os
+import numpy as np
+
+try:
+    import numba
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+
+# genotype codes used by the array-backed representations
+GT_HOM_REF, GT_HET, GT_HOM_ALT, GT_MISSING = 0, 1, 2, 3
+
+# genotype code of parse_block for a GT that is neither a call nor a missing call, e.g. 0/x
+GT_MALFORMED = 4
+
+# GQ of a call whose GQ field is not integer valued
+GQ_MISSING = np.iinfo(np.int32).min
+
+# DP of parse_block for a call whose DP field is there but not integer valued
+DP_MALFORMED = np.iinfo(np.int32).min
+
+# interned GT strings (str or bytes) -> (genotype code, ploidy), filled in as new strings are seen
+GT_TABLE = {}
+
+# interned GT strings that are neither a call nor a missing call, e.g. 0/x
+MALFORMED_GT = set()
+
+KERNELS = ['auto', 'numba', 'python']
+
+_kernel = 'auto'
+
+
+def set_kernel(name):
+    """
+    Choose the kernel used by parse_block, auto uses numba when it is installed.
+    """
+    global _kernel
+    if name not in KERNELS:
+        raise ValueError('Unknown kernel %s, expected one of %s.' % (name, ', '.join(KERNELS)))
+    if name == 'numba' and not HAVE_NUMBA:
+        raise ValueError('The numba kernel was asked for but numba is not installed.')
+    _kernel = name
+
+def active_kernel():
+    if _kernel == 'auto':
+        return 'numba' if HAVE_NUMBA else 'python'
+    return _kernel
+
+def _classify_gt(gt):
+    # phased or unphased calls of any ploidy and number of alleles, a call with a missing allele is missing
+    if isinstance(gt, bytes):
+        gt = gt.decode('ascii', 'replace')
+    alleles = gt.replace('|', '/').split('/') if gt != '' else []
+    if not alleles or not all(allele != '' and all('0' <= c <= '9' for c in allele) for allele in alleles):
+        return GT_MISSING, len(alleles)
+    alleles = [int(allele) for allele in alleles]
+    if any(allele != alleles[0] for allele in alleles):
+        return GT_HET, len(alleles)
+    # haploid calls count as homozygous
+    return (GT_HOM_REF if alleles[0] == 0 else GT_HOM_ALT), len(alleles)
+
+def interned_gt(gt):
+    """
+    Genotype code and ploidy of a GT string, e.g. (GT_HET, 2) for 0|1 or 1/2 and (GT_HOM_ALT, 1) for 1.
+    """
+    call = GT_TABLE.get(gt)
+    if call is None:
+        call = GT_TABLE[gt] = _classify_gt(gt)
+        if call[0] == GT_MISSING:
+            alleles = (gt.decode('ascii', 'replace') if isinstance(gt, bytes) else gt).replace('|', '/').split('/')
+            if gt and not all(allele == '.' or allele.isdigit() for allele in alleles):
+                MALFORMED_GT.add(gt)
+    return call
+
+def gt_code(gt):
+    return interned_gt(gt)[0]
+
+for gt in ['0/0', '0/1', '1/1', '0|0', '0|1', '1|0', '1|1', './.', '.|.', '.', '0', '1', '']:
+    interned_gt(gt)
+    interned_gt(gt.encode())
+
+def _parse_int(buf, start, end):
+    # int() of the bytes, returns (valid, value)
+    if start >= end:
+        return False, 0
+    sign = 1
+    if buf[start] == 45 or buf[start] == 43: # - or +
+        if buf[start] == 45:
+            sign = -1
+        start += 1
+        if start >= end:
+            return False, 0
+    value = 0
+    for i in range(start, end):
+        c = buf[i]
+        if c < 48 or c > 57:
+            return False, 0
+        value = value*10 + (c - 48)
+    return True, sign*value
+
+def _scan_block(buf, starts, ends, col_map, dp_idx, gt_out, gq_out, dp_out):
+    """
+    Scan every record once. col_map gives the output column of each vcf column (-1 to skip) and
+    scanning a record stops after the last mapped column.
+    """
+    n_cols = len(col_map)
+    for r in range(len(starts)):
+        pos = starts[r]
+        end = ends[r]
+        while end > pos and (buf[end - 1] == 10 or buf[end - 1] == 13):
+            end -= 1
+        col = 0
+        while col < n_cols and pos <= end:
+            cell_start = pos
+            while pos < end and buf[pos] != 9:
+                pos += 1
+            cell_end = pos
+            out = col_map[col]
+            if out >= 0:
+                # genotype is the text before the first colon (snp_info[:-1] when there is none)
+                first_colon = -1
+                for i in range(cell_start, cell_end):
+                    if buf[i] == 58:
+                        first_colon = i
+                        break
+                gt_end = first_colon if first_colon >= 0 else cell_end - 1
+                # alleles separated by / or |, same rules as _classify_gt and MALFORMED_GT
+                code = GT_MISSING
+                if gt_end > cell_start:
+                    missing, malformed, differ, first, allele, n_digits, n_other = False, False, False, -1, 0, 0, 0
+                    for i in range(cell_start, gt_end + 1):
+                        if i == gt_end or buf[i] == 47 or buf[i] == 124: # / or |
+                            if n_digits == 0 or n_other > 0:
+                                missing = True
+                                # an allele is a number or a single .
+                                if n_digits > 0 or not (n_other == 1 and buf[i - 1] == 46):
+                                    malformed = True
+                            elif first < 0:
+                                first = allele
+                            elif allele != first:
+                                differ = True
+                            allele, n_digits, n_other = 0, 0, 0
+                        elif buf[i] >= 48 and buf[i] <= 57:
+                            allele = allele*10 + (buf[i] - 48)
+                            n_digits += 1
+                        else:
+                            n_other += 1
+                    if malformed:
+                        code = GT_MALFORMED
+                    elif not missing:
+                        code = GT_HET if differ else (GT_HOM_REF if first == 0 else GT_HOM_ALT)
+                gt_out[r, out] = code
+                # DP is field dp_idx and GQ the last field
+                field, field_start, dp = 0, cell_start, 0
+                for i in range(cell_start, cell_end + 1):
+                    if i == cell_end or buf[i] == 58:
+                        if field == dp_idx:
+                            valid, value = _parse_int(buf, field_start, i)
+                            dp = value if valid else DP_MALFORMED
+                        if i == cell_end:
+                            valid, value = _parse_int(buf, field_start, i)
+                            gq_out[r, out] = value if valid else GQ_MISSING
+                        field += 1
+                        field_start = i + 1
+                dp_out[r, out] = dp
+            pos += 1
+            col += 1
+
+def _split_block(lines, cols, dp_idx, gt_out, gq_out, dp_out):
+    last_col = max(cols)
+    for r, line in enumerate(lines):
+        row = line.rstrip(b'\r\n').split(b'\t', last_col + 1)
+        for out, col in enumerate(cols):
+            if col >= len(row):
+                continue
+            cell = row[col]
+            gt = cell[:cell.find(b':')]
+            code = gt_code(gt)
+            gt_out[r, out] = GT_MALFORMED if code == GT_MISSING and gt in MALFORMED_GT else code
+            parts = cell.split(b':')
+            try:
+                gq_out[r, out] = int(parts[-1])
+            except ValueError:
+                gq_out[r, out] = GQ_MISSING
+            if len(parts) > dp_idx:
+                try:
+                    dp_out[r, out] = int(parts[dp_idx])
+                except ValueError:
+                    dp_out[r, out] = DP_MALFORMED
+
+if HAVE_NUMBA:
+    _parse_int = numba.njit(cache=True)(_parse_int)
+    _scan_block_numba = numba.njit(cache=True)(_scan_block)
+else:
+    _scan_block_numba = None
+
+def parse_block(lines, cols, dp_idx=2):
+    """
+    Genotype code, GQ and DP arrays of shape (records x cols) for a list of vcf record lines (bytes).
+    Cells missing from a record are GT_MISSING with GQ_MISSING and a DP of 0, malformed GT and DP
+    fields are GT_MALFORMED and DP_MALFORMED.
+    """
+    n = len(lines)
+    gt = np.full((n, len(cols)), GT_MISSING, np.int8)
+    gq = np.full((n, len(cols)), GQ_MISSING, np.int32)
+    dp = np.zeros((n, len(cols)), np.int32)
+    if n == 0 or len(cols) == 0:
+        return gt, gq, dp
+    if active_kernel() == 'numba':
+        col_map = np.full(max(cols) + 1, -1, np.int64)
+        col_map[np.asarray(cols, np.int64)] = np.arange(len(cols))
+        lengths = np.fromiter((len(line) for line in lines), np.int64, count=n)
+        ends = np.cumsum(lengths)
+        buf = np.frombuffer(b''.join(lines), np.uint8)
+        _scan_block_numba(buf, ends - lengths, ends, col_map, dp_idx, gt, gq, dp)
+    else:
+        _split_block(lines, cols, dp_idx, gt, gq, dp)
+    return gt, gq, dp
+
+def mask_by_gq(gt, gq, dp, gq_threshold):
+    """
+    Mask the calls whose GQ is below the threshold like filter_by_gq: depth 0 and GT_MISSING.
+    Malformed genotypes are missing and malformed depths 0 as well.
+    Returns the masked genotypes, depths and the GQ pass mask.
+    """
+    gq_pass = gq >= gq_threshold
+    return np.where(gq_pass & (gt != GT_MALFORMED), gt, GT_MISSING).astype(np.int8), \
+        np.where(gq_pass & (dp != DP_MALFORMED), dp, 0).astype(np.int32), gq_pass
+
+
+if os.environ.get('X_FILTERS_KERNEL', '') != '':
+    set_kernel(os.environ['X_FILTERS_KERNEL'])
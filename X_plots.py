@@ -7,11 +7,20 @@ import logging # module to enable logging
 import numpy as np
 import time
 
+# import custom functions
+from X_filtering_functions import field_diagnostics, preview_vcf_lines, wilson_interval
+from X_kernels import GT_HET, GT_MISSING, gt_code
+
 # setup argument parser
 parser = argparse.ArgumentParser(description="Script to filter vcf files.")
 parser.add_argument('-i', '--input', type=str, default='', help='Name of input vcf file.')
 parser.add_argument('-gq', '--gq-threshold', type=int, default=20, help='GQ threshold to use (default=20).')
 parser.add_argument('--fold-change-margin', type=float, default=0.2, help='Margin around 2.0 to use for fold change check (default=0.2).')
+parser.add_argument('--sample-fraction', type=float, default=0.0, help='Preview from a uniform sample of about this fraction of the records, read at random offsets, instead of the whole file (default=0, off).')
+parser.add_argument('--sample-records', type=int, default=0, help='Preview from about this number of records read at random offsets instead of the whole file (default=0, off).')
+parser.add_argument('--seed', type=int, default=None, help='Seed of the random offsets of the preview.')
+parser.add_argument('--diagnostics-output', type=str, default='', help='Name of file to write the counts of malformed GQ, DP and GT fields per sample to (not written if none specified, a summary is always logged).')
+parser.add_argument('--verbose-fields', action='store_true', help='Log every malformed GQ, DP and GT field as it is seen.')
 parser.add_argument('--log-file', type=str, default='', help='File to write log information to (uses stdout if none specified).')
 
 # parse command line arguments
@@ -32,13 +41,14 @@ def find_genders(x, offset):
     return males, females
 
 def is_heterozygote(snp_info):
-    first_part = snp_info[:snp_info.find(':')]
-    if first_part == '0/1':
+    # phased, multi-allelic and haploid calls are classified with the interned GT table
+    code = gt_code(snp_info[:snp_info.find(':')])
+    if code == GT_HET:
         return True
-    elif first_part == '0/0' or first_part == '1/1':
-        return False
-    else:
+    elif code == GT_MISSING:
         return None
+    else:
+        return False
 
 def at_least_one_heterozygote(row, cols):
     for col in cols:
@@ -46,12 +56,13 @@ def at_least_one_heterozygote(row, cols):
             return True
     return False
 
-def is_gq_greater_than(snp_info, gq_threshold):
+def is_gq_greater_than(snp_info, gq_threshold, col=None, diagnostics=field_diagnostics):
     parts = snp_info.split(':')
     try:
         gq_value = int(parts[-1]) # we expect GQ to be the last field
     except Exception as exception:
-        logging.debug('GQ value not integer valued: %s of %s.' % (parts[-1], snp_info))
+        if diagnostics is not None:
+            diagnostics.add('GQ', 'not_integer', col, snp_info)
         return False
     return gq_value >= gq_threshold
 
@@ -76,15 +87,15 @@ def count_zygote_gt_type(row, male_cols, female_cols):
 
     return n_hm_male, n_ht_male, n_hm_female, n_ht_female
 
-def filter_by_gq(row, gq_threshold, offset, empty_str='.'):
+def filter_by_gq(row, gq_threshold, offset, empty_str='.', diagnostics=field_diagnostics):
     n = 0
     for i in range(offset, len(row)):
-        if not is_gq_greater_than(row[i], gq_threshold):
+        if not is_gq_greater_than(row[i], gq_threshold, i, diagnostics):
             n += 1
             row[i] = empty_str
     return n
 
-def dp_values(row, cols, dp_idx=2):
+def dp_values(row, cols, dp_idx=2, diagnostics=field_diagnostics):
     # get a list of the dp values for the given rows
     dp_values = []
     for col in cols:
@@ -94,12 +105,13 @@ def dp_values(row, cols, dp_idx=2):
                 dp_value = int(parts[dp_idx])
                 dp_values.append(dp_value)
             except Exception as ex:
-                logging.warning('DP value not an integer %s.' % parts[dp_idx])
+                if diagnostics is not None:
+                    diagnostics.add('DP', 'not_integer', col, row[col])
     return dp_values
 
 def calc_coverage_and_fold_change(row, male_cols, female_cols, normalise=True):
-    male_dps = np.array(dp_values(row, male_cols), np.float)
-    female_dps = np.array(dp_values(row, female_cols), np.float)
+    male_dps = np.array(dp_values(row, male_cols), float)
+    female_dps = np.array(dp_values(row, female_cols), float)
     if (len(male_dps) == 0) or (len(female_dps) == 0):
         return None, None, None
     total_dp = np.sum(male_dps) + np.sum(female_dps)
@@ -122,6 +134,7 @@ total = 0
 
 # setup logging, this will log anything info level or above
 logging.basicConfig(filename=(opts.log_file if opts.log_file != '' else None), filemode='a', level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+field_diagnostics.verbose = opts.verbose_fields
 
 logging.info('Start of plotting.')
 
@@ -146,13 +159,20 @@ coverages['filtered'] = {'male': [], 'female': []}
 coverages['excluded'] = {'male': [], 'female': []}
 
 fold_change_issue = 0
+preview = opts.sample_fraction > 0 or opts.sample_records > 0
 
 # open files for reading
 try:
-    f = open(opts.input, "r")
-    logging.info('Opened input file %s' % opts.input)
-    csv_reader = csv.reader(f, delimiter="\t")
     s = time.time()
+    if preview:
+        # only records read at random offsets, see preview_vcf_lines
+        f, n_sampled, estimated_records = preview_vcf_lines(opts.input, n_records=opts.sample_records if opts.sample_records > 0 else None,
+                                                            fraction=opts.sample_fraction if opts.sample_fraction > 0 else None, seed=opts.seed)
+        logging.info('Previewing %d records of about %d from %s' % (n_sampled, estimated_records, opts.input))
+    else:
+        f = open(opts.input, "r")
+        logging.info('Opened input file %s' % opts.input)
+    csv_reader = csv.reader(f, delimiter="\t")
     for row in csv_reader:
         if row[0].startswith("##"):
             continue
@@ -190,7 +210,16 @@ try:
                 removed += 1
     e = time.time()
     logging.info('Filtered %d/%d records leaving %d in %.2f seconds.' % (removed, total, total - removed, e-s))
-    f.close()
+    field_diagnostics.log_summary()
+    if opts.diagnostics_output != '':
+        field_diagnostics.write(opts.diagnostics_output, headers)
+    if preview:
+        low, high = wilson_interval(total - removed, total)
+        logging.info('Estimated fraction of records left %.4f (95%% CI %.4f-%.4f), about %d of %d records.' % (
+            (total - removed)/float(max(total, 1)), low, high, round((total - removed)/float(max(total, 1))*estimated_records), estimated_records))
+    else:
+        f.close()
+    preview_id = '_preview' if preview else ''
     
     # now plot the distributions
     for i, key in enumerate(fold_changes.keys()):
@@ -198,7 +227,7 @@ try:
         plt.hist(fold_changes[key], range=(0.0, 5.0), bins=20)
         plt.xlabel('fold change')
         plt.title('Dist of fold change for %s'%key)
-    plt.savefig('%s_fold_change_dist.png' % opts.input)
+    plt.savefig('%s%s_fold_change_dist.png' % (opts.input, preview_id))
 
     for i, key in enumerate(coverages.keys()):
         plt.subplot(3,1,i+1)
@@ -207,7 +236,7 @@ try:
         plt.legend(loc='best')
         plt.xlabel('coverage')
         plt.title('Dist of fold change for %s'%key)
-    plt.savefig('%s_coverage_dist.png' % opts.input)
+    plt.savefig('%s%s_coverage_dist.png' % (opts.input, preview_id))
 
 
 except IOError as ioerror:
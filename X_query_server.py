@@ -0,0 +1,254 @@
+#!/usr/bin/python
+"""
+Local query service holding a parsed vcf in memory.
+
+The vcf is read once into raw genotype code, GQ and depth arrays. Filter, fold change,
+heterozygote proportion and subset coverage queries for any GQ threshold, fold change margin
+or sample selection are then answered from the arrays over HTTP on localhost, e.g.
+
+    curl 'http://127.0.0.1:8765/filter?gq=30&margin=0.3&passing=1'
+    curl -d @sites.tsv 'http://127.0.0.1:8765/coverage?format=npy' > coverage.npy
+
+Results are returned as TSV (default) or as a numpy .npy structured array with format=npy.
+"""
+import argparse # package to help with argument parsing
+import io
+import json
+import logging # module to enable logging
+import sys
+import time
+import numpy as np
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# import custom functions
+from X_filtering_functions import *
+from X_kernels import KERNELS, set_kernel, mask_by_gq
+
+
+FILTER_HEADERS = META_HEADERS + ["passed"]
+
+
+def parse_site(line):
+    """
+    Contig and position of a site line, tab separated or contig:position. The position is split
+    off at the last ':' so contig names holding a ':' themselves stay whole.
+    """
+    if '\t' in line:
+        return line.split('\t')[:2]
+    return line.rsplit(':', 1)
+
+
+class CohortQueries(object):
+    """
+    Queries over a cohort read with read_vcf_arrays(..., gq_threshold=None).
+    The GQ masked arrays and depth totals of the most recently used thresholds are cached.
+    Every query takes the parsed query string and the request body and returns the column
+    names and a list of equally long columns.
+    """
+    endpoints = ['filter', 'fold_change', 'heterozygosity', 'coverage']
+
+    def __init__(self, cohort, gq_threshold=20, n_cached=4):
+        self.cohort = cohort
+        self.gq_threshold = gq_threshold
+        self.n_cached = n_cached
+        self.masked_cache = OrderedDict()
+        self.contig_ids = dict((contig, i) for i, contig in enumerate(cohort['contigs']))
+        self.loci = np.array(cohort['contigs'], object)
+        # sorted (contig, position) keys to look up sites
+        keys = cohort['contig_idx'].astype(np.int64) << 40 | cohort['positions']
+        self.key_order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.key_order]
+
+    def masked(self, gq_threshold):
+        if gq_threshold not in self.masked_cache:
+            gt, dp, gq_pass = mask_by_gq(self.cohort['gt'], self.cohort['gq'], self.cohort['dp'], gq_threshold)
+            self.masked_cache[gq_threshold] = (gt, dp, gq_pass, dp.sum(axis=0, dtype=np.int64))
+            while len(self.masked_cache) > self.n_cached:
+                self.masked_cache.popitem(last=False)
+        self.masked_cache.move_to_end(gq_threshold)
+        return self.masked_cache[gq_threshold]
+
+    def samples(self, params):
+        # male and female sample indexes after the include/exclude selection
+        samples = self.cohort['samples']
+        reverse = params.get('reverse', '0') not in ['0', 'false', '']
+        male_idx, female_idx = find_genders(samples, offset=0, reverse=reverse)
+        include = params['include'].split(',') if params.get('include', '') != '' else None
+        exclude = params['exclude'].split(',') if params.get('exclude', '') != '' else None
+        return (select_columns(samples, 0, male_idx, include, exclude),
+                select_columns(samples, 0, female_idx, include, exclude))
+
+    def rows(self, params, body=b''):
+        # rows of the contig given, of the sites listed in the body, or every row
+        rows = np.arange(len(self.cohort['positions']))
+        if params.get('contig', '') != '':
+            if params['contig'] not in self.contig_ids:
+                raise ValueError('Unknown contig %s.' % params['contig'])
+            rows = np.flatnonzero(self.cohort['contig_idx'] == self.contig_ids[params['contig']])
+        sites = [parse_site(line) for line in body.decode().splitlines() if line.strip() != '']
+        if params.get('sites', '') != '':
+            sites += [parse_site(site) for site in params['sites'].split(',')]
+        if sites:
+            keys = np.array([self.contig_ids[contig] << 40 | int(position) for contig, position in sites
+                             if contig in self.contig_ids], np.int64)
+            found = np.minimum(np.searchsorted(self.sorted_keys, keys), max(len(self.sorted_keys) - 1, 0))
+            found = found[self.sorted_keys[found] == keys] if len(self.sorted_keys) else found[:0]
+            rows = np.intersect1d(rows, self.key_order[found])
+        return rows
+
+    def site_columns(self, rows):
+        return [self.loci[self.cohort['contig_idx'][rows]], self.cohort['positions'][rows]]
+
+    def filter(self, params, body=b''):
+        gt, dp, gq_pass, totals = self.masked(int(params.get('gq', self.gq_threshold)))
+        male_idx, female_idx = self.samples(params)
+        rows = self.rows(params, body)
+        results = filter_results(gt[rows], dp[rows], gq_pass[rows], male_idx, female_idx, totals,
+                                 float(params.get('margin', 0.2)))
+        columns = self.site_columns(rows) + [results[name] for name in FILTER_HEADERS[2:]]
+        if params.get('passing', '0') not in ['0', 'false', '']:
+            columns = [column[results['passed']] for column in columns]
+        return FILTER_HEADERS, columns
+
+    def fold_change(self, params, body=b''):
+        headers, columns = self.filter(params, body)
+        keep = [0, 1, 8, 9, 10, 11]
+        return [headers[i] for i in keep], [columns[i] for i in keep]
+
+    def heterozygosity(self, params, body=b''):
+        # proportion of heterozygote calls among the called males and females, SNPs where both are called
+        gt = self.masked(int(params.get('gq', self.gq_threshold)))[0]
+        male_idx, female_idx = self.samples(params)
+        rows = self.rows(params, body)
+        columns = self.site_columns(rows)
+        for idx in [male_idx, female_idx]:
+            sample_gt = gt[rows][:, idx]
+            n_called = np.sum(sample_gt != GT_MISSING, axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                columns.append(np.sum(sample_gt == GT_HET, axis=1)/n_called.astype(float))
+        keep = ~np.isnan(columns[2]) & ~np.isnan(columns[3])
+        return ['locus', 'position', 'male_hz', 'female_hz'], [column[keep] for column in columns]
+
+    def coverage(self, params, body=b''):
+        headers, columns = self.filter(params, body)
+        return headers[:2] + headers[8:10], columns[:2] + columns[8:10]
+
+    def info(self):
+        return {'samples': self.cohort['samples'], 'contigs': self.cohort['contigs'],
+                'n_snps': len(self.cohort['positions']), 'gq_threshold': self.gq_threshold,
+                'cached_gq_thresholds': list(self.masked_cache)}
+
+
+def write_table(f, headers, columns, table_format='tsv', chunk_rows=65536):
+    """
+    Write the columns to the binary file f as TSV, streamed a chunk of rows at a time,
+    or as a .npy structured array.
+    """
+    n_rows = len(columns[0]) if columns else 0
+    if table_format == 'npy':
+        dtypes = [(name, column.dtype if column.dtype != object else 'U%d' % max([len(v) for v in column] + [1]))
+                  for name, column in zip(headers, columns)]
+        table = np.empty(n_rows, dtypes)
+        for name, column in zip(headers, columns):
+            table[name] = column
+        buffer = io.BytesIO()
+        np.save(buffer, table)
+        f.write(buffer.getvalue())
+        return n_rows
+    if table_format != 'tsv':
+        raise ValueError('Unknown format %s, expected tsv or npy.' % table_format)
+    f.write(('\t'.join(headers) + '\n').encode())
+    for start in range(0, n_rows, chunk_rows):
+        chunk = [column[start:start + chunk_rows].tolist() for column in columns]
+        f.write(''.join('\t'.join(map(str, row)) + '\n' for row in zip(*chunk)).encode())
+    return n_rows
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    queries = None
+
+    def do_GET(self):
+        self.answer(b'')
+
+    def do_POST(self):
+        self.answer(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+    def answer(self, body):
+        s = time.time()
+        url = urlparse(self.path)
+        params = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+        endpoint = url.path.strip('/')
+        if endpoint == 'info':
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(self.queries.info()).encode())
+            return
+        if endpoint not in self.queries.endpoints:
+            self.send_error(404, 'Unknown query %s, expected one of info, %s.' % (endpoint, ', '.join(self.queries.endpoints)))
+            return
+        table_format = params.get('format', 'tsv')
+        try:
+            if table_format not in ['tsv', 'npy']:
+                raise ValueError('Unknown format %s, expected tsv or npy.' % table_format)
+            headers, columns = getattr(self.queries, endpoint)(params, body)
+        except (ValueError, KeyError) as error:
+            self.send_error(400, str(error))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/tab-separated-values' if table_format == 'tsv' else 'application/octet-stream')
+        self.end_headers()
+        n_rows = write_table(self.wfile, headers, columns, table_format)
+        e = time.time()
+        logging.info('Answered %s with %d rows in %.3f seconds.' % (self.path, n_rows, e-s))
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+def make_server(queries, host='127.0.0.1', port=8765):
+    handler = type('CohortQueryHandler', (QueryHandler,), {'queries': queries})
+    return HTTPServer((host, port), handler)
+
+
+# only run following code if was called from command line
+if __name__ == '__main__':
+    # setup argument parser
+    parser = argparse.ArgumentParser(description="Script to load a vcf file once and answer filter queries over it on localhost.")
+    parser.add_argument('-i', '--input', type=str, default='', help='Name of input vcf file.')
+    parser.add_argument('-gq', '--gq-threshold', type=int, default=20, help='GQ threshold used when a query does not give one (default=20).')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on (default=127.0.0.1).')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on (default=8765).')
+    parser.add_argument('--max-memory', type=str, default='', help='Memory budget used to size the blocks of records parsed together, e.g. 2G or 500M (default=blocks of 10000 records).')
+    parser.add_argument('--kernel', type=str, default='auto', choices=KERNELS, help='Record parsing kernel, auto uses numba when installed (default=auto).')
+    parser.add_argument('--log-file', type=str, default='', help='File to write log information to (uses stdout if none specified).')
+
+    # parse command line arguments
+    opts = parser.parse_args(sys.argv[1:])
+
+    # config values
+    individual_start_col = 9
+
+    # setup logging, this will log anything info level or above
+    logging.basicConfig(filename=(opts.log_file if opts.log_file != '' else None), filemode='a', level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+
+    set_kernel(opts.kernel)
+
+    try:
+        s = time.time()
+        max_memory = parse_memory_size(opts.max_memory) if opts.max_memory != '' else None
+        cohort = read_vcf_arrays(opts.input, individual_start_col, None, max_memory=max_memory)
+        e = time.time()
+        logging.info('Loaded %d snps x %d samples in %.2f seconds.' % (cohort['dp'].shape[0], cohort['dp'].shape[1], e-s))
+    except IOError as ioerror:
+        logging.error('Problem opening files: ' + str(ioerror))
+        sys.exit(-1)
+
+    server = make_server(CohortQueries(cohort, opts.gq_threshold), opts.host, opts.port)
+    logging.info('Answering queries on http://%s:%d/' % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info('Stopped.')
+    server.server_close()
@@ -0,0 +1,257 @@
+#!/usr/bin/python
+"""
+Filter outputs and plots of a vcf file from a single scan.
+
+The records are parsed once. The GQ masked depths are spilled to a raw int32 file and the
+GQ masked text of the records without a male heterozygote to a candidates file, while the
+genotype counts and heterozygote proportions are kept per SNP. Once the depth totals are known
+the filtered vcf, meta file, summaries, fold change and coverage histograms (as plot_hist_coverage.py)
+and heterozygote proportions (as Compare_Male_HZ_to_Female_Hz.py) all come from the spilled files.
+"""
+import argparse # package to help with argument parsing
+import csv
+import logging # module to enable logging
+import os
+import sys
+import time
+from array import array
+import numpy as np
+
+# import custom functions
+from X_filtering_functions import *
+from X_kernels import KERNELS, set_kernel
+
+
+COUNT_NAMES = ["n_male_homozygote", "n_male_heterozygote", "n_female_homozygote", "n_female_heterozygote", "n_gq_filtered"]
+
+
+def scan_vcf(f, individual_start_col, used_cols, male_idx, female_idx, gq_threshold, fd, candidate_writer, max_memory=None):
+    """
+    Single scan of the records of f (binary, positioned anywhere before the first record).
+    Writes the masked depths to fd and the masked candidate records through candidate_writer,
+    the malformed GQ, DP and GT fields are counted in field_diagnostics.
+    Returns the depth totals and a dict of per SNP arrays.
+    """
+    last_col = max(used_cols) if used_cols else individual_start_col - 1
+    totals = np.zeros(len(used_cols), np.int64)
+    contigs, contig_ids = [], {}
+    scan = {'contig_idx': array('i'), 'positions': [], 'male_hz': array('d'), 'female_hz': array('d')}
+    for name in COUNT_NAMES:
+        scan[name] = array('q')
+    for lines in iter_vcf_blocks(f, max_memory=max_memory, n_samples=len(used_cols)):
+        gt, gq, dp = parse_block(lines, used_cols)
+        field_diagnostics.add_block(lines, used_cols, gt, gq, dp, gq_threshold)
+        gt, dp, gq_pass = mask_by_gq(gt, gq, dp, gq_threshold)
+        dp.tofile(fd)
+        totals += dp.sum(axis=0)
+        counts = genotype_summary(gt, gq_pass, male_idx, female_idx)
+        for name in COUNT_NAMES:
+            scan[name].frombytes(counts[name].astype(np.int64).tobytes())
+        # heterozygote proportions among the called males and females
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for sex in ['male', 'female']:
+                n_het, n_hom = counts['n_%s_heterozygote' % sex], counts['n_%s_homozygote' % sex]
+                scan['%s_hz' % sex].frombytes((n_het/(n_het + n_hom).astype(float)).tobytes())
+        for i, line in enumerate(lines):
+            locus, position = line.split(b'\t', 2)[:2]
+            if locus not in contig_ids:
+                contig_ids[locus] = len(contigs)
+                contigs.append(locus.decode())
+            scan['contig_idx'].append(contig_ids[locus])
+            scan['positions'].append(position.decode())
+            if not counts['is_male_heterozygote'][i]:
+                row = split_projected(line.decode(), last_col)
+                filter_by_gq(row, gq_threshold, offset=individual_start_col, cols=used_cols, diagnostics=None)
+                candidate_writer.writerow(unsplit_projected(row, last_col))
+    scan['contigs'] = contigs
+    for name in COUNT_NAMES + ['contig_idx', 'male_hz', 'female_hz']:
+        scan[name] = np.frombuffer(scan[name], scan[name].typecode) if len(scan[name]) else np.zeros(0, scan[name].typecode)
+    scan['is_male_heterozygote'] = scan['n_male_heterozygote'] > 0
+    return totals, scan
+
+def spilled_coverage(dp_file, n_snps, n_cols, male_idx, female_idx, totals, chunk_rows=65536):
+    """
+    Normalised mean male and female coverage and fold change of every SNP from the spilled depths.
+    """
+    male_mean_coverage, female_mean_coverage, fold_change = [np.full(n_snps, np.nan) for i in range(3)]
+    if n_snps == 0 or n_cols == 0:
+        return male_mean_coverage, female_mean_coverage, fold_change
+    dp = np.memmap(dp_file, np.int32, 'r', shape=(n_snps, n_cols))
+    for start in range(0, n_snps, chunk_rows):
+        chunk = slice(start, start + chunk_rows)
+        male_mean_coverage[chunk], female_mean_coverage[chunk], fold_change[chunk] = coverage_and_fold_change_matrix(
+            dp[chunk], male_idx, female_idx, totals, normalise=True, ttest=False)[:3]
+    del dp
+    return male_mean_coverage, female_mean_coverage, fold_change
+
+
+# only run following code if was called from command line
+if __name__ == '__main__':
+    # setup argument parser
+    parser = argparse.ArgumentParser(description="Script to filter a vcf file and write its plots and tables from a single scan.")
+    parser.add_argument('-i', '--input', type=str, default='', help='Name of input vcf file.')
+    parser.add_argument('-o', '--output', type=str, default='', help='Name of output vcf file.')
+    parser.add_argument('-m', '--meta-output', type=str, default='', help='Name of meta data output file.')
+    parser.add_argument('-p', '--plot-prefix', type=str, default='', help='Prefix of the plots and heterozygote values file (default=input file name).')
+    parser.add_argument('-gq', '--gq-threshold', type=int, default=20, help='GQ threshold to use (default=20).')
+    parser.add_argument('--fold-change-margin', type=float, default=0.2, help='Margin around 2.0 to use for fold change check (default=0.2).')
+    parser.add_argument('--log-file', type=str, default='', help='File to write log information to (uses stdout if none specified).')
+    parser.add_argument('-r', '--reverse', action='store_true', help='Interchange the labels on the males and females.')
+    parser.add_argument('--include-samples', type=str, default='', help='Comma separated sample names, or a file with one per line, to restrict the analysis to.')
+    parser.add_argument('--exclude-samples', type=str, default='', help='Comma separated sample names, or a file with one per line, to leave out of the analysis.')
+    parser.add_argument('--kernel', type=str, default='auto', choices=KERNELS, help='Record parsing kernel, auto uses numba when installed (default=auto).')
+    parser.add_argument('--max-memory', type=str, default='', help='Memory budget used to size the blocks of records processed together, e.g. 2G or 500M (default=blocks of 10000 records).')
+    parser.add_argument('-s', '--scaffold-output', type=str, default='', help='Name of per scaffold summary output file (not written if none specified).')
+    parser.add_argument('-q', '--quantile-output', type=str, default='', help='Name of fold change and coverage quantile summary output file (not written if none specified).')
+    parser.add_argument('-w', '--window-output', type=str, default='', help='Name of sliding window fold change profile output file (not written if none specified).')
+    parser.add_argument('--diagnostics-output', type=str, default='', help='Name of file to write the counts of malformed GQ, DP and GT fields per sample to (not written if none specified, a summary is always logged).')
+    parser.add_argument('--verbose-fields', action='store_true', help='Log every malformed GQ, DP and GT field as it is seen.')
+    parser.add_argument('--window-sizes', type=str, default='100kb', help='Comma separated window sizes for the profile, in bp (e.g. 10kb, 1mb) or SNPs (e.g. 50snp); windows start every half window (default=100kb).')
+
+    # parse command line arguments
+    opts = parser.parse_args(sys.argv[1:])
+
+    # config values
+    individual_start_col = 9
+    plot_prefix = opts.plot_prefix if opts.plot_prefix != '' else os.path.basename(opts.input)
+
+    scaffold_summary = ScaffoldSummary() if opts.scaffold_output != '' else None
+    distribution_summary = DistributionSummary() if opts.quantile_output != '' else None
+    window_profile = WindowProfile() if opts.window_output != '' else None
+    window_sizes = parse_window_sizes(opts.window_sizes)
+
+    # setup logging, this will log anything info level or above
+    logging.basicConfig(filename=(opts.log_file if opts.log_file != '' else None), filemode='a', level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+    field_diagnostics.verbose = opts.verbose_fields
+
+    logging.info('Start of report.')
+
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError as ex:
+        logging.error('Problem importing plotting library.' + str(ex))
+        sys.exit(-1)
+
+    set_kernel(opts.kernel)
+    max_memory = parse_memory_size(opts.max_memory) if opts.max_memory != '' else None
+
+    dp_file = opts.meta_output + '.dp.tmp'
+    candidates_file = opts.output + '.candidates.tmp'
+    try:
+        headers = read_vcf_header(opts.input)
+        individuals = headers[individual_start_col:]
+        male_cols, female_cols = find_genders(individuals, offset=individual_start_col, reverse=opts.reverse)
+        include_samples, exclude_samples = read_sample_list(opts.include_samples), read_sample_list(opts.exclude_samples)
+        male_cols = select_columns(individuals, individual_start_col, male_cols, include_samples, exclude_samples)
+        female_cols = select_columns(individuals, individual_start_col, female_cols, include_samples, exclude_samples)
+        used_cols = sorted(male_cols + female_cols)
+        position = dict((col, i) for i, col in enumerate(used_cols))
+        male_idx, female_idx = [position[col] for col in male_cols], [position[col] for col in female_cols]
+        logging.info('Using %d male and %d female samples of %d.' % (len(male_cols), len(female_cols), len(individuals)))
+
+        # the one scan over the vcf
+        s = time.time()
+        with open(opts.input, 'rb') as f, open(dp_file, 'wb') as fd, open(candidates_file, 'w') as fc:
+            logging.info('Opened input file %s' % opts.input)
+            totals, scan = scan_vcf(f, individual_start_col, used_cols, male_idx, female_idx, opts.gq_threshold, fd,
+                                    csv.writer(fc, delimiter="\t"), max_memory=max_memory)
+        n_snps = len(scan['positions'])
+        e = time.time()
+        logging.info('Scanned %d records in %.2f seconds.' % (n_snps, e-s))
+        field_diagnostics.log_summary()
+        if opts.diagnostics_output != '':
+            field_diagnostics.write(opts.diagnostics_output, headers)
+
+        s = time.time()
+        male_mean_coverage, female_mean_coverage, fold_change = spilled_coverage(dp_file, n_snps, len(used_cols), male_idx, female_idx, totals)
+        fold_change_in_range = fold_change_in_range_array(fold_change, opts.fold_change_margin)
+        # with a male or female total of 0 the coverage is undefined, None in the meta file as in X_filtering.py
+        coverage_defined = not (np.any(totals[male_idx] == 0) or np.any(totals[female_idx] == 0))
+        passed = ~scan['is_male_heterozygote'] & fold_change_in_range
+
+        with open(opts.output, 'w') as fw, open(opts.meta_output, 'w') as fm, open(candidates_file, newline='') as fc:
+            logging.info('Opened output file %s' % opts.output)
+            logging.info('Opened output meta file %s' % opts.meta_output)
+            csv.writer(fw, delimiter="\t").writerow(headers)
+            csv_meta_writer = csv.writer(fm, delimiter="\t")
+            csv_meta_writer.writerow(META_HEADERS)
+            for i in range(n_snps):
+                locus, pos = scan['contigs'][scan['contig_idx'][i]], scan['positions'][i]
+                is_male_heterozygote = bool(scan['is_male_heterozygote'][i])
+                if coverage_defined:
+                    values = [male_mean_coverage[i], female_mean_coverage[i], fold_change[i], bool(fold_change_in_range[i])]
+                else:
+                    values = [None, None, None, None]
+                if not is_male_heterozygote:
+                    line = fc.readline()
+                    if passed[i]:
+                        fw.write(line)
+                if scaffold_summary is not None:
+                    scaffold_summary.add(locus, is_male_heterozygote, values[0], values[1], values[2], values[3], bool(passed[i]))
+                if distribution_summary is not None:
+                    distribution_summary.add(*values)
+                if window_profile is not None:
+                    window_profile.add(locus, pos, values[0], values[1])
+                csv_meta_writer.writerow([locus, pos, is_male_heterozygote] + [scan[name][i] for name in COUNT_NAMES] + values)
+        total, removed = n_snps, n_snps - int(passed.sum())
+        e = time.time()
+        logging.info('Filtered %d/%d records leaving %d in %.2f seconds.' % (removed, total, total - removed, e-s))
+
+        if scaffold_summary is not None:
+            scaffold_summary.write(opts.scaffold_output)
+            logging.info('Wrote summary of %d scaffolds to %s' % (len(scaffold_summary.contigs), opts.scaffold_output))
+        if distribution_summary is not None:
+            distribution_summary.write(opts.quantile_output)
+            logging.info('Wrote quantile summary to %s' % opts.quantile_output)
+        if window_profile is not None:
+            window_profile.write(opts.window_output, window_sizes)
+            logging.info('Wrote fold change profile of %d window sizes to %s' % (len(window_sizes), opts.window_output))
+
+        # fold change and coverage distributions of all, in range and out of range SNPs
+        determined = ~np.isnan(fold_change)
+        groups = {'all': determined, 'filtered': determined & fold_change_in_range, 'excluded': determined & ~fold_change_in_range}
+        plt.figure()
+        for i, key in enumerate(['all', 'filtered', 'excluded']):
+            plt.subplot(3,1,i+1)
+            plt.hist(fold_change[groups[key]], range=(0.0, 5.0), bins=50)
+            plt.xlabel('fold change')
+            plt.title('Dist of fold change for %s'%key)
+        plt.savefig('%s_fold_change_dist.png' % plot_prefix)
+        plt.close()
+
+        plt.figure()
+        for i, key in enumerate(['all', 'filtered', 'excluded']):
+            plt.subplot(3,1,i+1)
+            plt.hist(male_mean_coverage[groups[key]], bins=100, label='male', alpha=0.5)
+            plt.hist(female_mean_coverage[groups[key]], bins=100, label='female', alpha=0.5)
+            plt.legend(loc='best')
+            plt.xlabel('coverage')
+            plt.title('Dist of coverage for %s'%key)
+        plt.savefig('%s_coverage_dist.png' % plot_prefix)
+        plt.close()
+
+        # heterozygote proportions of the SNPs with called males and females
+        keep = np.flatnonzero(~np.isnan(scan['male_hz']) & ~np.isnan(scan['female_hz']))
+        plt.figure()
+        plt.plot(scan['female_hz'][keep], scan['male_hz'][keep], marker='o', ls='none')
+        plt.xlabel('female')
+        plt.ylabel('male')
+        plt.title('Heterzygote proportion')
+        plt.savefig('%s_heterozygote_scatter.png' % plot_prefix)
+        plt.close()
+
+        with open('%s_heterozygote_values.csv' % plot_prefix, 'w') as f:
+            csv_writer = csv.writer(f)
+            csv_writer.writerow(['consensus', 'position', 'male_hz', 'female_hz'])
+            for i in keep:
+                csv_writer.writerow([scan['contigs'][scan['contig_idx'][i]], scan['positions'][i], float(scan['male_hz'][i]), float(scan['female_hz'][i])])
+        logging.info('Wrote plots and heterozygote values of %d snps with prefix %s' % (len(keep), plot_prefix))
+        logging.info('Peak memory use %.1f MB.' % (peak_rss() / 1024.0**2))
+    except IOError as ioerror:
+        logging.error('Problem opening files: ' + str(ioerror))
+    finally:
+        for tmp_file in [dp_file, candidates_file]:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
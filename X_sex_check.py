@@ -0,0 +1,125 @@
+#!/usr/bin/python
+"""
+Quick check of the sample sex labels against the data, run before the full filter.
+
+A few thousand records are read from random offsets of the vcf. Candidate X linked sites
+are picked with the labels (fold change near 2 and few male heterozygotes) and every sample's
+normalised depth and heterozygosity on them is compared with the female samples. Males are
+expected at about half the female depth with no heterozygotes, so a sample whose data points
+the other way is flagged.
+"""
+import argparse # package to help with argument parsing
+import csv
+import logging # module to enable logging
+import sys
+import time
+import numpy as np
+
+# import custom functions
+from X_filtering_functions import *
+from X_kernels import KERNELS, set_kernel
+
+
+SEX_CHECK_HEADERS = ["sample", "label", "n_called", "heterozygosity", "depth_ratio", "inferred", "contradicts_label"]
+
+# fewest candidate sites to infer the sex from
+MIN_SITES = 20
+
+
+def sex_check(lines, samples, male_idx, female_idx, cols, gq_threshold, fold_change_margin=0.5,
+              max_male_heterozygosity=0.2, female_depth_ratio=0.75, min_sites=MIN_SITES):
+    """
+    Rows of SEX_CHECK_HEADERS for every sample from a list of vcf record lines (bytes).
+    male_idx/female_idx index the samples (and cols, their vcf columns). The depth ratio is the mean
+    normalised depth of a sample on the candidate sites over the median of the female samples.
+    Returns the rows and the number of candidate sites; nothing is inferred with fewer than min_sites.
+    """
+    gt, gq, dp = parse_block(lines, cols)
+    gt, dp, gq_pass = mask_by_gq(gt, gq, dp, gq_threshold)
+    totals = dp.sum(axis=0, dtype=np.int64)
+    labels = dict([(i, 'm') for i in male_idx] + [(i, 'f') for i in female_idx])
+    # samples without any depth in the sampled records can't be checked
+    male_idx = [i for i in male_idx if totals[i] > 0]
+    female_idx = [i for i in female_idx if totals[i] > 0]
+
+    # candidate X linked sites, a few heterozygous males are allowed for the mislabelled females
+    male_gt = gt[:, male_idx]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        male_heterozygosity = np.sum(male_gt == GT_HET, axis=1)/np.sum(male_gt != GT_MISSING, axis=1).astype(float)
+    fold_change = coverage_and_fold_change_matrix(dp, male_idx, female_idx, totals, ttest=False)[2]
+    candidates = fold_change_in_range_array(fold_change, fold_change_margin) & ~(male_heterozygosity > max_male_heterozygosity)
+    n_sites = int(candidates.sum())
+
+    candidate_gt = gt[candidates]
+    n_called = np.sum(candidate_gt != GT_MISSING, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        heterozygosity = np.sum(candidate_gt == GT_HET, axis=0)/n_called.astype(float)
+        depth = (dp[candidates]/totals.astype(float)).mean(axis=0) * 1000000
+        depth_ratio = depth/np.median(depth[female_idx]) if female_idx else np.full(len(samples), np.nan)
+
+    rows = []
+    for i, sample in enumerate(samples):
+        label, inferred = labels.get(i, ''), None
+        if n_sites >= min_sites and totals[i] > 0 and np.isfinite(depth_ratio[i]):
+            female = depth_ratio[i] >= female_depth_ratio or heterozygosity[i] > max_male_heterozygosity
+            inferred = 'f' if female else 'm'
+        rows.append([sample, label, n_called[i], heterozygosity[i], depth_ratio[i], inferred,
+                     label != '' and inferred is not None and inferred != label])
+    return rows, n_sites
+
+
+# only run following code if was called from command line
+if __name__ == '__main__':
+    # setup argument parser
+    parser = argparse.ArgumentParser(description="Script to check the sample sex labels of a vcf file against a sample of its records.")
+    parser.add_argument('-i', '--input', type=str, default='', help='Name of input vcf file.')
+    parser.add_argument('-o', '--output', type=str, default='', help='Name of per sample output file (not written if none specified).')
+    parser.add_argument('-n', '--sample-records', type=int, default=5000, help='Number of records to read from random offsets (default=5000).')
+    parser.add_argument('--seed', type=int, default=None, help='Seed of the random offsets.')
+    parser.add_argument('-gq', '--gq-threshold', type=int, default=20, help='GQ threshold to use (default=20).')
+    parser.add_argument('--fold-change-margin', type=float, default=0.5, help='Margin around 2.0 of the fold change of candidate X linked sites (default=0.5).')
+    parser.add_argument('--max-male-heterozygosity', type=float, default=0.2, help='Largest proportion of heterozygous male calls at a candidate site, and of a male sample over the sites (default=0.2).')
+    parser.add_argument('-r', '--reverse', action='store_true', help='Interchange the labels on the males and females.')
+    parser.add_argument('--strict', action='store_true', help='Exit with an error when a sample contradicts its label.')
+    parser.add_argument('--kernel', type=str, default='auto', choices=KERNELS, help='Record parsing kernel, auto uses numba when installed (default=auto).')
+    parser.add_argument('--log-file', type=str, default='', help='File to write log information to (uses stdout if none specified).')
+
+    # parse command line arguments
+    opts = parser.parse_args(sys.argv[1:])
+
+    # config values
+    individual_start_col = 9
+
+    # setup logging, this will log anything info level or above
+    logging.basicConfig(filename=(opts.log_file if opts.log_file != '' else None), filemode='a', level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+
+    set_kernel(opts.kernel)
+
+    try:
+        s = time.time()
+        headers = read_vcf_header(opts.input)
+        samples = headers[individual_start_col:]
+        male_idx, female_idx = find_genders(samples, offset=0, reverse=opts.reverse)
+        lines, estimated_records = sample_vcf_records(opts.input, opts.sample_records, seed=opts.seed)
+        rows, n_sites = sex_check(lines, samples, male_idx, female_idx, list(range(individual_start_col, len(headers))),
+                                  opts.gq_threshold, opts.fold_change_margin, opts.max_male_heterozygosity)
+        e = time.time()
+        logging.info('Checked %d samples on %d candidate X linked sites of %d records sampled from about %d in %.2f seconds.' % (len(samples), n_sites, len(lines), estimated_records, e-s))
+        if n_sites < MIN_SITES:
+            logging.warning('Too few candidate X linked sites to check the labels, try more --sample-records.')
+        n_contradicting = 0
+        for sample, label, n_called, heterozygosity, depth_ratio, inferred, contradicts_label in rows:
+            if contradicts_label:
+                n_contradicting += 1
+                logging.warning('Sample %s is labelled %s but looks %s (depth ratio %.2f, heterozygosity %.2f).' % (sample, label, inferred, depth_ratio, heterozygosity))
+        if opts.output != '':
+            with open(opts.output, 'w') as f:
+                csv_writer = csv.writer(f, delimiter="\t")
+                csv_writer.writerow(SEX_CHECK_HEADERS)
+                csv_writer.writerows(rows)
+            logging.info('Wrote sex check of %d samples to %s' % (len(rows), opts.output))
+        if n_contradicting and opts.strict:
+            sys.exit(1)
+    except IOError as ioerror:
+        logging.error('Problem opening files: ' + str(ioerror))
+        sys.exit(-1)
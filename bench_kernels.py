@@ -0,0 +1,87 @@
+#!/usr/bin/python
+"""
+Benchmark of the record parsing kernels against the reference helpers.
+
+Parses a vcf (or a synthetic one) with filter_by_gq/dp_values/genotype_code and with every
+available X_kernels kernel, checks they give identical arrays and reports the time of each.
+"""
+import argparse # package to help with argument parsing
+import sys
+import time
+import numpy as np
+
+# import custom functions
+from X_filtering_functions import *
+import X_kernels
+
+
+def synthetic_lines(n_records, n_samples, seed=0):
+    rng = np.random.RandomState(seed)
+    gts = np.array(['0/0', '0/1', '1/1', './.'])
+    lines = []
+    for i in range(n_records):
+        gt = gts[rng.randint(0, 4, n_samples)]
+        dp = rng.randint(0, 80, n_samples)
+        gq = rng.randint(0, 100, n_samples)
+        cells = ['%s:0,%d,%d:%d:0:%d' % (gt[j], dp[j], 2*dp[j], dp[j], gq[j]) for j in range(n_samples)]
+        lines.append(('contig_%d\t%d\t.\tA\tC\t99\t.\t.\tGT:PL:DP:SP:GQ\t' % (i//1000, i) + '\t'.join(cells) + '\n').encode())
+    return lines
+
+def reference_block(lines, cols, gq_threshold):
+    gt = np.full((len(lines), len(cols)), GT_MISSING, np.int8)
+    dp = np.zeros((len(lines), len(cols)), np.int32)
+    for r, line in enumerate(lines):
+        row = line.decode().rstrip('\r\n').split('\t')
+        filter_by_gq(row, gq_threshold, offset=cols[0], cols=cols)
+        for out, col in enumerate(cols):
+            gt[r, out] = genotype_code(row[col])
+            individual_dp = dp_values(row, [col])
+            dp[r, out] = individual_dp[0] if individual_dp else 0
+    return gt, dp
+
+
+# only run following code if was called from command line
+if __name__ == '__main__':
+    # setup argument parser
+    parser = argparse.ArgumentParser(description="Benchmark of the record parsing kernels.")
+    parser.add_argument('-i', '--input', type=str, default='', help='Name of input vcf file (synthetic records if none specified).')
+    parser.add_argument('-n', '--n-records', type=int, default=2000, help='Number of synthetic records (default=2000).')
+    parser.add_argument('--n-samples', type=int, default=500, help='Number of synthetic samples (default=500).')
+    parser.add_argument('-gq', '--gq-threshold', type=int, default=20, help='GQ threshold to use (default=20).')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of timed repeats, the best is reported (default=3).')
+
+    # parse command line arguments
+    opts = parser.parse_args(sys.argv[1:])
+
+    # config values
+    individual_start_col = 9
+
+    if opts.input != '':
+        with open(opts.input, 'rb') as f:
+            lines = [line for line in f if not line.startswith(b'#')]
+    else:
+        lines = synthetic_lines(opts.n_records, opts.n_samples)
+    cols = list(range(individual_start_col, len(lines[0].split(b'\t'))))
+
+    timings = {}
+    s = time.time()
+    expected_gt, expected_dp = reference_block(lines, cols, opts.gq_threshold)
+    timings['reference'] = time.time() - s
+    for kernel in ['python'] + (['numba'] if X_kernels.HAVE_NUMBA else []):
+        X_kernels.set_kernel(kernel)
+        X_kernels.parse_block(lines[:2], cols) # compile/warm up
+        best = None
+        for i in range(opts.repeats):
+            s = time.time()
+            gt, gq, dp = X_kernels.parse_block(lines, cols)
+            gt, dp, gq_pass = X_kernels.mask_by_gq(gt, gq, dp, opts.gq_threshold)
+            e = time.time() - s
+            best = e if best is None else min(best, e)
+        if not (np.array_equal(gt, expected_gt) and np.array_equal(dp, expected_dp)):
+            print('Kernel %s does not match the reference helpers.' % kernel)
+            sys.exit(-1)
+        timings[kernel] = best
+
+    print('%d records x %d samples' % (len(lines), len(cols)))
+    for kernel, t in timings.items():
+        print('%-10s %8.3f s %8.1fx' % (kernel, t, timings['reference']/t))
@@ -7,20 +7,8 @@ import logging # module to enable logging
 import numpy as np
 import time
 
-# setup argument parser
-parser = argparse.ArgumentParser(description="Script to filter vcf files.")
-parser.add_argument('-i', '--input', type=str, default='', help='Name of input vcf file.')
-parser.add_argument('-o', '--output-id', type=str, default='', help='Identifying string to put in output filenames.')
-parser.add_argument('--fold-change-margin', type=float, default=0.2, help='Margin around 2.0 to use for fold change check (default=0.2).')
-parser.add_argument('--log-file', type=str, default='', help='File to write log information to (uses stdout if none specified).')
-parser.add_argument('-r', '--reverse', action='store_true', help='Interchange the labels on the males and females.')
-parser.add_argument('-d', '--duplicates', action='store_true', help='Look at duplicated columns instead.')
-
-# parse command line arguments
-opts = parser.parse_args(sys.argv[1:])
-
-# config values
-individual_start_col = 4
+# import custom functions
+from X_filtering_functions import WindowProfile, parse_window_sizes, write_sample_depths
 
 
 # define useful functions
@@ -38,122 +26,157 @@ def find_genders(x, offset, reverse=False):
         return males, females
 
 
-def calc_coverage_and_fold_change(coverage_values, male_cols, female_cols, normalise=True):
-    male_dps = np.array(coverage_values, np.float)[male_cols]
-    female_dps = np.array(coverage_values, np.float)[female_cols]
-    if (len(male_dps) == 0) or (len(female_dps) == 0):
-        return None, None, None
-    total_dp = np.sum(male_dps) + np.sum(female_dps)
-    if total_dp == 0:
-        logging.warning('Total coverage depth is 0.')
-        return None, None, None
-    # normalise the depts
-    if normalise:
-        male_dps /= total_dp
-        female_dps /= total_dp
-    male_mean_coverage = np.mean(male_dps)
-    female_mean_coverage = np.mean(female_dps)
-    if male_mean_coverage == 0 or female_mean_coverage == 0:
-        logging.warning('Male or female coverage 0 (male: %.2f, female %.2g).' %(male_mean_coverage, female_mean_coverage))
-    fold_change = female_mean_coverage/male_mean_coverage
-    return male_mean_coverage, female_mean_coverage, fold_change
-
- # initialise counters
-removed = 0
-total = 0
-
-    # setup logging, this will log anything info level or above
-logging.basicConfig(filename=(opts.log_file if opts.log_file != '' else None), filemode='a', level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
-
-logging.info('Start of plotting.')
-
-try:
-    import matplotlib
-    matplotlib.use('Agg')
-    import matplotlib.pyplot as plt
-
-except ImportError as ex:
-    logging.error('Problem importing plotting library.' + str(ex))
-    sys.exit(-1)
-
-# keep fold change for each group
-fold_changes = {}
-fold_changes['all'] = []
-fold_changes['filtered'] = []
-fold_changes['excluded'] = []
-
-coverages = {}
-coverages['all'] = {'male': [], 'female': []}
-coverages['filtered'] = {'male': [], 'female': []}
-coverages['excluded'] = {'male': [], 'female': []}
-
-fold_change_issue = 0
-
-# open files for reading
-try:
-    f = open(opts.input, "r")
-    logging.info('Opened input file %s' % opts.input)
+def read_bam_summary(f, individual_start_col):
+    """
+    Read the summary in a single scan. Returns the headers, the leading columns of every window and
+    aligned (windows x individuals) matrices of the count and duplicate columns, which alternate
+    from individual_start_col.
+    """
     csv_reader = csv.reader(f, delimiter="\t")
-    s = time.time()
+    headers = []
+    windows, values = [], []
     for row in csv_reader:
         if row[0].startswith("#"): # header column
             headers = row
-            individual_idxs = range(individual_start_col + (1 if opts.duplicates else 0), len(headers), 2)
-            individuals = list(map(lambda x : headers[x], individual_idxs)) # only do every second column
-            male_cols, female_cols = find_genders(individuals, offset=0, reverse=opts.reverse)
+            n_individuals = (len(headers) - individual_start_col)//2
+        elif not headers:
+            logging.error('No # header row with the individuals before the first window of the BAM summary.')
+            sys.exit(-1)
         else:
-            total += 1
-            coverage_values = list(map(lambda x: int(row[x]), individual_idxs))
-            male_mean_coverage, female_mean_coverage, fold_change = calc_coverage_and_fold_change(coverage_values, male_cols, female_cols, normalise=True)
-            if fold_change is None:
-                fold_change_in_range = None
-                fold_change_issue += 1
-            else:
-                fold_changes['all'].append(fold_change)
-                coverages['all']['male'].append(male_mean_coverage)
-                coverages['all']['female'].append(female_mean_coverage)
-                if (2.0 - opts.fold_change_margin) < fold_change < (2.0 + opts.fold_change_margin):
-                    fold_change_in_range = True
-                    fold_changes['filtered'].append(fold_change)
-                    coverages['filtered']['male'].append(male_mean_coverage)
-                    coverages['filtered']['female'].append(female_mean_coverage)
-                else:
-                    fold_change_in_range = False
-                    fold_changes['excluded'].append(fold_change)
-                    coverages['excluded']['male'].append(male_mean_coverage)
-                    coverages['excluded']['female'].append(female_mean_coverage)
-
-            if not fold_change_in_range:
-                pass
-            else:
-                removed += 1
-    e = time.time()
-    logging.info('Filtered %d/%d records leaving %d in %.2f seconds.' % (removed, total, total - removed, e-s))
-    f.close()
+            windows.append(row[:individual_start_col])
+            values.append(row[individual_start_col:individual_start_col + 2*n_individuals])
+    if not headers:
+        logging.error('No # header row with the individuals in the BAM summary.')
+        sys.exit(-1)
+    values = np.array(values, np.int64).reshape(len(windows), n_individuals, 2)
+    return headers, windows, values[:, :, 0], values[:, :, 1]
 
+def calc_coverage_and_fold_change(coverage_values, male_cols, female_cols, normalise=True):
+    """
+    Mean male and female coverage and fold change of every window (row) of coverage_values.
+    Windows where they are not defined are nan.
+    """
+    coverage_values = np.asarray(coverage_values, float)
+    n_windows = coverage_values.shape[0]
+    if len(male_cols) == 0 or len(female_cols) == 0:
+        return np.full(n_windows, np.nan), np.full(n_windows, np.nan), np.full(n_windows, np.nan)
+    male_dps = coverage_values[:, male_cols]
+    female_dps = coverage_values[:, female_cols]
+    # nan values (e.g. the rate of a zero count) are left out of the means
+    total_dp = np.nansum(male_dps, axis=1) + np.nansum(female_dps, axis=1)
+    undetermined = (total_dp == 0) if normalise else np.isnan(total_dp)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # normalise the depts
+        if normalise:
+            male_dps = male_dps/total_dp[:, None]
+            female_dps = female_dps/total_dp[:, None]
+        male_mean_coverage = np.nansum(male_dps, axis=1)/np.sum(~np.isnan(male_dps), axis=1)
+        female_mean_coverage = np.nansum(female_dps, axis=1)/np.sum(~np.isnan(female_dps), axis=1)
+        fold_change = female_mean_coverage/male_mean_coverage
+    for values in [male_mean_coverage, female_mean_coverage, fold_change]:
+        values[undetermined] = np.nan
+    n_zero = np.sum(~undetermined & ((male_mean_coverage == 0) | (female_mean_coverage == 0)))
+    if n_zero:
+        logging.warning('Male or female coverage 0 in %d windows.' % n_zero)
+    return male_mean_coverage, female_mean_coverage, fold_change
+
+def plot_distributions(prefix, label, male_mean_coverage, female_mean_coverage, fold_change, fold_change_margin):
+    determined = ~np.isnan(fold_change)
+    in_range = ((2.0 - fold_change_margin) < fold_change) & (fold_change < (2.0 + fold_change_margin))
+    groups = {'all': determined, 'filtered': determined & in_range, 'excluded': determined & ~in_range}
     plot_order = ['all', 'filtered', 'excluded']
     # now plot the distributions
     plt.figure()
     for i, key in enumerate(plot_order):
         plt.subplot(3,1,i+1)
-        plt.hist(fold_changes[key], range=(0.0, 5.0), bins=20)
+        plt.hist(fold_change[groups[key]], range=(0.0, 5.0), bins=20)
         plt.xlabel('Fold change')
-        plt.title('Fold change for %s'%key)
-    output_id = '_id_%s_' % (opts.output_id)
+        plt.title('Fold change of %s for %s' % (label, key))
     plt.tight_layout()
-    plt.savefig('%s%sfold_change_dist.png' % (os.path.basename(opts.input), output_id))
+    plt.savefig('%sfold_change_dist.png' % prefix)
+    plt.close()
 
     plt.figure()
     for i, key in enumerate(plot_order):
         plt.subplot(3,1,i+1)
-        plt.hist(coverages[key]['male'], bins=20, label='male', alpha=0.8)
-        plt.hist(coverages[key]['female'], bins=20, label='female', alpha=0.8)
+        plt.hist(male_mean_coverage[groups[key]], bins=20, label='male', alpha=0.8)
+        plt.hist(female_mean_coverage[groups[key]], bins=20, label='female', alpha=0.8)
         plt.legend(loc='best')
-        plt.xlabel('coverage')
-        plt.title('Coverage for %s'%key)
+        plt.xlabel(label)
+        plt.title('%s for %s' % (label.capitalize(), key))
     plt.tight_layout()
-    plt.savefig('%s%scoverage_dist.png' % (os.path.basename(opts.input), output_id))
+    plt.savefig('%scoverage_dist.png' % prefix)
+    plt.close()
+    return int(np.sum(~determined)), int(np.sum(groups['filtered']))
+
+# only run following code if was called from command line
+if __name__ == '__main__':
+    # setup argument parser
+    parser = argparse.ArgumentParser(description="Script to filter vcf files.")
+    parser.add_argument('-i', '--input', type=str, default='', help='Name of input vcf file.')
+    parser.add_argument('-o', '--output-id', type=str, default='', help='Identifying string to put in output filenames.')
+    parser.add_argument('--fold-change-margin', type=float, default=0.2, help='Margin around 2.0 to use for fold change check (default=0.2).')
+    parser.add_argument('--log-file', type=str, default='', help='File to write log information to (uses stdout if none specified).')
+    parser.add_argument('-r', '--reverse', action='store_true', help='Interchange the labels on the males and females.')
+    parser.add_argument('--window-sizes', type=str, default='', help='Comma separated window sizes in bp (e.g. 10kb, 1mb) or summary rows (e.g. 50snp) for sliding window fold change profiles, written next to the figures (default=no profiles).')
+    parser.add_argument('--sample-depths-output', type=str, default='', help='Name of file to write the total read count of every individual to, usable as X_filtering.py --sample-depths where only the ratios between the individuals matter (not written if none specified).')
+    parser.add_argument('-d', '--duplicates', action='store_true', help='No longer needed, the count and duplicate columns are always plotted together.')
+
+    # parse command line arguments
+    opts = parser.parse_args(sys.argv[1:])
+
+    # config values
+    individual_start_col = 4
 
-
-except IOError as ioerror:
-    logging.error('Problem opening files: ' + str(ioerror))
+    # setup logging, this will log anything info level or above
+    logging.basicConfig(filename=(opts.log_file if opts.log_file != '' else None), filemode='a', level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+
+    logging.info('Start of plotting.')
+
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+
+    except ImportError as ex:
+        logging.error('Problem importing plotting library.' + str(ex))
+        sys.exit(-1)
+
+    # open files for reading
+    try:
+        f = open(opts.input, "r")
+        logging.info('Opened input file %s' % opts.input)
+        s = time.time()
+        headers, windows, counts, duplicates = read_bam_summary(f, individual_start_col)
+        f.close()
+        individuals = headers[individual_start_col::2][:counts.shape[1]] # only do every second column
+        male_cols, female_cols = find_genders(individuals, offset=0, reverse=opts.reverse)
+        total = len(windows)
+        e = time.time()
+        logging.info('Read %d windows of %d individuals in %.2f seconds.' % (total, len(individuals), e-s))
+        if opts.sample_depths_output != '':
+            write_sample_depths(opts.sample_depths_output, dict(zip(individuals, counts.sum(axis=0).tolist())))
+            logging.info('Wrote total read counts of %d individuals to %s' % (len(individuals), opts.sample_depths_output))
+
+        # the duplicate rate is left out of the means where there are no reads
+        with np.errstate(divide='ignore', invalid='ignore'):
+            duplicate_rate = np.where(counts > 0, duplicates/counts.astype(float), np.nan)
+        views = [('', 'coverage', counts, True), ('duplicates_', 'duplicate coverage', duplicates, True),
+                 ('duplicate_rate_', 'duplicate rate', duplicate_rate, False)]
+        output_id = '_id_%s_' % (opts.output_id)
+        window_sizes = parse_window_sizes(opts.window_sizes)
+        for name, label, values, normalise in views:
+            s = time.time()
+            male_mean_coverage, female_mean_coverage, fold_change = calc_coverage_and_fold_change(values, male_cols, female_cols, normalise=normalise)
+            prefix = '%s%s%s' % (os.path.basename(opts.input), output_id, name)
+            fold_change_issue, in_range = plot_distributions(prefix, label, male_mean_coverage, female_mean_coverage, fold_change, opts.fold_change_margin)
+            if window_sizes:
+                # windows are placed by the start position in the second column
+                window_profile = WindowProfile()
+                window_profile.add_arrays([w[0] for w in windows], [int(w[1]) for w in windows], male_mean_coverage, female_mean_coverage)
+                window_profile.write('%sfold_change_windows.tsv' % prefix, window_sizes)
+            e = time.time()
+            logging.info('%s: %d/%d windows with fold change in range, %d undetermined, plotted in %.2f seconds.' % (label.capitalize(), in_range, total, fold_change_issue, e-s))
+
+    except IOError as ioerror:
+        logging.error('Problem opening files: ' + str(ioerror))
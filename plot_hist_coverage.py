@@ -7,14 +7,23 @@ import logging # module to enable logging
 import numpy as np
 import time
 
+from X_filtering_functions import DistributionSummary, field_diagnostics, preview_vcf_lines, wilson_interval
+from X_kernels import GT_HET, GT_MISSING, gt_code
+
 # setup argument parser
 parser = argparse.ArgumentParser(description="Script to filter vcf files.")
 parser.add_argument('-i', '--input', type=str, default='', help='Name of input vcf file.')
 parser.add_argument('-o', '--output-id', type=str, default='', help='Identifying string to put in output filenames.')
 parser.add_argument('-gq', '--gq-threshold', type=int, default=20, help='GQ threshold to use (default=20).')
 parser.add_argument('--fold-change-margin', type=float, default=0.2, help='Margin around 2.0 to use for fold change check (default=0.2).')
+parser.add_argument('--sample-fraction', type=float, default=0.0, help='Preview from a uniform sample of about this fraction of the records, read at random offsets, instead of the whole file (default=0, off).')
+parser.add_argument('--sample-records', type=int, default=0, help='Preview from about this number of records read at random offsets instead of the whole file (default=0, off).')
+parser.add_argument('--seed', type=int, default=None, help='Seed of the random offsets of the preview.')
+parser.add_argument('--diagnostics-output', type=str, default='', help='Name of file to write the counts of malformed GQ, DP and GT fields per sample to (not written if none specified, a summary is always logged).')
+parser.add_argument('--verbose-fields', action='store_true', help='Log every malformed GQ, DP and GT field as it is seen.')
 parser.add_argument('--log-file', type=str, default='', help='File to write log information to (uses stdout if none specified).')
 parser.add_argument('-r', '--reverse', action='store_true', help='Interchange the labels on the males and females.')
+parser.add_argument('-q', '--quantile-output', type=str, default='', help='Name of fold change and coverage quantile summary output file (not written if none specified).')
 
 # parse command line arguments
 opts = parser.parse_args(sys.argv[1:])
@@ -37,13 +46,14 @@ def find_genders(x, offset, reverse=False):
         return males, females
 
 def is_heterozygote(snp_info):
-    first_part = snp_info[:snp_info.find(':')]
-    if first_part == '0/1':
+    # phased, multi-allelic and haploid calls are classified with the interned GT table
+    code = gt_code(snp_info[:snp_info.find(':')])
+    if code == GT_HET:
         return True
-    elif first_part == '0/0' or first_part == '1/1':
-        return False
-    else:
+    elif code == GT_MISSING:
         return None
+    else:
+        return False
 
 def at_least_one_heterozygote(row, cols):
     for col in cols:
@@ -51,12 +61,13 @@ def at_least_one_heterozygote(row, cols):
             return True
     return False
 
-def is_gq_greater_than(snp_info, gq_threshold):
+def is_gq_greater_than(snp_info, gq_threshold, col=None, diagnostics=field_diagnostics):
     parts = snp_info.split(':')
     try:
         gq_value = int(parts[-1]) # we expect GQ to be the last field
     except Exception as exception:
-        logging.debug('GQ value not integer valued: %s of %s.' % (parts[-1], snp_info))
+        if diagnostics is not None:
+            diagnostics.add('GQ', 'not_integer', col, snp_info)
         return False
     return gq_value >= gq_threshold
 
@@ -81,15 +92,15 @@ def count_zygote_gt_type(row, male_cols, female_cols):
 
     return n_hm_male, n_ht_male, n_hm_female, n_ht_female
 
-def filter_by_gq(row, gq_threshold, offset, empty_str='.'):
+def filter_by_gq(row, gq_threshold, offset, empty_str='.', diagnostics=field_diagnostics):
     n = 0
     for i in range(offset, len(row)):
-        if not is_gq_greater_than(row[i], gq_threshold):
+        if not is_gq_greater_than(row[i], gq_threshold, i, diagnostics):
             n += 1
             row[i] = empty_str
     return n
 
-def dp_values(row, cols, dp_idx=2):
+def dp_values(row, cols, dp_idx=2, diagnostics=field_diagnostics):
     # get a list of the dp values for the given rows
     dp_values = []
     for col in cols:
@@ -99,12 +110,14 @@ def dp_values(row, cols, dp_idx=2):
                 dp_value = int(parts[dp_idx])
                 dp_values.append(dp_value)
             except Exception as ex:
-                logging.warning('DP value not an integer %s.' % parts[dp_idx])
+                if diagnostics is not None:
+                    diagnostics.add('DP', 'not_integer', col, row[col])
         else: dp_values.append(0)
     return dp_values
 
-def total_read_dp_per_individual(input_file, individual_start_col, gq_threshold):
-    f = open(input_file, "r")
+def total_read_dp_per_individual(input_file, individual_start_col, gq_threshold, lines=None):
+    # totals over the given text lines (header included) instead of the file when there are some
+    f = open(input_file, "r") if lines is None else lines
     logging.info('Opened input file %s' % input_file)
     csv_reader = csv.reader(f, delimiter="\t")
     s = time.time()
@@ -118,15 +131,16 @@ def total_read_dp_per_individual(input_file, individual_start_col, gq_threshold)
             for i, individual in enumerate(individuals): 
                 all_samples_total_coverages[i + individual_start_col]=0
         else: 
-            gq_filtered = filter_by_gq(row, gq_threshold, offset=individual_start_col)
+            # not counted in the field diagnostics, the plotting pass sees the same cells
+            gq_filtered = filter_by_gq(row, gq_threshold, offset=individual_start_col, diagnostics=None)
             for col_idx in range(individual_start_col, len(row)):
-                individual_dp = dp_values(row, [col_idx])[0]
+                individual_dp = dp_values(row, [col_idx], diagnostics=None)[0]
                 all_samples_total_coverages[col_idx] += individual_dp
     return all_samples_total_coverages
 
 def calc_coverage_and_fold_change(row, male_cols, female_cols, total_sample_read_depth, normalise=True):
-    male_dps = np.array(dp_values(row, male_cols), np.float)                 
-    female_dps = np.array(dp_values(row, female_cols), np.float)
+    male_dps = np.array(dp_values(row, male_cols), float)                 
+    female_dps = np.array(dp_values(row, female_cols), float)
     male_dp_total = np.array(list(map(lambda x: total_sample_read_depth[x], male_cols)))
     female_dp_total = np.array(list(map(lambda x: total_sample_read_depth[x], female_cols)))
     if np.any(male_dp_total == 0) or np.any(female_dp_total == 0):
@@ -150,6 +164,7 @@ total = 0
 
 # setup logging, this will log anything info level or above
 logging.basicConfig(filename=(opts.log_file if opts.log_file != '' else None), filemode='a', level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+field_diagnostics.verbose = opts.verbose_fields
 
 logging.info('Start of plotting.')
 
@@ -174,16 +189,29 @@ coverages['filtered'] = {'male': [], 'female': []}
 coverages['excluded'] = {'male': [], 'female': []}
 
 fold_change_issue = 0
+distribution_summary = DistributionSummary() if opts.quantile_output != '' else None
+preview = opts.sample_fraction > 0 or opts.sample_records > 0
 
-
-total_sample_read_depth = total_read_dp_per_individual(opts.input, individual_start_col, opts.gq_threshold)
+if preview:
+    # only records read at random offsets, the depth totals are scaled up from them
+    preview_lines, n_sampled, estimated_records = preview_vcf_lines(opts.input, n_records=opts.sample_records if opts.sample_records > 0 else None,
+                                                                    fraction=opts.sample_fraction if opts.sample_fraction > 0 else None, seed=opts.seed)
+    logging.info('Previewing %d records of about %d from %s' % (n_sampled, estimated_records, opts.input))
+    total_sample_read_depth = total_read_dp_per_individual(opts.input, individual_start_col, opts.gq_threshold, lines=preview_lines)
+    scale = estimated_records/float(max(n_sampled, 1))
+    total_sample_read_depth = dict((col, dp*scale) for col, dp in total_sample_read_depth.items())
+else:
+    total_sample_read_depth = total_read_dp_per_individual(opts.input, individual_start_col, opts.gq_threshold)
 print(total_sample_read_depth)
 
 
 # open files for reading
 try:
-    f = open(opts.input, "r")
-    logging.info('Opened input file %s' % opts.input)
+    if preview:
+        f = preview_lines
+    else:
+        f = open(opts.input, "r")
+        logging.info('Opened input file %s' % opts.input)
     csv_reader = csv.reader(f, delimiter="\t")
     s = time.time()
     for row in csv_reader:
@@ -217,13 +245,27 @@ try:
                     coverages['excluded']['male'].append(male_mean_coverage)
                     coverages['excluded']['female'].append(female_mean_coverage)
 
+            if distribution_summary is not None:
+                distribution_summary.add(male_mean_coverage, female_mean_coverage, fold_change, fold_change_in_range)
+
             if not is_male_heterozygote and fold_change_in_range:
                 pass
             else:
                 removed += 1
     e = time.time()
     logging.info('Filtered %d/%d records leaving %d in %.2f seconds.' % (removed, total, total - removed, e-s))
-    f.close()
+    field_diagnostics.log_summary()
+    if opts.diagnostics_output != '':
+        field_diagnostics.write(opts.diagnostics_output, headers)
+    if preview:
+        low, high = wilson_interval(total - removed, total)
+        logging.info('Estimated fraction of records left %.4f (95%% CI %.4f-%.4f), about %d of %d records.' % (
+            (total - removed)/float(max(total, 1)), low, high, round((total - removed)/float(max(total, 1))*estimated_records), estimated_records))
+    else:
+        f.close()
+    if distribution_summary is not None:
+        distribution_summary.write(opts.quantile_output)
+        logging.info('Wrote quantile summary to %s' % opts.quantile_output)
     
     # now plot the distributions
     for i, key in enumerate(['all', 'filtered', 'excluded']):
@@ -231,7 +273,7 @@ try:
         plt.hist(fold_changes[key], range=(0.0, 5.0), bins=50)
         plt.xlabel('fold change')
         plt.title('Dist of fold change for %s'%key)
-    output_id = '_id_%s_' % (opts.output_id)
+    output_id = '_id_%s_%s' % (opts.output_id, 'preview_' if preview else '')
     plt.savefig('%s%sfold_change_dist.png' % (os.path.basename(opts.input), output_id))
 
     plt.figure()
@@ -25,6 +25,7 @@ if __name__ == '__main__':
     parser.add_argument('-m', '--meta-input', type=str, default='', help='Name of input meta file.')
     parser.add_argument('-i', '--input', type=str, default='', help='Name of input subset vcf file.')
     parser.add_argument('-o', '--output', type=str, default='', help='Name of output image.')
+    parser.add_argument('--site-index', type=str, default='', help='Name of a saved index of the subset vcf sites, built from the input when missing or out of date and reused by later runs.')
     parser.add_argument('--log-file', type=str, default='', help='File to write log information to (uses stdout if none specified).')
   
     # parse command line arguments
@@ -46,7 +47,10 @@ if __name__ == '__main__':
         sys.exit(-1)
     
     # getting SNP ids of interest from vcf file
-    SNP_IDs = get_SNP_IDs_from_VCF(opts.input)
+    if opts.site_index != '':
+        SNP_IDs = load_or_build_site_index(opts.site_index, opts.input)
+    else:
+        SNP_IDs = SiteIndex.from_vcf(opts.input)
     # get the (normalised) coverage of SNPs of interest
     male_coverages, female_coverages = get_coverages_from_meta(opts.meta_input, SNP_IDs)
     
@@ -1,7 +1,23 @@
 #!/usr/bin/python
 
 import X_filtering as Xf
+import X_cohort_store as Xc
+import X_genotype_cache as Xg
+import X_kernels as Xk
+import X_query_server as Xq
+import X_sex_check as Xs
+import plot_coverage_from_BAM_summary as Xb
+import csv
+import gzip
+import io
 import os
+import subprocess
+import sys
+import threading
+import urllib.error
+import urllib.request
+import numpy as np
+import pytest
 
 """"
 Script to test the basic functionality of functions in the X_filtering.py script.
@@ -29,6 +45,930 @@ def test_df_totals():
     assert(totals[10] == 450)
     assert(totals[11] == 174)
 
+def read_test_rows():
+    with open(scriptdir + '/test.vcf') as f:
+        rows = list(csv.reader(f, delimiter='\t'))
+    return rows[0], rows[1:]
+
+def write_vcf(filename, headers, rows):
+    with open(filename, 'w') as f:
+        csv_writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        csv_writer.writerow(headers)
+        csv_writer.writerows(rows)
+
+def test_cohort_store_matches_row_functions():
+    cohort = Xc.cohort_from_vcf(scriptdir + '/test.vcf', 9, 20)
+    totals = Xf.total_read_dp_per_individual(scriptdir + '/test.vcf', 9, 20)
+    assert(list(cohort['totals']) == [totals[i] for i in sorted(totals)])
+    male_idx, female_idx = Xf.find_genders(cohort['samples'], offset=0)
+    # leave out samples without any coverage so the fold change is defined
+    male_idx = [i for i in male_idx if cohort['totals'][i] > 0]
+    female_idx = [i for i in female_idx if cohort['totals'][i] > 0]
+    results = Xc.store_filter_results(cohort, male_idx, female_idx, 0.2)
+    male_cols, female_cols = [i + 9 for i in male_idx], [i + 9 for i in female_idx]
+    headers, rows = read_test_rows()
+    for i, row in enumerate(rows):
+        gq_filtered = Xf.filter_by_gq(row, 20, offset=9)
+        assert(results['n_gq_filtered'][i] == gq_filtered)
+        counts = Xf.count_zygote_gt_type(row, male_cols, female_cols)
+        assert(counts == (results['n_male_homozygote'][i], results['n_male_heterozygote'][i],
+                          results['n_female_homozygote'][i], results['n_female_heterozygote'][i]))
+        assert(results['is_male_heterozygote'][i] == Xf.at_least_one_heterozygote(row, male_cols))
+        male_mean, female_mean, fold_change = Xf.calc_coverage_and_fold_change(row, male_cols, female_cols, totals)[:3]
+        assert(np.isclose(results['male_mean_coverage'][i], male_mean))
+        assert(np.isclose(results['fold_change'][i], fold_change))
+
+def test_merge_cohorts(tmpdir):
+    headers, rows = read_test_rows()
+    # first file has the first 100 samples on the first 4 sites, second the rest of the samples on every site
+    write_vcf(str(tmpdir.join('a.vcf')), headers[:109], [row[:109] for row in rows[:4]])
+    write_vcf(str(tmpdir.join('b.vcf')), headers[:9] + headers[109:], [row[:9] + row[109:] for row in rows])
+    merged = Xc.merge_cohorts(Xc.cohort_from_vcf(str(tmpdir.join('a.vcf')), 9, 20),
+                              Xc.cohort_from_vcf(str(tmpdir.join('b.vcf')), 9, 20))
+    Xc.save_store(str(tmpdir.join('store')), merged)
+    merged = Xc.load_store(str(tmpdir.join('store')))
+    full = Xc.cohort_from_vcf(scriptdir + '/test.vcf', 9, 20)
+    assert(merged['samples'] == full['samples'])
+    assert(np.array_equal(merged['positions'], full['positions']))
+    assert(np.array_equal(merged['dp'][:4], full['dp'][:4]))
+    assert(np.array_equal(merged['gt'][:4], full['gt'][:4]))
+    # sites missing from the first file are masked for its samples
+    assert(np.all(merged['gt'][4:, :100] == Xf.GT_MISSING))
+    assert(np.array_equal(merged['totals'], merged['dp'].sum(axis=0)))
+
+def write_covered_vcf(filename):
+    # test.vcf restricted to the samples with some coverage, so every fold change is defined
+    headers, rows = read_test_rows()
+    totals = Xf.total_read_dp_per_individual(scriptdir + '/test.vcf', 9, 20)
+    cols = list(range(9)) + [i for i in sorted(totals) if totals[i] > 0]
+    write_vcf(filename, [headers[i] for i in cols], [[row[i] for i in cols] for row in rows])
+
+def write_x_linked_vcf(filename, n_copies=8):
+    # covered samples on several scaffolds, one record in six looks X linked: no male heterozygotes and enough
+    # extra female depth for a normalised fold change close to 2
+    write_covered_vcf(filename)
+    rows = read_tsv(filename)
+    headers, rows = rows[0], rows[1:]
+    male_cols, female_cols = Xf.find_genders(headers[9:], offset=9)
+    x_rows = []
+    for k in range(n_copies):
+        for i, row in enumerate(rows):
+            row = row[:]
+            row[0], row[1] = 'scaffold_%d' % (k % 3), str(k*100 + int(row[1]))
+            if i == 1:
+                for col in male_cols:
+                    row[col] = row[col].replace('0/1', '0/0', 1)
+                for col in female_cols:
+                    parts = row[col].split(':')
+                    parts[2] = str(int(round(2.4*int(parts[2]))))
+                    row[col] = ':'.join(parts)
+            x_rows.append(row)
+    write_vcf(filename, headers, x_rows)
+
+def write_simulated_vcf(filename, n_males=12, n_females=12, n_records=3000, x_fraction=0.25, mislabelled=(), seed=0):
+    # autosomal sites with the same depth in everyone and X linked sites with half the depth and no
+    # heterozygotes in males, samples in mislabelled get the other sex letter in their name
+    rs = np.random.RandomState(seed)
+    sexes = ['m']*n_males + ['f']*n_females
+    names = ['SM%s%02d' % ({'m': 'f', 'f': 'm'}[sex] if i in mislabelled else sex, i) for i, sex in enumerate(sexes)]
+    male = np.array(sexes) == 'm'
+    with open(filename, 'w') as f:
+        f.write('##fileformat=VCFv4.1\n')
+        f.write('\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + names) + '\n')
+        for r in range(n_records):
+            x_linked = rs.random_sample() < x_fraction
+            depth = rs.poisson(np.where(male & x_linked, 10, 20))
+            het = (rs.random_sample(len(sexes)) < 0.3) & ~(male & x_linked)
+            cells = ['%s:0,0,0:%d:0:%d' % ('0/1' if h else '0/0', d, 40) for h, d in zip(het, depth)]
+            f.write('\t'.join(['scaffold_%d' % (r//500), str(r*10 + 1), '.', 'A', 'C', '50', '.', '.', 'GT:PL:DP:SP:GQ'] + cells) + '\n')
+    return names
+
+@pytest.fixture
+def simulated_vcf(tmpdir):
+    # path and sample names of a simulated vcf of 1500 records on three scaffolds
+    filename = str(tmpdir.join('sim.vcf'))
+    return filename, write_simulated_vcf(filename, n_records=1500)
+
+def row_filter_meta(filename, gq_threshold=20, fold_change_margin=0.2):
+    # meta rows worked out with the per row helpers
+    rows = read_tsv(filename)
+    headers, rows = rows[0], rows[1:]
+    male_cols, female_cols = Xf.find_genders(headers[9:], offset=9)
+    totals = Xf.total_read_dp_per_individual(filename, 9, gq_threshold)
+    meta = []
+    for row in rows:
+        gq_filtered = Xf.filter_by_gq(row, gq_threshold, offset=9)
+        counts = Xf.count_zygote_gt_type(row, male_cols, female_cols)
+        is_male_heterozygote = Xf.at_least_one_heterozygote(row, male_cols)
+        male_mean, female_mean, fold_change = Xf.calc_coverage_and_fold_change(row, male_cols, female_cols, totals)[:3]
+        in_range = (2.0 - fold_change_margin) < fold_change < (2.0 + fold_change_margin)
+        meta.append([str(v) for v in [row[0], row[1], is_male_heterozygote] + list(counts) +
+                     [gq_filtered, male_mean, female_mean, fold_change, in_range]])
+    return meta
+
+def row_vcf_arrays(input_file, individual_start_col, gq_threshold):
+    # the arrays of read_vcf_arrays worked out a row at a time with filter_by_gq, dp_values and genotype_code
+    rows = [row for row in read_tsv(input_file) if not row[0].startswith('#')]
+    positions, dps, gts, gq_passes = [], [], [], []
+    for row in rows:
+        positions.append(int(row[1]))
+        Xf.filter_by_gq(row, gq_threshold, offset=individual_start_col)
+        dps.append([(Xf.dp_values(row, [col]) or [0])[0] for col in range(individual_start_col, len(row))])
+        gts.append([Xf.genotype_code(cell) for cell in row[individual_start_col:]])
+        gq_passes.append([cell != '.' for cell in row[individual_start_col:]])
+    return {'positions': np.array(positions, np.int64), 'dp': np.array(dps, np.int32),
+            'gt': np.array(gts, np.int8), 'gq_pass': np.array(gq_passes, bool)}
+
+def run_script(script, *args):
+    subprocess.check_call([sys.executable, os.path.join(scriptdir, '..', script)] + list(args))
+
+def read_tsv(filename):
+    with open(filename) as f:
+        return list(csv.reader(f, delimiter='\t'))
+
+def test_scaffold_summary():
+    summary = Xf.ScaffoldSummary()
+    fold_changes = [1.9, 2.1, 2.5, None, 1.7]
+    for i, fold_change in enumerate(fold_changes):
+        in_range = None if fold_change is None else 1.8 < fold_change < 2.2
+        summary.add('c1', i == 4, 1.0, fold_change, fold_change, in_range, in_range and i != 4)
+    summary.add('c2', False, 1.0, 2.0, 2.0, True, True)
+    rows = list(summary.rows())
+    assert([row[0] for row in rows] == ['c1', 'c2'])
+    values = [1.9, 2.1, 2.5, 1.7]
+    assert(rows[0][1:5] == [5, 1, 2, 4])
+    assert(np.isclose(rows[0][5], np.mean(values)))
+    assert(np.isclose(rows[0][6], np.var(values, ddof=1)))
+    assert(np.isclose(rows[0][9], np.mean(values)))
+    assert(rows[0][10] == 0.5)
+    assert(rows[1][6] is None)
+
+def test_filtering_script_scaffold_output(tmpdir):
+    write_covered_vcf(str(tmpdir.join('in.vcf')))
+    run_script('X_filtering.py', '-i', str(tmpdir.join('in.vcf')), '-o', str(tmpdir.join('out.vcf')),
+               '-m', str(tmpdir.join('meta.tsv')), '-s', str(tmpdir.join('scaffolds.tsv')))
+    meta = read_tsv(str(tmpdir.join('meta.tsv')))[1:]
+    scaffolds = read_tsv(str(tmpdir.join('scaffolds.tsv')))
+    assert(len(scaffolds) == 2 and scaffolds[1][0] == 'consensus_53740')
+    assert(int(scaffolds[1][1]) == len(meta))
+    assert(int(scaffolds[1][2]) == sum(row[2] == 'True' for row in meta))
+    assert(np.isclose(float(scaffolds[1][5]), np.mean([float(row[10]) for row in meta])))
+
+def test_sample_projection(tmpdir):
+    write_covered_vcf(str(tmpdir.join('in.vcf')))
+    headers, rows = read_tsv(str(tmpdir.join('in.vcf')))[0], read_tsv(str(tmpdir.join('in.vcf')))[1:]
+    # excluding the BL samples should be the same as removing their columns
+    excluded = [name for name in headers[9:] if name.startswith('BL')]
+    with open(str(tmpdir.join('excluded.txt')), 'w') as f:
+        f.write('\n'.join(excluded) + '\n')
+    cols = [i for i, name in enumerate(headers) if name not in excluded]
+    write_vcf(str(tmpdir.join('subset.vcf')), [headers[i] for i in cols], [[row[i] for i in cols] for row in rows])
+    run_script('X_filtering.py', '-i', str(tmpdir.join('in.vcf')), '-o', str(tmpdir.join('out.vcf')),
+               '-m', str(tmpdir.join('meta.tsv')), '--exclude-samples', str(tmpdir.join('excluded.txt')))
+    run_script('X_filtering.py', '-i', str(tmpdir.join('subset.vcf')), '-o', str(tmpdir.join('subset_out.vcf')),
+               '-m', str(tmpdir.join('subset_meta.tsv')))
+    assert(read_tsv(str(tmpdir.join('meta.tsv'))) == read_tsv(str(tmpdir.join('subset_meta.tsv'))))
+
+    assert(Xf.read_sample_list('a,b,') == ['a', 'b'])
+    assert(Xf.select_columns(['AMf1', 'AMm1', 'BLf1'], 2, [2, 3, 4], include_samples=['AMf1', 'AMm1'], exclude_samples=['AMm1']) == [2])
+    row = Xf.split_projected('a\tb\tc\td\n', 1)
+    assert(row == ['a', 'b', 'c\td'])
+    assert(Xf.unsplit_projected(row, 1) == ['a', 'b', 'c', 'd'])
+
+def test_genotype_cache(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    assert(not Xg.cache_is_current(cache_dir, scriptdir + '/test.vcf', 9, 20))
+    cache = Xg.load_or_build_genotype_cache(scriptdir + '/test.vcf', cache_dir, 9, 20)
+    assert(Xg.cache_is_current(cache_dir, scriptdir + '/test.vcf', 9, 20))
+    assert(not Xg.cache_is_current(cache_dir, scriptdir + '/test.vcf', 9, 30))
+    # a cache of a different column layout is rebuilt
+    assert(not Xg.cache_is_current(cache_dir, scriptdir + '/test.vcf', 10, 20))
+    cohort = Xc.cohort_from_vcf(scriptdir + '/test.vcf', 9, 20)
+    n_samples = len(cache['samples'])
+    assert(np.array_equal(Xg.unpack_genotypes(np.asarray(cache['gt_packed']), n_samples), cohort['gt']))
+    assert(np.array_equal(np.unpackbits(cache['gq_pass'], axis=1)[:, :n_samples].astype(bool), cohort['gq_pass']))
+    for idx in [Xf.find_genders(cache['samples'], 0)[0], [0, 5, 6, n_samples - 1], []]:
+        n_het, n_hom, n_missing = Xg.genotype_counts(cache, idx, block_size=4)
+        gt = cohort['gt'][:, idx]
+        assert(np.array_equal(n_het, np.sum(gt == Xf.GT_HET, axis=1)))
+        assert(np.array_equal(n_hom, np.sum((gt == Xf.GT_HOM_REF) | (gt == Xf.GT_HOM_ALT), axis=1)))
+        assert(np.array_equal(n_missing, np.sum(gt == Xf.GT_MISSING, axis=1)))
+
+def test_quantile_sketch():
+    rng = np.random.RandomState(1)
+    values = np.concatenate([rng.lognormal(0.5, 1.0, 5000), np.zeros(50)])
+    a, b = Xf.QuantileSketch(0.01), Xf.QuantileSketch(0.01)
+    for value in values[:2000]:
+        a.add(value)
+    for value in values[2000:]:
+        b.add(value)
+    b.add(float('inf'))
+    a.merge(b)
+    assert(a.count == len(values) and a.n_not_finite == 1)
+    sorted_values = np.sort(values)
+    for q in [0.001, 0.01, 0.25, 0.5, 0.9, 0.99, 1.0]:
+        true_value = sorted_values[int(q*(len(values) - 1))]
+        assert(abs(a.quantile(q) - true_value) <= 0.01*true_value + 1e-12)
+    # memory stays bounded, only the lowest quantiles lose accuracy
+    small = Xf.QuantileSketch(0.01, max_bins=50)
+    for value in values:
+        small.add(value)
+    assert(len(small.bins) <= 50)
+    assert(abs(small.quantile(0.99) - sorted_values[int(0.99*(len(values) - 1))]) <= 0.01*sorted_values[-1])
+
+def test_kernels_match_reference_helpers():
+    headers, rows = read_test_rows()
+    lines = [('\t'.join(row) + '\n').encode() for row in rows]
+    # malformed cells: missing GQ, no colon, non integer DP, phased call and a short record
+    lines.append(b'c2\t5\t.\tA\tC\t9\t.\t.\tGT:PL:DP:SP:GQ\t0/1:1,2:x:0:30\t.\t0/1\t1/1:0:7:0:.\t0|1:0,1:4:0:45\r\n')
+    # phased, multi-allelic, haploid, polyploid and partly missing calls
+    cells = ['1/2', '2|2', '1|0', '1', '0', '0/0/1', './1', '1/.', '0/1x', '10/10', '.', '/']
+    lines.append(('c2\t6\t.\tA\tC,G\t9\t.\t.\tGT:PL:DP:SP:GQ\t' + '\t'.join(cell + ':0:3:0:50' for cell in cells) + '\n').encode())
+    reference = [row[:] for row in rows] + [line.decode().rstrip('\r\n').split('\t') for line in lines[-2:]]
+    cols = list(range(9, len(headers)))
+    expected_gt = np.full((len(lines), len(cols)), Xf.GT_MISSING)
+    expected_dp = np.zeros((len(lines), len(cols)))
+    for r, row in enumerate(reference):
+        Xf.filter_by_gq(row, 20, offset=9)
+        for out, col in enumerate(cols[:len(row) - 9]):
+            expected_gt[r, out] = Xf.genotype_code(row[col])
+            dps = Xf.dp_values(row, [col])
+            expected_dp[r, out] = dps[0] if dps else 0
+    for kernel in ['python', 'bytes'] + (['numba'] if Xk.HAVE_NUMBA else []):
+        if kernel == 'bytes':
+            # the byte scanner run as plain python
+            gt = np.full((len(lines), len(cols)), Xf.GT_MISSING, np.int8)
+            gq = np.full((len(lines), len(cols)), Xf.GQ_MISSING, np.int32)
+            dp = np.zeros((len(lines), len(cols)), np.int32)
+            col_map = np.full(max(cols) + 1, -1, np.int64)
+            col_map[cols] = np.arange(len(cols))
+            lengths = np.array([len(line) for line in lines])
+            Xk._scan_block(np.frombuffer(b''.join(lines), np.uint8), np.cumsum(lengths) - lengths, np.cumsum(lengths),
+                           col_map, 2, gt, gq, dp)
+        else:
+            Xk.set_kernel(kernel)
+            gt, gq, dp = Xk.parse_block(lines, cols)
+        # malformed DP and GT fields come out as sentinels, e.g. 0/ and 0/1x
+        assert(dp[-2, 0] == Xk.DP_MALFORMED and gt[-2, 2] == Xk.GT_MALFORMED)
+        assert([i for i in range(len(cells)) if gt[-1, i] == Xk.GT_MALFORMED] == [8, 11])
+        gt, dp, gq_pass = Xk.mask_by_gq(gt, gq, dp, 20)
+        assert(np.array_equal(gt, expected_gt))
+        assert(np.array_equal(dp, expected_dp))
+    Xk.set_kernel('auto')
+    assert(np.array_equal(gq[-2, :5], [30, Xf.GQ_MISSING, Xf.GQ_MISSING, Xf.GQ_MISSING, 45]))
+
+    arrays = Xf.read_vcf_arrays(scriptdir + '/test.vcf', 9, 20, block_records=4)
+    reference = row_vcf_arrays(scriptdir + '/test.vcf', 9, 20)
+    for name in ['dp', 'gt', 'gq_pass', 'positions']:
+        assert(np.array_equal(arrays[name], reference[name]))
+    assert(Xf.total_depths_from_blocks(scriptdir + '/test.vcf', 9, 20) == Xf.total_read_dp_per_individual(scriptdir + '/test.vcf', 9, 20))
+
+def test_interned_gt():
+    calls = {'0/0': (Xk.GT_HOM_REF, 2), '0|1': (Xk.GT_HET, 2), '1|0': (Xk.GT_HET, 2), '1/2': (Xk.GT_HET, 2),
+             '2/2': (Xk.GT_HOM_ALT, 2), '1': (Xk.GT_HOM_ALT, 1), '0': (Xk.GT_HOM_REF, 1), '0/0/1': (Xk.GT_HET, 3),
+             './1': (Xk.GT_MISSING, 2), '.': (Xk.GT_MISSING, 1), '': (Xk.GT_MISSING, 0), 'x/1': (Xk.GT_MISSING, 2)}
+    for gt, call in calls.items():
+        assert(Xk.interned_gt(gt) == call and Xk.interned_gt(gt.encode()) == call)
+        assert(gt in Xk.GT_TABLE)
+    row = ['c', '1', '.', 'A', 'C', '9', '.', '.', 'GT:GQ', '0|1:30', '1/2:30', '1:30', '0/0:30', './.:30']
+    assert(Xf.count_zygote_gt_type(row, [9, 11], [10, 12, 13]) == (1, 1, 1, 1))
+    assert(Xf.at_least_one_heterozygote(row, [9]) and not Xf.at_least_one_heterozygote(row, [11, 12, 13]))
+    assert([Xf.is_heterozygote(row[i]) for i in range(9, 14)] == [True, True, False, False, None])
+
+def test_block_filter_matches_row_filter(tmpdir):
+    write_x_linked_vcf(str(tmpdir.join('in.vcf')), n_copies=12)
+    # a small memory budget so the records are spread over several blocks
+    run_script('X_filtering.py', '-i', str(tmpdir.join('in.vcf')), '-o', str(tmpdir.join('out.vcf')),
+               '-m', str(tmpdir.join('meta.tsv')), '--max-memory', '300k', '--log-file', str(tmpdir.join('log.txt')))
+    meta = read_tsv(str(tmpdir.join('meta.tsv')))[1:]
+    assert(meta == row_filter_meta(str(tmpdir.join('in.vcf'))))
+    out = read_tsv(str(tmpdir.join('out.vcf')))
+    assert(len(out) - 1 == sum(row[2] == 'False' and row[11] == 'True' for row in meta) > 0)
+    log = open(str(tmpdir.join('log.txt'))).read()
+    assert('Peak memory use' in log and '(1 blocks)' not in log)
+    assert(Xf.parse_memory_size('2G') == 2*1024**3 and Xf.parse_memory_size('500k') == 500*1024)
+    assert(Xf.record_block_size(1024**3, 1000, 20000) > Xf.record_block_size(1024**3, 10000, 200000))
+
+def test_checkpoint_resume(tmpdir):
+    write_x_linked_vcf(str(tmpdir.join('in.vcf')), n_copies=12)
+    args = ['-i', str(tmpdir.join('in.vcf')), '-s', str(tmpdir.join('scaffolds.tsv')), '-q', str(tmpdir.join('quantiles.tsv')),
+            '-w', str(tmpdir.join('windows.tsv')), '--window-sizes', '250bp,3snp', '--max-memory', '300k', '--checkpoint-every', '1',
+            '--route-output', str(tmpdir.join('routed')), '-b', str(tmpdir.join('bootstrap.tsv')), '--seed', '1']
+    routed = ['routed_%s.vcf' % route for route in Xf.ROUTES] + ['bootstrap.tsv']
+    run_script('X_filtering.py', '-o', str(tmpdir.join('full.vcf')), '-m', str(tmpdir.join('full_meta.tsv')), *args)
+    expected = [open(str(tmpdir.join(name))).read() for name in ['full.vcf', 'full_meta.tsv', 'scaffolds.tsv', 'quantiles.tsv', 'windows.tsv'] + routed]
+    assert(not os.path.exists(str(tmpdir.join('full.vcf.checkpoint'))))
+
+    # stop the run when the third block is filtered, as if it had been killed
+    crash = ('import runpy, sys, X_filtering_functions as F\n'
+             'filter_record_block, n = F.filter_record_block, [0]\n'
+             'def crashing_filter(*args, **kwargs):\n'
+             '    n[0] += 1\n'
+             '    if n[0] == 3:\n'
+             '        raise SystemExit(3)\n'
+             '    return filter_record_block(*args, **kwargs)\n'
+             'F.filter_record_block = crashing_filter\n'
+             'sys.argv = sys.argv[1:]\n'
+             'runpy.run_path(sys.argv[0], run_name="__main__")\n')
+    out_args = ['-o', str(tmpdir.join('out.vcf')), '-m', str(tmpdir.join('meta.tsv'))]
+    code = subprocess.call([sys.executable, '-c', crash, os.path.join(scriptdir, '..', 'X_filtering.py')] + out_args + args,
+                           cwd=os.path.join(scriptdir, '..'))
+    assert(code == 3)
+    assert(os.path.exists(str(tmpdir.join('out.vcf.checkpoint'))))
+    # the bootstrap sums are kept next to the checkpoint rather than in it
+    bootstrap_state = Xf.read_checkpoint(str(tmpdir.join('out.vcf.checkpoint')))['bootstrap']
+    assert('sums' not in bootstrap_state and os.path.exists(bootstrap_state['sums_file']))
+    # anything written after the checkpoint is dropped on resume
+    with open(str(tmpdir.join('meta.tsv')), 'a') as f:
+        f.write('partial\trow\n')
+    run_script('X_filtering.py', '--resume', *(out_args + args))
+    resumed = [open(str(tmpdir.join(name))).read() for name in ['out.vcf', 'meta.tsv', 'scaffolds.tsv', 'quantiles.tsv', 'windows.tsv'] + routed]
+    assert(resumed == expected)
+    assert(not [name for name in os.listdir(str(tmpdir)) if name.startswith('out.vcf.')])
+
+
+def test_streaming_with_sample_depths(tmpdir, simulated_vcf):
+    filename = simulated_vcf[0]
+    run_script('X_filtering.py', '-i', filename, '-o', str(tmpdir.join('full.vcf')), '-m', str(tmpdir.join('full_meta.tsv')),
+               '--fold-change-margin', '0.5', '--write-sample-depths', str(tmpdir.join('depths.tsv')))
+    depths = Xf.read_sample_depths(str(tmpdir.join('depths.tsv')))
+    assert(len(depths) == 24 and all(isinstance(total, int) and total > 0 for total in depths.values()))
+
+    # stdin to stdout in one pass, normalised with the written totals
+    tmpdir.join('-.checkpoint').write('unrelated')
+    with open(filename, 'rb') as f:
+        out = subprocess.check_output([sys.executable, os.path.join(os.path.abspath(scriptdir), '..', 'X_filtering.py'), '-i', '-', '-o', '-',
+                                       '-m', str(tmpdir.join('meta.tsv')), '--fold-change-margin', '0.5',
+                                       '--sample-depths', str(tmpdir.join('depths.tsv'))], stdin=f, cwd=str(tmpdir))
+    assert(out == tmpdir.join('full.vcf').read_binary())
+    # there is no checkpoint of a stream to clean up
+    assert(tmpdir.join('-.checkpoint').read() == 'unrelated')
+    assert(tmpdir.join('meta.tsv').read() == tmpdir.join('full_meta.tsv').read())
+    # stdin can't be read twice for the totals and a stream can't be checkpointed
+    for extra in [[], ['--sample-depths', str(tmpdir.join('depths.tsv')), '--checkpoint-every', '100']]:
+        with open(filename, 'rb') as f:
+            assert(subprocess.call([sys.executable, os.path.join(scriptdir, '..', 'X_filtering.py'), '-i', '-', '-o', '-',
+                                    '-m', str(tmpdir.join('meta.tsv'))] + extra, stdin=f, stdout=subprocess.DEVNULL) != 0)
+
+
+def test_bootstrap_fold_change(tmpdir, simulated_vcf):
+    rs = np.random.RandomState(1)
+    male_idx, female_idx = [0, 1, 2, 3, 4], [5, 6, 7, 8, 9, 10]
+    # scaffold x has female depth twice the male depth, scaffold a the same
+    x_dp = rs.poisson([10]*5 + [20]*6, size=(400, 11))
+    a_dp = rs.poisson(20, size=(300, 11))
+    totals = np.concatenate([x_dp, a_dp]).sum(axis=0)
+    bootstrap = Xf.BootstrapFoldChange(male_idx, female_idx, totals)
+    for start in range(0, 400, 150):
+        bootstrap.add(['x']*len(x_dp[start:start + 150]), range(start, start + len(x_dp[start:start + 150])), x_dp[start:start + 150])
+    bootstrap.add(['a']*300, range(300), a_dp)
+    assert(bootstrap.units == [['x', 0, 399, 400], ['a', 0, 299, 300]])
+    point, se, low, high = bootstrap.intervals(n_replicates=200, seed=5, chunk_cells=200)
+    # both are scaled by the normalisation, the X linked scaffold stays at twice the fold change
+    assert(np.isclose(point[0]/point[1], 2.0, atol=0.1))
+    assert(np.all(low < point) and np.all(point < high) and np.all(high - low < 0.3*point))
+    # same replicates as resampling the individuals one replicate at a time
+    normalised = np.array([x_dp.sum(axis=0), a_dp.sum(axis=0)])/totals.astype(float) * 1000000
+    draws = np.random.RandomState(5)
+    male_counts = draws.multinomial(5, [0.2]*5, size=200)
+    female_counts = draws.multinomial(6, [1/6.0]*6, size=200)
+    replicates = [np.mean(np.repeat(normalised[0, female_idx], female_counts[b]))/np.mean(np.repeat(normalised[0, male_idx], male_counts[b]))
+                  for b in range(200)]
+    assert(np.isclose(se[0], np.std(replicates, ddof=1)) and np.isclose(low[0], np.quantile(replicates, 0.025)))
+    # blocks of SNPs along the scaffolds
+    blocks = Xf.BootstrapFoldChange(male_idx, female_idx, totals, block_snps=250)
+    blocks.set_state(bootstrap.get_state())
+    assert(blocks.units == bootstrap.units)
+    blocks = Xf.BootstrapFoldChange(male_idx, female_idx, totals, block_snps=250)
+    blocks.set_state(bootstrap.get_state(str(tmpdir.join('sums.npy'))))
+    assert(blocks.units == bootstrap.units and np.array_equal(blocks.sums, bootstrap.sums[:2]))
+    blocks = Xf.BootstrapFoldChange(male_idx, female_idx, totals, block_snps=250)
+    blocks.add(['x']*400, range(400), x_dp)
+    assert([u[3] for u in blocks.units] == [250, 150])
+
+    filename = simulated_vcf[0]
+    args = ['-i', filename, '-o', str(tmpdir.join('out.vcf')), '-m', str(tmpdir.join('meta.tsv')), '-s', str(tmpdir.join('scaffolds.tsv')),
+            '--bootstrap-replicates', '300', '--seed', '2', '--max-memory', '300k']
+    run_script('X_filtering.py', '-b', str(tmpdir.join('bootstrap.tsv')), *args)
+    run_script('X_filtering.py', '-b', str(tmpdir.join('bootstrap2.tsv')), *args)
+    assert(tmpdir.join('bootstrap.tsv').read() == tmpdir.join('bootstrap2.tsv').read())
+    rows, scaffolds = read_tsv(str(tmpdir.join('bootstrap.tsv'))), read_tsv(str(tmpdir.join('scaffolds.tsv')))
+    assert(rows[0] == Xf.BootstrapFoldChange.headers and [row[0] for row in rows[1:]] == [row[0] for row in scaffolds[1:]])
+    for row, scaffold in zip(rows[1:], scaffolds[1:]):
+        assert(int(row[3]) == int(scaffold[4]) and np.isclose(float(row[4]), float(scaffold[9])))
+        assert(float(row[6]) <= float(row[4]) <= float(row[7]))
+
+
+def test_field_diagnostics(tmpdir):
+    diagnostics = Xf.FieldDiagnostics(n_examples=2)
+    row = ['c1', '1', '.', 'A', 'C', '50', '.', '.', 'GT:PL:DP:SP:GQ',
+           '0/1:0,0,0:10:0:.', '0/0:0,0,0:x:0:40', '0/0:0,0,0:7:0:', '0/0:0,0,0:y:0:30']
+    assert(Xf.filter_by_gq(row, 20, offset=9, diagnostics=diagnostics) == 2)
+    assert(Xf.dp_values(row, [10, 12], diagnostics=diagnostics) == [])
+    assert(diagnostics.counts == {('GQ', 'not_integer', 9): 1, ('GQ', 'not_integer', 11): 1,
+                                  ('DP', 'not_integer', 10): 1, ('DP', 'not_integer', 12): 1})
+    assert(diagnostics.examples[('GQ', 'not_integer')] == ['0/1:0,0,0:10:0:.', '0/0:0,0,0:7:0:'])
+    # malformed genotypes are told apart from missing calls
+    Xf.count_zygote_gt_type(['0/x:0', '0/x:0', './.:0', '.'], [1], [2, 3], diagnostics=diagnostics)
+    assert(diagnostics.counts[('GT', 'malformed', 1)] == 1)
+    assert(('GT', 'malformed', 2) not in diagnostics.counts and ('GT', 'malformed', 3) not in diagnostics.counts)
+    state = diagnostics.get_state()
+    restored = Xf.FieldDiagnostics()
+    restored.set_state(state)
+    assert(restored.counts == diagnostics.counts and restored.examples == diagnostics.examples)
+
+    # the row and the block scripts count the same GQ, DP and GT fields
+    headers, rows = read_test_rows()
+    rows[0][9] = rows[0][9].rsplit(':', 1)[0] + ':.'
+    rows[1][10] = rows[1][10].rsplit(':', 1)[0] + ':'
+    rows[2][9] = ':'.join(rows[2][9].split(':')[:2] + ['x'] + rows[2][9].split(':')[3:-1] + ['99'])
+    rows[3][10] = '0/x' + rows[3][10][rows[3][10].find(':'):-2] + '99'
+    rows[4][11] = rows[4][11][:rows[4][11].find(':')] + ':0:y:0:3'
+    write_vcf(str(tmpdir.join('in.vcf')), headers, rows)
+    run_script('X_filter_incl_stats.py', '-i', str(tmpdir.join('in.vcf')), '-o', str(tmpdir.join('stats.vcf')), '-m', str(tmpdir.join('stats_meta.tsv')),
+               '--diagnostics-output', str(tmpdir.join('stats_fields.tsv')))
+    run_script('X_filtering.py', '-i', str(tmpdir.join('in.vcf')), '-o', str(tmpdir.join('out.vcf')), '-m', str(tmpdir.join('meta.tsv')),
+               '--diagnostics-output', str(tmpdir.join('fields.tsv')))
+    stats_fields, fields = read_tsv(str(tmpdir.join('stats_fields.tsv'))), read_tsv(str(tmpdir.join('fields.tsv')))
+    assert(fields[0] == Xf.FieldDiagnostics.headers)
+    field_counts = lambda table: dict(((row[0], row[2], row[3]), int(row[4])) for row in table[1:])
+    assert(field_counts(fields) == field_counts(stats_fields))
+    assert(field_counts(fields)[('GQ', '10', headers[10])] >= 1 and field_counts(fields)[('DP', '9', headers[9])] == 1)
+    assert(field_counts(fields)[('GT', '10', headers[10])] == 1 and ('DP', '11', headers[11]) not in field_counts(fields))
+    # with --verbose-fields every malformed cell is logged with its text
+    run = subprocess.run([sys.executable, os.path.join(scriptdir, '..', 'X_filtering.py'), '-i', str(tmpdir.join('in.vcf')),
+                          '-o', str(tmpdir.join('out.vcf')), '-m', str(tmpdir.join('meta.tsv')), '--verbose-fields'], stderr=subprocess.PIPE)
+    assert(run.returncode == 0 and ('GT value malformed in column 10: %s' % rows[3][10]).encode() in run.stderr)
+
+
+def test_site_index(tmpdir, simulated_vcf):
+    filename = simulated_vcf[0]
+    run_script('X_filtering.py', '-i', filename, '-o', str(tmpdir.join('subset.vcf')), '-m', str(tmpdir.join('meta.tsv')),
+               '--fold-change-margin', '0.5')
+    subset = str(tmpdir.join('subset.vcf'))
+    SNP_IDs = Xf.get_SNP_IDs_from_VCF(subset)
+    index = Xf.SiteIndex.from_vcf(subset)
+    assert(len(index) == len(set(SNP_IDs)) and sorted(index.keys()) == sorted(SNP_IDs))
+    assert(all(np.all(np.diff(p) > 0) and p.dtype == np.int64 for p in index.positions.values()))
+    assert(list(index.contains(['scaffold_0', 'scaffold_0', 'nowhere'], [int(SNP_IDs[0].split(':')[1]), 2, 1])) == [SNP_IDs[0].startswith('scaffold_0:'), False, False])
+    # many small scaffolds, as in a scaffold level assembly, against the CHROM:POS set
+    rs = np.random.RandomState(2)
+    many = Xf.SiteIndex(dict(('s%d' % i, np.unique(rs.randint(1, 1000, 3)).astype(np.int64)) for i in range(3000)))
+    loci = ['s%d' % i for i in rs.randint(0, 3100, 20000)]
+    positions = [many.positions[locus][0] if locus in many.positions and r % 2 else r % 1000 for r, locus in enumerate(loci)]
+    keys = set(many.keys())
+    assert(list(many.contains(loci, positions)) == ['%s:%d' % site in keys for site in zip(loci, positions)])
+
+    # same coverages as the membership test of the CHROM:POS strings
+    meta = read_tsv(str(tmpdir.join('meta.tsv')))[1:]
+    expected = ([float(row[8]) for row in meta if row[0] + ':' + row[1] in SNP_IDs], [float(row[9]) for row in meta if row[0] + ':' + row[1] in SNP_IDs])
+    assert(Xf.get_coverages_from_meta(str(tmpdir.join('meta.tsv')), SNP_IDs) == expected)
+    assert(Xf.get_coverages_from_meta(str(tmpdir.join('meta.tsv')), index, chunk_rows=100) == expected)
+
+    # saved and reused until the vcf changes
+    index_file = str(tmpdir.join('subset.sites.npz'))
+    built = Xf.load_or_build_site_index(index_file, subset)
+    loaded = Xf.SiteIndex.load(index_file)
+    assert(loaded.signature == Xf.vcf_signature(subset) and sorted(loaded.keys()) == sorted(built.keys()))
+    with open(subset, 'a') as f:
+        f.write('\t'.join(['scaffold_99', '5', '.', 'A', 'C', '50', '.', '.', 'GT'] + ['0/0']*24) + '\n')
+    assert(list(Xf.load_or_build_site_index(index_file, subset).contains(['scaffold_99'], [5])) == [True])
+    run_script('plot_subset_normal_cov.py', '-i', subset, '-m', str(tmpdir.join('meta.tsv')), '-o', str(tmpdir.join('subset')),
+               '--site-index', index_file)
+    assert(tmpdir.join('subset_coverage_dist.png').check())
+
+
+def test_permutation_null(tmpdir, simulated_vcf):
+    filename = simulated_vcf[0]
+    args = ['-i', filename, '-m', str(tmpdir.join('meta.tsv')), '--permutations', '200', '--seed', '4', '--max-memory', '300k']
+    run_script('X_filtering.py', '-o', str(tmpdir.join('out.vcf')), '--permutation-output', str(tmpdir.join('null.tsv')),
+               '--permutation-margins', '0.2,0.5', *args)
+    rows = read_tsv(str(tmpdir.join('null.tsv')))
+    assert(rows[0] == Xf.PermutationNull.headers and [float(row[0]) for row in rows[1:]] == [0.2, 0.5])
+    # the unpermuted labels give the filter's own decisions
+    for row in rows[1:]:
+        run_script('X_filtering.py', '-o', str(tmpdir.join('margin.vcf')), '--fold-change-margin', row[0], *args)
+        assert(int(row[1]) == len(tmpdir.join('margin.vcf').read().splitlines()) - 1)
+        assert(int(row[2]) == 200 and 0.0 <= float(row[5]) < 0.2)
+
+    # every permutation is the row filter run with shuffled labels
+    cohort = Xf.read_vcf_arrays(filename, 9, 20)
+    totals = cohort['dp'].sum(axis=0)
+    male_idx, female_idx = Xf.find_genders(cohort['samples'], offset=0)
+    null = Xf.PermutationNull(male_idx, female_idx, totals, [0.3], n_permutations=5, seed=1)
+    for start in range(0, 1500, 400):
+        null.add(cohort['gt'][start:start + 400], cohort['dp'][start:start + 400], chunk_cells=600)
+    pooled = np.array(male_idx + female_idx)
+    for k in range(6):
+        males = pooled[null.males[:, k] == 1]
+        females = pooled[null.males[:, k] == 0]
+        results = Xf.filter_results(cohort['gt'], cohort['dp'], cohort['gq_pass'], list(males), list(females), totals, 0.3)
+        assert(null.counts[0, k] == results['passed'].sum())
+    assert(sorted(pooled[null.males[:, 0] == 1]) == sorted(male_idx))
+
+
+def test_strata(tmpdir, simulated_vcf):
+    assert(Xf.read_strata('popA=SMm0,SMf', ['SMm01', 'SMm11', 'SMf01', 'SMm02']) == [('popA', ['SMm01', 'SMm02']), ('SMf', ['SMf01'])])
+    assert(list(Xf.consensus_passed([[True, True], [True, False], [False, False]], 'all')) == [True, False, False])
+    assert(list(Xf.consensus_passed([[True, True, False], [True, False, False]], 'majority')) == [True, False])
+
+    filename, names = simulated_vcf
+    populations = dict((name, 'A' if i % 12 < 6 else 'B') for i, name in enumerate(names))
+    with open(str(tmpdir.join('sheet.tsv')), 'w') as f:
+        f.write('#sample\tpopulation\n' + ''.join('%s\t%s\n' % item for item in populations.items()))
+    args = ['-i', filename, '--fold-change-margin', '0.5']
+    run_script('X_filtering.py', '-o', str(tmpdir.join('out.vcf')), '-m', str(tmpdir.join('meta.tsv')),
+               '--strata', str(tmpdir.join('sheet.tsv')), '-s', str(tmpdir.join('scaffolds.tsv')), *args)
+    # the scaffold summary is that of the pooled samples, whatever the strata
+    run_script('X_filtering.py', '-o', str(tmpdir.join('pooled.vcf')), '-m', str(tmpdir.join('pooled_meta.tsv')),
+               '-s', str(tmpdir.join('pooled_scaffolds.tsv')), *args)
+    assert(tmpdir.join('scaffolds.tsv').read() == tmpdir.join('pooled_scaffolds.tsv').read())
+    meta = read_tsv(str(tmpdir.join('meta.tsv')))
+    assert(meta[0][12:] == ['%s_%s' % (name, column) for name in 'AB' for column in Xf.STRATUM_COLUMNS] + ['consensus_passed'])
+    # every stratum matches a run over its own samples
+    for k, name in enumerate('AB'):
+        run_script('X_filtering.py', '-o', str(tmpdir.join('%s.vcf' % name)), '-m', str(tmpdir.join('%s_meta.tsv' % name)),
+                   '--include-samples', ','.join(sample for sample in names if populations[sample] == name), *args)
+        stratum_meta = read_tsv(str(tmpdir.join('%s_meta.tsv' % name)))
+        for row, stratum_row in zip(meta[1:], stratum_meta[1:]):
+            assert(row[12 + 6*k:18 + 6*k] == [stratum_row[4]] + stratum_row[8:12] + [str(stratum_row[2] == 'False' and stratum_row[11] == 'True')])
+    passed = [row[:2] for row in meta[1:] if row[17] == 'True' and row[23] == 'True']
+    assert([row[-1] == 'True' for row in meta[1:]] == [row[17] == 'True' and row[23] == 'True' for row in meta[1:]])
+    assert([row[:2] for row in read_tsv(str(tmpdir.join('out.vcf')))[1:]] == passed and len(passed) > 0)
+
+
+def test_routed_outputs(tmpdir, simulated_vcf):
+    filename = simulated_vcf[0]
+    # a low GQ call on every seventh record to be masked
+    with open(filename) as f:
+        lines = f.readlines()
+    for r in range(2, len(lines), 7):
+        lines[r] = lines[r].replace(':40\t', ':5\t', 1)
+    with open(filename, 'w') as f:
+        f.writelines(lines)
+    args = ['-i', filename, '-m', str(tmpdir.join('meta.tsv')), '--fold-change-margin', '0.3', '--max-memory', '500k']
+    run_script('X_filtering.py', '-o', str(tmpdir.join('out.vcf')), '--route-output', str(tmpdir.join('routed')), *args)
+    meta = read_tsv(str(tmpdir.join('meta.tsv')))[1:]
+    records = read_tsv(filename)[2:]
+    for row in records:
+        Xf.filter_by_gq(row, 20, offset=9, diagnostics=None)
+    routed = [read_tsv(str(tmpdir.join('routed_%s.vcf' % route))) for route in Xf.ROUTES]
+    assert(all(rows[0] == read_tsv(filename)[1] for rows in routed))
+    # the X candidates are the filtered records, every route has the low GQ calls masked and the same line endings
+    assert(tmpdir.join('routed_x_candidate.vcf').read() == tmpdir.join('out.vcf').read())
+    for route in Xf.ROUTES:
+        lines = tmpdir.join('routed_%s.vcf' % route).read_binary().splitlines(True)
+        assert(all(line.endswith(b'\r\n') and not line.endswith(b'\r\r\n') for line in lines))
+    for route, rows in zip(Xf.ROUTES[1:], routed[1:]):
+        expected = []
+        for row, record in zip(meta, records):
+            finite = row[10] not in ['inf', 'nan', '']
+            reason = 'male_het' if row[2] == 'True' else 'fold_change' if finite and row[11] == 'False' else \
+                     'undetermined' if not finite else 'x_candidate'
+            if reason == route:
+                expected.append(record)
+        assert(rows[1:] == expected)
+    assert(sum(len(rows) - 1 for rows in routed) == len(records))
+    assert(sum(row[9:].count('.') for rows in routed for row in rows[1:]) == len(range(0, 1500, 7)))
+    assert(len(routed[Xf.ROUTE_MALE_HET]) > 1 and len(routed[Xf.ROUTE_FOLD_CHANGE]) > 1)
+
+    # compressed outputs hold the same records
+    run_script('X_filtering.py', '-o', str(tmpdir.join('out.vcf')), '--route-output', str(tmpdir.join('gz')),
+               '--route-compress-level', '1', '--route-buffer-size', '64k', *args)
+    for route in Xf.ROUTES:
+        with gzip.open(str(tmpdir.join('gz_%s.vcf.gz' % route)), 'rt', newline='') as f:
+            assert(f.read() == open(str(tmpdir.join('routed_%s.vcf' % route)), newline='').read())
+
+
+def test_tolerant_male_heterozygote(tmpdir, simulated_vcf):
+    rs = np.random.RandomState(3)
+    gt = rs.choice([Xk.GT_HOM_REF, Xk.GT_HET, Xk.GT_MISSING], p=[0.8, 0.1, 0.1], size=(300, 20)).astype(np.int8)
+    gq = rs.randint(5, 60, size=gt.shape).astype(np.int32)
+    male_idx, female_idx = list(range(12)), list(range(12, 20))
+    results = Xf.genotype_summary(gt, gt != Xk.GT_MISSING, male_idx, female_idx, gq, male_het_alpha=0.05)
+    # reference from a scipy call per row
+    for i in range(len(gt)):
+        called = [j for j in male_idx if gt[i, j] != Xk.GT_MISSING]
+        expected_errors = sum(10**(-gq[i, j]/10.0) for j in called)
+        pvalue = Xf.stats.poisson.sf(results['n_male_heterozygote'][i] - 1, expected_errors)
+        assert(np.isclose(results['male_het_pvalue'][i], pvalue))
+        assert(results['is_male_heterozygote'][i] == (pvalue < 0.05))
+    assert(np.all(results['male_het_pvalue'][results['n_male_heterozygote'] == 0] == 1))
+    assert(np.all(results['is_male_heterozygote'] <= (results['n_male_heterozygote'] > 0)))
+
+    # one low GQ male heterozygote on every third record
+    filename = simulated_vcf[0]
+    with open(filename) as f:
+        lines = f.readlines()
+    for r in range(2, len(lines), 3):
+        row = lines[r].rstrip('\n').split('\t')
+        row[9:21] = [cell[:cell.rfind(':')] + ':12' for cell in row[9:21]]
+        row[9] = '0/1' + row[9][3:]
+        lines[r] = '\t'.join(row) + '\n'
+    with open(filename, 'w') as f:
+        f.writelines(lines)
+    args = ['-i', filename, '-gq', '10', '--fold-change-margin', '0.5']
+    run_script('X_filtering.py', '-o', str(tmpdir.join('strict.vcf')), '-m', str(tmpdir.join('strict_meta.tsv')), *args)
+    run_script('X_filtering.py', '-o', str(tmpdir.join('tolerant.vcf')), '-m', str(tmpdir.join('meta.tsv')), '--male-het-alpha', '0.01',
+               '--permutation-output', str(tmpdir.join('null.tsv')), '--permutations', '20', '--seed', '1', *args)
+    meta = read_tsv(str(tmpdir.join('meta.tsv')))
+    assert(meta[0][12] == 'male_het_pvalue')
+    strict = set(tuple(row[:2]) for row in read_tsv(str(tmpdir.join('strict.vcf')))[1:])
+    tolerant = set(tuple(row[:2]) for row in read_tsv(str(tmpdir.join('tolerant.vcf')))[1:])
+    assert(strict < tolerant and all(int(row[1]) % 30 == 1 for row in tolerant - strict))
+    assert(int(read_tsv(str(tmpdir.join('null.tsv')))[1][1]) == len(tolerant))
+
+
+def write_bam_summary(filename, names, loci, starts, counts, duplicates, header=True):
+    # four leading columns, then the count and duplicate columns of every individual
+    with open(filename, 'w') as f:
+        if header:
+            f.write('\t'.join(['#contig', 'start', 'end', 'length'] + [column for name in names for column in [name, name + '_duplicates']]) + '\n')
+        for locus, start, count_row, duplicate_row in zip(loci, starts, counts, duplicates):
+            f.write('\t'.join([locus, str(start), str(start + 999), '1000'] + [str(v) for pair in zip(count_row, duplicate_row) for v in pair]) + '\n')
+
+def baseline_coverage_and_fold_change(coverage_values, male_cols, female_cols, normalise=True):
+    # the per window version plot_coverage_from_BAM_summary.py had before it was vectorised
+    male_dps = np.array(coverage_values, float)[male_cols]
+    female_dps = np.array(coverage_values, float)[female_cols]
+    if (len(male_dps) == 0) or (len(female_dps) == 0):
+        return None, None, None
+    total_dp = np.sum(male_dps) + np.sum(female_dps)
+    if total_dp == 0:
+        return None, None, None
+    if normalise:
+        male_dps /= total_dp
+        female_dps /= total_dp
+    male_mean_coverage = np.mean(male_dps)
+    female_mean_coverage = np.mean(female_dps)
+    with np.errstate(divide='ignore'):
+        fold_change = female_mean_coverage/male_mean_coverage
+    return male_mean_coverage, female_mean_coverage, fold_change
+
+def test_bam_summary(tmpdir):
+    rs = np.random.RandomState(4)
+    names = ['SM%s_pool_%s%02d' % (sex, sex, i) for i, sex in enumerate(['m']*6 + ['f']*6)]
+    loci, starts = ['scaffold_%d' % (w//30) for w in range(60)], [(w % 30)*1000 + 1 for w in range(60)]
+    x_linked = rs.random_sample(60) < 0.3
+    counts = rs.poisson(np.where(x_linked[:, None] & (np.arange(12) < 6), 50, 100), size=(60, 12))
+    counts[5] = 0
+    counts[7, :3] = 0
+    duplicates = rs.binomial(counts, 0.1)
+    filename = str(tmpdir.join('bam_summary.tsv'))
+    write_bam_summary(filename, names, loci, starts, counts, duplicates)
+
+    with open(filename) as f:
+        headers, windows, read_counts, read_duplicates = Xb.read_bam_summary(f, 4)
+    assert(headers[4::2] == names and windows[2] == [loci[2], str(starts[2]), str(starts[2] + 999), '1000'])
+    assert(np.array_equal(read_counts, counts) and np.array_equal(read_duplicates, duplicates))
+    male_cols, female_cols = Xb.find_genders(names, offset=0)
+    assert(male_cols == list(range(6)) and female_cols == list(range(6, 12)))
+
+    # vectorised views against the per window baseline, the duplicate rate over the individuals with reads
+    with np.errstate(divide='ignore', invalid='ignore'):
+        duplicate_rate = np.where(counts > 0, duplicates/counts.astype(float), np.nan)
+    vectorised = {'coverage': Xb.calc_coverage_and_fold_change(counts, male_cols, female_cols),
+                  'duplicates': Xb.calc_coverage_and_fold_change(duplicates, male_cols, female_cols),
+                  'duplicate_rate': Xb.calc_coverage_and_fold_change(duplicate_rate, male_cols, female_cols, normalise=False)}
+    baseline = {'coverage': [], 'duplicates': [], 'duplicate_rate': []}
+    for w in range(60):
+        baseline['coverage'].append(baseline_coverage_and_fold_change(counts[w], male_cols, female_cols))
+        baseline['duplicates'].append(baseline_coverage_and_fold_change(duplicates[w], male_cols, female_cols))
+        called = [i for i in range(12) if counts[w, i] > 0]
+        baseline['duplicate_rate'].append(baseline_coverage_and_fold_change(
+            duplicate_rate[w], [i for i in male_cols if i in called], [i for i in female_cols if i in called], normalise=False))
+    for view in baseline:
+        for w, values in enumerate(baseline[view]):
+            for k, value in enumerate(values):
+                assert(np.isnan(vectorised[view][k][w]) if value is None else np.isclose(vectorised[view][k][w], value))
+    assert(np.isnan(vectorised['coverage'][2][5]) and np.isfinite(vectorised['duplicate_rate'][2][7]))
+
+    # the script writes the plots, one SNP (here summary row) windows matching the fold changes, and the read totals
+    subprocess.check_call([sys.executable, os.path.join(os.path.abspath(scriptdir), '..', 'plot_coverage_from_BAM_summary.py'), '-i', filename,
+                           '-o', 'test', '--window-sizes', '1snp,20kb', '--sample-depths-output', 'depths.tsv'], cwd=str(tmpdir))
+    for view in baseline:
+        prefix = 'bam_summary.tsv_id_test_%s' % ('' if view == 'coverage' else view + '_')
+        assert(all(os.path.exists(str(tmpdir.join(prefix + name))) for name in ['fold_change_dist.png', 'coverage_dist.png']))
+        profile = read_tsv(str(tmpdir.join(prefix + 'fold_change_windows.tsv')))
+        one_row = dict(((row[0], int(row[3])), float(row[8])) for row in profile[1:] if row[1] == 'snp')
+        expected = dict(((loci[w], starts[w]), values[2]) for w, values in enumerate(baseline[view]) if values[2] is not None)
+        assert(sorted(one_row) == sorted(expected) and all(np.isclose(one_row[key], expected[key]) for key in expected))
+        assert(any(row[1] == 'bp' and row[2] == '20000' for row in profile[1:]))
+    assert(Xf.read_sample_depths(str(tmpdir.join('depths.tsv'))) == dict(zip(names, counts.sum(axis=0).tolist())))
+
+    # a summary without the header row is an error rather than a NameError
+    write_bam_summary(str(tmpdir.join('no_header.tsv')), names, loci, starts, counts, duplicates, header=False)
+    run = subprocess.run([sys.executable, os.path.join(os.path.abspath(scriptdir), '..', 'plot_coverage_from_BAM_summary.py'),
+                          '-i', 'no_header.tsv', '-o', 'test'], cwd=str(tmpdir), stderr=subprocess.PIPE)
+    assert(run.returncode != 0 and b'No # header row' in run.stderr and b'Traceback' not in run.stderr)
+
+
+def test_sample_depths_from_bam_summary(tmpdir, simulated_vcf):
+    # names with the sex letter where both the vcf (third) and BAM summary (tenth character) scripts look
+    filename, names = simulated_vcf
+    bam_names = ['SM%s_pool_%s%s' % (name[2], name[2], name[3:]) for name in names]
+    with open(filename) as f:
+        lines = f.readlines()
+    lines[1] = lines[1].replace('\t'.join(names), '\t'.join(bam_names))
+    with open(filename, 'w') as f:
+        f.writelines(lines)
+    args = ['-i', filename, '--fold-change-margin', '0.5']
+    run_script('X_filtering.py', '-o', str(tmpdir.join('full.vcf')), '-m', str(tmpdir.join('full_meta.tsv')),
+               '--write-sample-depths', str(tmpdir.join('vcf_depths.tsv')), *args)
+    vcf_depths = Xf.read_sample_depths(str(tmpdir.join('vcf_depths.tsv')))
+
+    # read counts in other units, three times the vcf depth totals over two windows
+    totals = np.array([vcf_depths[name] for name in bam_names])
+    write_bam_summary(str(tmpdir.join('bam_summary.tsv')), bam_names, ['scaffold_0']*2, [1, 1001],
+                      [totals, 2*totals], [totals//10, totals//10])
+    subprocess.check_call([sys.executable, os.path.join(os.path.abspath(scriptdir), '..', 'plot_coverage_from_BAM_summary.py'),
+                           '-i', 'bam_summary.tsv', '--sample-depths-output', 'bam_depths.tsv'], cwd=str(tmpdir))
+    run_script('X_filtering.py', '-o', str(tmpdir.join('out.vcf')), '-m', str(tmpdir.join('meta.tsv')),
+               '--sample-depths', str(tmpdir.join('bam_depths.tsv')), *args)
+    assert(tmpdir.join('out.vcf').read() == tmpdir.join('full.vcf').read())
+    meta, full_meta = read_tsv(str(tmpdir.join('meta.tsv'))), read_tsv(str(tmpdir.join('full_meta.tsv')))
+    assert(len(meta) == len(full_meta) == 1501)
+    for row, full_row in zip(meta[1:], full_meta[1:]):
+        assert(row[:8] == full_row[:8] and row[11] == full_row[11])
+        assert(np.allclose([float(v) for v in row[8:11]], [float(full_row[8])/3, float(full_row[9])/3, float(full_row[10])]))
+
+
+def bh_qvalues(pvalues):
+    # in memory Benjamini-Hochberg q-values
+    pvalues = np.asarray(pvalues)
+    order = np.argsort(pvalues)
+    m = len(pvalues)
+    adjusted = np.minimum.accumulate((pvalues[order]*m/np.arange(1, m + 1))[::-1])[::-1]
+    qvalues = np.empty(m)
+    qvalues[order] = np.minimum(adjusted, 1.0)
+    return qvalues
+
+def test_multiple_testing_correction(tmpdir):
+    values = np.random.RandomState(3).random_sample(1000)
+    values.tofile(str(tmpdir.join('values.bin')))
+    assert(Xf.external_sort(str(tmpdir.join('values.bin')), str(tmpdir.join('sorted.bin')), chunk_records=37) == 1000)
+    assert(np.array_equal(np.fromfile(str(tmpdir.join('sorted.bin'))), np.sort(values)))
+    # tied values across runs and more runs than values per buffer
+    values = np.random.RandomState(4).randint(0, 20, 1000).astype(np.float64)
+    values.tofile(str(tmpdir.join('values.bin')))
+    for chunk_records in [3, 37, 999]:
+        assert(Xf.external_sort(str(tmpdir.join('values.bin')), str(tmpdir.join('sorted.bin')), chunk_records) == 1000)
+        assert(np.array_equal(np.fromfile(str(tmpdir.join('sorted.bin'))), np.sort(values)))
+
+    filename = str(tmpdir.join('x.vcf'))
+    write_x_linked_vcf(filename)
+    for method in ['bh', 'bonferroni']:
+        output, meta_output = str(tmpdir.join(method + '.vcf')), str(tmpdir.join(method + '.meta'))
+        run_script('X_filter_incl_stats.py', '-i', filename, '-o', output, '-m', meta_output,
+                   '--multiple-testing', method, '--alpha', '0.01', '--sort-chunk-records', '5')
+        meta = read_tsv(meta_output)
+        assert(meta[0][-1] == 'qvalue')
+        pvalues = np.array([float(row[14]) for row in meta[1:]])
+        qvalues = np.array([float(row[15]) for row in meta[1:]])
+        expected = bh_qvalues(pvalues) if method == 'bh' else np.minimum(pvalues*len(pvalues), 1.0)
+        assert(np.allclose(qvalues, expected))
+        passed = [row[:2] for row, q in zip(meta[1:], qvalues) if row[2] == 'False' and row[11] == 'True' and q < 0.01]
+        assert(passed and [row[:2] for row in read_tsv(output)[1:]] == passed)
+        assert(not [name for name in os.listdir(str(tmpdir)) if name.endswith('.tmp')])
+
+def test_window_profile():
+    assert(Xf.parse_window_sizes('10kb, 1mb,500,50snp') == [(10000, 'bp'), (1000000, 'bp'), (500, 'bp'), (50, 'snp')])
+    rs = np.random.RandomState(5)
+    positions = np.sort(rs.choice(5000, 300, replace=False))
+    male, female = rs.random_sample(300), rs.random_sample(300)
+    male[7] = np.nan
+    profile, vector_profile = Xf.WindowProfile(), Xf.WindowProfile()
+    for i in range(300):
+        profile.add('scaffold_%d' % (i % 2), positions[i], male[i], female[i])
+    vector_profile.add_arrays(['scaffold_%d' % (i % 2) for i in range(300)], positions, male, female)
+    for size, unit in [(400, 'bp'), (25, 'snp')]:
+        windows = list(profile.windows(size, unit))
+        assert(windows == list(vector_profile.windows(size, unit)))
+        assert(len(windows) > 20)
+        for locus, window_unit, window_size, start, end, n_snps, male_mean, female_mean, fold_change in windows:
+            # brute force mean over the SNPs in the window
+            idx = [i for i in range(300) if i % 2 == int(locus[-1]) and start <= positions[i] <= end and np.isfinite(male[i])]
+            assert(len(idx) == n_snps and (unit == 'bp' or n_snps <= size))
+            assert(np.isclose(male_mean, np.mean(male[idx])) and np.isclose(female_mean, np.mean(female[idx])))
+            assert(np.isclose(fold_change, np.mean(female[idx])/np.mean(male[idx])))
+        if unit == 'snp':
+            # 150 SNPs per contig in steps of 12 don't end on the last SNP, a last window does
+            for locus in ['scaffold_0', 'scaffold_1']:
+                last = [window for window in windows if window[0] == locus][-1]
+                assert(last[4] == positions[int(locus[-1])::2][-1] and last[5] == size)
+
+def test_query_server(tmpdir):
+    filename = str(tmpdir.join('x.vcf'))
+    write_x_linked_vcf(filename, n_copies=4)
+    server = Xq.make_server(Xq.CohortQueries(Xf.read_vcf_arrays(filename, 9, None)), port=0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    url = 'http://127.0.0.1:%d/' % server.server_address[1]
+    try:
+        for gq_threshold in [20, 30, 20]:
+            run_script('X_filtering.py', '-i', filename, '-o', str(tmpdir.join('out.vcf')), '-m', str(tmpdir.join('meta.tsv')),
+                       '-gq', str(gq_threshold))
+            meta = read_tsv(str(tmpdir.join('meta.tsv')))
+            answer = urllib.request.urlopen(url + 'filter?gq=%d' % gq_threshold).read().decode()
+            rows = list(csv.reader(io.StringIO(answer), delimiter='\t'))
+            assert(rows[0][:12] == meta[0] and [row[:12] for row in rows[1:]] == meta[1:])
+            passing = [row[:2] for row in read_tsv(str(tmpdir.join('out.vcf')))[1:]]
+            answer = urllib.request.urlopen(url + 'filter?passing=1&gq=%d' % gq_threshold).read().decode()
+            assert(passing and [row.split('\t')[:2] for row in answer.splitlines()[1:]] == passing)
+
+        sites = ''.join('%s\t%s\n' % tuple(row[:2]) for row in meta[1::5])
+        table = np.load(io.BytesIO(urllib.request.urlopen(url + 'coverage?format=npy', data=sites.encode()).read()))
+        assert(list(table['locus']) == [row[0] for row in meta[1::5]])
+        assert(np.allclose(table['male_mean_coverage'], [float(row[8]) for row in meta[1::5]]))
+
+        answer = urllib.request.urlopen(url + 'heterozygosity?contig=scaffold_1').read().decode().splitlines()
+        assert(answer[0] == 'locus\tposition\tmale_hz\tfemale_hz' and len(answer) > 1)
+        assert(all(line.startswith('scaffold_1\t') for line in answer[1:]))
+        for query, code in [('nothing', 404), ('filter?contig=nothing', 400), ('filter?format=xml', 400)]:
+            try:
+                urllib.request.urlopen(url + query)
+                assert(False)
+            except urllib.error.HTTPError as error:
+                assert(error.code == code)
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+def test_query_sites_with_colon_contigs(tmpdir):
+    filename = str(tmpdir.join('x.vcf'))
+    write_x_linked_vcf(filename, n_copies=3)
+    rows = read_tsv(filename)
+    contigs = {'scaffold_0': 'HLA-A*01:01', 'scaffold_1': 'chrUn:1', 'scaffold_2': 'scaffold_2'}
+    rows = [rows[0]] + [[contigs[row[0]]] + row[1:] for row in rows[1:]]
+    write_vcf(filename, rows[0], rows[1:])
+    queries = Xq.CohortQueries(Xf.read_vcf_arrays(filename, 9, None))
+    expected = list(range(0, len(rows) - 1, 4))
+    sites = [rows[i + 1][:2] for i in expected]
+    assert(Xq.parse_site('HLA-A*01:01:5') == ['HLA-A*01:01', '5'] and Xq.parse_site('chrUn:1\t5\tx') == ['chrUn:1', '5'])
+    for body, params in [(''.join('%s\t%s\n' % tuple(site) for site in sites), {}),
+                         (''.join('%s:%s\n' % tuple(site) for site in sites), {}),
+                         ('', {'sites': ','.join('%s:%s' % tuple(site) for site in sites)})]:
+        assert(list(queries.rows(params, body.encode())) == expected)
+    assert(list(queries.rows({'contig': 'chrUn:1', 'sites': 'chrUn:1:%s' % rows[8][1]})) == [7])
+
+def test_sex_check(tmpdir):
+    filename = str(tmpdir.join('sim.vcf'))
+    names = write_simulated_vcf(filename, mislabelled=(3, 17))
+    lines, estimated_records = Xf.sample_vcf_records(filename, 600, seed=1)
+    assert(400 < len(lines) < 800 and abs(estimated_records - 3000) < 300)
+    records = open(filename, 'rb').readlines()[2:]
+    assert(all(line in records for line in lines) and len(set(lines)) == len(lines))
+    assert(Xf.sample_vcf_records(filename, 5000)[0] == records)
+
+    male_idx, female_idx = Xf.find_genders(names, offset=0)
+    rows, n_sites = Xs.sex_check(lines, names, male_idx, female_idx, list(range(9, 9 + len(names))), 20)
+    assert(n_sites > 50)
+    assert([row[0] for row in rows if row[6]] == [names[3], names[17]])
+    assert(rows[3][5] == 'm' and rows[17][5] == 'f')
+
+    run_script('X_sex_check.py', '-i', filename, '-o', str(tmpdir.join('sex.tsv')), '-n', '600', '--seed', '1')
+    assert([row[0] for row in read_tsv(str(tmpdir.join('sex.tsv')))[1:] if row[6] == 'True'] == [names[3], names[17]])
+    assert(subprocess.call([sys.executable, os.path.join(scriptdir, '..', 'X_sex_check.py'), '-i', filename, '--strict']) == 1)
+
+def test_preview_sampling(tmpdir):
+    filename = str(tmpdir.join('sim.vcf'))
+    write_simulated_vcf(filename, n_records=4000)
+    lines, n_sampled, estimated_records = Xf.preview_vcf_lines(filename, fraction=0.1, seed=3)
+    assert(lines[0].startswith('#CHROM') and len(lines) == n_sampled + 1)
+    assert(abs(n_sampled - 400) < 40 and abs(estimated_records - 4000) < 400)
+    low, high = Xf.wilson_interval(30, 200)
+    assert(np.isclose(low, 0.1071, atol=1e-4) and np.isclose(high, 0.2061, atol=1e-4))
+    assert(Xf.wilson_interval(0, 50)[0] == 0.0 and Xf.wilson_interval(0, 0) == (0.0, 1.0))
+
+    # every tenth record and the first 100 carry a long INFO field, the records after them are not
+    # sampled more often and the first lines don't skew the estimated number of records
+    with open(filename) as f:
+        lines = f.readlines()
+    for r in range(4000):
+        if r % 10 == 0 or r < 100:
+            lines[r + 2] = lines[r + 2].replace('\t50\t.\t.\t', '\t50\t.\tLONG=%s\t' % ('x'*2000), 1)
+    with open(filename, 'w') as f:
+        f.writelines(lines)
+    lines, n_sampled, estimated_records = Xf.preview_vcf_lines(filename, fraction=0.25, seed=4)
+    records = [int(line.split('\t')[1])//10 for line in lines[1:]]
+    assert(abs(n_sampled - 1000) < 100 and abs(estimated_records - 4000) < 300)
+    assert(sum(r % 10 == 1 and r > 100 for r in records) < 130 and sum(r % 10 == 0 or r < 100 for r in records) > 80)
+
+def test_single_scan_report(tmpdir, simulated_vcf):
+    filename = simulated_vcf[0]
+    run_script('X_filtering.py', '-i', filename, '-o', str(tmpdir.join('filtered.vcf')), '-m', str(tmpdir.join('meta.tsv')),
+               '-s', str(tmpdir.join('scaffolds.tsv')), '--fold-change-margin', '0.5')
+    run_script('Compare_Male_HZ_to_Female_Hz.py', '-i', filename, '-o', str(tmpdir.join('compare')))
+    run_script('X_report.py', '-i', filename, '-o', str(tmpdir.join('report.vcf')), '-m', str(tmpdir.join('report_meta.tsv')),
+               '-s', str(tmpdir.join('report_scaffolds.tsv')), '-p', str(tmpdir.join('report')), '--fold-change-margin', '0.5',
+               '--max-memory', '1M')
+    for expected, found in [('filtered.vcf', 'report.vcf'), ('meta.tsv', 'report_meta.tsv'), ('scaffolds.tsv', 'report_scaffolds.tsv'),
+                            ('compare_heterozygote_values.csv', 'report_heterozygote_values.csv')]:
+        assert(tmpdir.join(found).read() == tmpdir.join(expected).read())
+    for plot in ['fold_change_dist', 'coverage_dist', 'heterozygote_scatter']:
+        assert(tmpdir.join('report_%s.png' % plot).check())
+    assert(not tmpdir.join('report.vcf.candidates.tmp').check() and not tmpdir.join('report_meta.tsv.dp.tmp').check())
+
 if __name__ == '__main__':
     test_df_totals()
-